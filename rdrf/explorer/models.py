@@ -71,7 +71,6 @@ class FieldValue(models.Model):
 
     @classmethod
     def put(cls, registry_model, patient_model, context_model, form_model, section_model, cde_model, index, value):
-        datatype = cde_model.datatype.strip().lower()
         model, _ = cls.objects.get_or_create(
             registry=registry_model,
             patient=patient_model,
@@ -80,61 +79,75 @@ class FieldValue(models.Model):
             section=section_model,
             cde=cde_model,
             index=index)
+        model.set_value(form_model, section_model, cde_model, index, value)
+        model.save()
 
-        model.datatype = model.set_datatype(datatype)
-        model.is_range = True if cde_model.pv_group else False
-        model.column_name = model.get_column_name(form_model,
-                                                  section_model,
-                                                  cde_model,
-                                                  index)
+    @classmethod
+    def build(cls, registry_model, patient_id, context_id, form_model, section_model, cde_model, index, value):
+        # an unsaved field value - for bulk_create
+        model = cls(registry=registry_model,
+                    patient_id=patient_id,
+                    context_id=context_id,
+                    form=form_model,
+                    section=section_model,
+                    cde=cde_model,
+                    index=index)
+        model.set_value(form_model, section_model, cde_model, index, value)
+        return model
+
+    def set_value(self, form_model, section_model, cde_model, index, value):
+        datatype = cde_model.datatype.strip().lower()
+        self.datatype = self.set_datatype(datatype)
+        self.is_range = True if cde_model.pv_group else False
+        self.column_name = self.get_column_name(form_model,
+                                                section_model,
+                                                cde_model,
+                                                index)
         if value is None:
-            model.save()
             return
 
         if datatype == 'string':
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
         elif cde_model.pv_group:
-            model.display_value = cde_model.get_display_value(value)
+            self.display_value = cde_model.get_display_value(value)
         elif datatype in ['integer', 'int', 'ineger']:
             try:
-                model.raw_integer = int(value)
+                self.raw_integer = int(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype in ['boolean', 'bool']:
             try:
-                model.raw_boolean = bool(value)
+                self.raw_boolean = bool(value)
             except BaseException:
                 pass
         elif datatype in ['float', 'numeric', 'decimal']:
             try:
-                model.raw_float = float(value)
+                self.raw_float = float(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype == 'date':
             try:
-                model.raw_date = parse_iso_date(value)
+                self.raw_date = parse_iso_date(value)
             except BaseException:
                 pass
         elif datatype == 'file':
             try:
-                model.file_name = value.get("file_name", None)
+                self.file_name = value.get("file_name", None)
             except BaseException:
                 pass
         else:
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
 
-        model.save()
-
     def set_datatype(self, datatype):
         if datatype in ['string', 'striing']:
             return 'string'
@@ -1,13 +1,22 @@
 from collections import OrderedDict
+from functools import reduce
+from multiprocessing import Pool
 import json
+import operator
+import uuid
 
+from django.conf import settings
 from django.db import ProgrammingError
-from django.db import connection
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
 
+from rdrf.db.history import materialise
 from rdrf.helpers.utils import get_cached_instance
 from rdrf.helpers.utils import timed
+from rdrf.helpers.registry_graph import get_registry_graph
 from rdrf.models.definition.models import Registry, RegistryForm, Section
-from rdrf.models.definition.models import CommonDataElement, ClinicalData
+from rdrf.models.definition.models import CommonDataElement, ClinicalData, RDRFContext
 
 from .models import Query
 from .models import FieldValue
@@ -24,8 +33,21 @@ class MissingDataError(Exception):
 class DatabaseUtils(object):
 
     result = None
-
-    def __init__(self, form_object=None, verify=False):
+    _first_rows = None
+
+    # the FieldValue attribute holding the value of each datatype
+    FIELD_VALUE_ATTRIBUTES = {
+        "string": "raw_value",
+        "range": "display_value",
+        "integer": "raw_integer",
+        "float": "raw_float",
+        "file": "file_name",
+        "boolean": "raw_boolean",
+        "date": "raw_date",
+    }
+
+    def __init__(self, form_object=None, verify=False, fetch_size=None):
+        self.fetch_size = fetch_size or settings.EXPLORER_FETCH_SIZE
         self.error_messages = []
         self.warning_messages = []
 
@@ -102,7 +124,7 @@ class DatabaseUtils(object):
             raise
 
         try:
-            self.cursor = self.create_cursor()
+            self.cursor = self.create_cursor(server_side=True)
         except Exception as ex:
             logger.error("Report Error: create cursor: %s" % ex)
             raise
@@ -139,10 +161,9 @@ class DatabaseUtils(object):
 
     @timed
     def generate_results2(self, reverse_column_map, col_map, max_items):
-        from registry.patients.models import Patient
         self.reverse_map = reverse_column_map
         self.col_map = col_map
-        report_columns = col_map.values()
+        report_columns = list(col_map.values())
 
         blank_dict = {column_name: None for column_name in report_columns}
 
@@ -153,49 +174,31 @@ class DatabaseUtils(object):
 
         sql_only = len(self.mongo_models) == 0
 
-        def get_sql_dict(row):
-            sql_columns_dict = {}
-            for i, item in enumerate(row):
-                sql_column_name = self.reverse_map[i]
-                sql_columns_dict[sql_column_name] = item
-                sql_columns_dict["snapshot"] = False
-            return sql_columns_dict
-
         def sql_only_c():
-            for row in self.cursor:
-                d = get_sql_dict(row)
-                yield d
+            for rows in self._row_chunks():
+                for row in rows:
+                    sql_columns_dict = self._get_sql_dict(row)
+                    sql_columns_dict["snapshot"] = False
+                    yield sql_columns_dict
 
         def full_new():
-            registry_id = self.registry_model.id
             from copy import copy
-            for row in self.cursor:
-                row_dict = copy(blank_dict)
-                d = get_sql_dict(row)
-                row_dict.update(d)
-                patient_id = int(d['id'])
-                patient_model = Patient.objects.get(id=patient_id)
-                q = (FieldValue.objects.filter(registry_id=registry_id)
-                     .prefetch_related("patient")
-                     .prefetch_related("context")
-                     .prefetch_related("form")
-                     .prefetch_related("section")
-                     .prefetch_related("cde"))
-
-                for context_model in patient_model.context_models:
-                    context_id = context_model.pk
-                    row = copy(row_dict)
-                    row["context_id"] = context_id
-
-                    qry = q.filter(registry_id=registry_id,
-                                   patient_id=patient_id,
-                                   context_id=context_id,
-                                   column_name__in=report_columns,
-                                   index__lt=max_items)
-
-                    self._get_fvs_by_datatype(qry, row)
-
-                    yield row
+            for rows in self._row_chunks():
+                sql_dicts = [self._get_sql_dict(row) for row in rows]
+                patient_ids = [int(d["id"]) for d in sql_dicts]
+                # one query each for the contexts and field values of the whole chunk
+                contexts = self._get_patient_contexts(patient_ids)
+                field_values = self._get_field_values(patient_ids, report_columns, max_items)
+                for d in sql_dicts:
+                    d["snapshot"] = False
+                    patient_id = int(d["id"])
+                    for context_id in contexts.get(patient_id, []):
+                        row = copy(blank_dict)
+                        row.update(d)
+                        row["context_id"] = context_id
+                        for fv in field_values.get((patient_id, context_id), []):
+                            row[fv.column_name] = self._get_field_value(fv)
+                        yield row
 
         if self.mongo_search_type == "C":
             # current data - no longitudinal snapshots
@@ -211,23 +214,68 @@ class DatabaseUtils(object):
                                            max_items):
                 yield d
 
-    def _get_fvs_by_datatype(self, query, row):
-        for fv in query.filter(datatype='string'):
-            row[fv.column_name] = fv.raw_value
-        for fv in query.filter(datatype='range'):
-            row[fv.column_name] = fv.display_value
-        for fv in query.filter(datatype='integer'):
-            row[fv.column_name] = fv.raw_integer
-        for fv in query.filter(datatype='float'):
-            row[fv.column_name] = fv.raw_float
-        for fv in query.filter(datatype='file'):
-            row[fv.column_name] = fv.file_name
-        for fv in query.filter(datatype='boolean'):
-            row[fv.column_name] = fv.raw_boolean
-        for fv in query.filter(datatype='date'):
-            row[fv.column_name] = fv.raw_date
-        for fv in query.filter(datatype='calculated'):
-            row[fv.column_name] = fv.get_calculated_value()
+    def _get_sql_dict(self, row):
+        return {self.reverse_map[i]: item for i, item in enumerate(row)}
+
+    def _row_chunks(self):
+        """
+        Yields the rows of the query cursor in lists of at most fetch_size rows
+        """
+        rows = self._first_rows
+        self._first_rows = None
+        try:
+            if rows is None:
+                rows = self.cursor.fetchmany(self.fetch_size)
+            while rows:
+                yield rows
+                rows = self.cursor.fetchmany(self.fetch_size)
+        finally:
+            self.cursor.close()
+
+    def _get_patient_contexts(self, patient_ids):
+        # same contexts ( and order ) as Patient.context_models
+        from django.contrib.contenttypes.models import ContentType
+        from registry.patients.models import Patient
+        content_type = ContentType.objects.get_for_model(Patient)
+        contexts = {}
+        qry = (RDRFContext.objects.filter(content_type=content_type, object_id__in=patient_ids)
+                                  .order_by("created_at")
+                                  .values_list("object_id", "pk"))
+        for patient_id, context_id in qry:
+            contexts.setdefault(patient_id, []).append(context_id)
+        return contexts
+
+    def _get_field_values(self, patient_ids, report_columns, max_items):
+        field_values = {}
+        qry = FieldValue.objects.filter(registry=self.registry_model,
+                                        patient_id__in=patient_ids,
+                                        column_name__in=report_columns,
+                                        index__lt=max_items)
+        for fv in qry:
+            field_values.setdefault((fv.patient_id, fv.context_id), []).append(fv)
+        return field_values
+
+    def _get_field_value(self, fv):
+        if fv.datatype == "calculated":
+            return fv.get_calculated_value()
+        attribute = self.FIELD_VALUE_ATTRIBUTES.get(fv.datatype)
+        return getattr(fv, attribute) if attribute else None
+
+    def _get_clinical_documents(self, qry, patient_ids):
+        # the data of the records of each patient in the chunk, in pk order
+        documents = {}
+        qry = qry.filter(django_model="Patient", django_id__in=patient_ids)
+        for patient_id, data in qry.values_list("django_id", "data"):
+            documents.setdefault(patient_id, []).append(data)
+        return documents
+
+    def _get_snapshot_documents(self, qry, patient_ids):
+        # as _get_clinical_documents, with delta encoded snapshots materialised
+        documents = {}
+        qry = qry.filter(django_model="Patient", django_id__in=patient_ids)
+        for snapshot in materialise(qry.data()):
+            documents.setdefault(snapshot["django_id"], []).append(snapshot)
+        return documents
 
     @timed
     def generate_results(self, reverse_column_map, col_map, max_items):
@@ -236,6 +284,7 @@ class DatabaseUtils(object):
 
         collection = ClinicalData.objects.collection(self.registry_model.code, self.collection)
         history = ClinicalData.objects.collection(self.registry_model.code, "history")
+        snapshots = history.filter(data__record_type="snapshot")
 
         if self.projection:
             self.mongo_models = [model_triple for model_triple in self._get_mongo_fields()]
@@ -244,61 +293,43 @@ class DatabaseUtils(object):
 
         sql_only = len(self.mongo_models) == 0
 
-        def full_c2():
-            for row in self.cursor:
-                sql_columns_dict = {}
-                for i, item in enumerate(row):
-                    sql_column_name = self.reverse_map[i]
-                    sql_columns_dict[sql_column_name] = item
-
         def sql_only_c():
-            for row in self.cursor:
-                sql_columns_dict = {}
-                for i, item in enumerate(row):
-                    sql_column_name = self.reverse_map[i]
-                    sql_columns_dict[sql_column_name] = item
-                yield sql_columns_dict
+            for rows in self._row_chunks():
+                for row in rows:
+                    yield self._get_sql_dict(row)
 
-        def full_c():
-            for row in self.cursor:
-                sql_columns_dict = {}
-                for i, item in enumerate(row):
-                    sql_column_name = self.reverse_map[i]
-                    sql_columns_dict[sql_column_name] = item
-
-                    for mongo_columns_dict in self.run_mongo_one_row(sql_columns_dict, collection, max_items):
-                        if mongo_columns_dict is None:
-                            sql_columns_dict["snapshot"] = False
-                            yield sql_columns_dict
-                        else:
-                            mongo_columns_dict["snapshot"] = False
-                            for combined_dict in self._combine_sql_and_mongo(sql_columns_dict, mongo_columns_dict):
-                                yield combined_dict
-
-        def longitudinal():
-            for row in self.cursor:
-                sql_columns_dict = {}
-                for i, item in enumerate(row):
-                    sql_column_name = self.reverse_map[i]
-                    sql_columns_dict[sql_column_name] = item
-
-                    for mongo_columns_dict in self.run_mongo_one_row(sql_columns_dict, collection, max_items):
-                        if mongo_columns_dict is None:
-                            sql_columns_dict["snapshot"] = False
-                            yield sql_columns_dict
-                        else:
-                            mongo_columns_dict["snapshot"] = False
-                            for combined_dict in self._combine_sql_and_mongo(sql_columns_dict, mongo_columns_dict):
-                                yield combined_dict
-
-                    for mongo_columns_dict in self.run_mongo_one_row_longitudinal(
-                            sql_columns_dict, history, max_items):
-                        if mongo_columns_dict is None:
-                            yield None
-                        else:
-                            mongo_columns_dict["snapshot"] = True
-                            for combined_dict in self._combine_sql_and_mongo(sql_columns_dict, mongo_columns_dict):
-                                yield combined_dict
+        def current_rows(sql_columns_dict, documents):
+            if not documents:
+                sql_columns_dict["snapshot"] = False
+                yield sql_columns_dict
+            for mongo_document in documents:
+                mongo_columns_dict = self._get_result_map(mongo_document, max_items=max_items)
+                mongo_columns_dict["snapshot"] = False
+                for combined_dict in self._combine_sql_and_mongo(sql_columns_dict, mongo_columns_dict):
+                    yield combined_dict
+
+        def snapshot_rows(sql_columns_dict, snapshot_documents):
+            for snapshot in snapshot_documents:
+                mongo_columns_dict = self._get_result_map(snapshot, is_snapshot=True, max_items=max_items)
+                mongo_columns_dict["snapshot"] = True
+                for combined_dict in self._combine_sql_and_mongo(sql_columns_dict, mongo_columns_dict):
+                    yield combined_dict
+
+        def full_c(include_snapshots=False):
+            for rows in self._row_chunks():
+                sql_dicts = [self._get_sql_dict(row) for row in rows]
+                patient_ids = [d["id"] for d in sql_dicts]
+                # clinical data for the whole chunk rather than a lookup per row
+                documents = self._get_clinical_documents(collection, patient_ids)
+                if include_snapshots:
+                    snapshot_documents = self._get_snapshot_documents(snapshots, patient_ids)
+                for sql_columns_dict in sql_dicts:
+                    patient_id = sql_columns_dict["id"]
+                    for d in current_rows(sql_columns_dict, documents.get(patient_id, [])):
+                        yield d
+                    if include_snapshots:
+                        for d in snapshot_rows(sql_columns_dict, snapshot_documents.get(patient_id, [])):
+                            yield d
 
         if self.mongo_search_type == "C":
             # current data - no longitudinal snapshots
@@ -315,7 +346,7 @@ class DatabaseUtils(object):
                 for d in sql_only_c():
                     yield d
             else:
-                for d in longitudinal():
+                for d in full_c(include_snapshots=True):
                     yield d
 
     def _combine_sql_and_mongo(self, sql_result_dict, mongo_result_dict):
@@ -384,9 +415,22 @@ class DatabaseUtils(object):
         return [get_info(item) for item in cursor.description]
 
     @timed
-    def create_cursor(self):
-        cursor = connection.cursor()
+    def create_cursor(self, server_side=False):
+        if not server_side:
+            cursor = connection.cursor()
+            cursor.execute(self.query)
+            return cursor
+
+        # a named cursor leaves the result set on the server, rows are
+        # fetched fetch_size at a time by _row_chunks. Outside a transaction
+        # it has to be held open past the query's implicit commit.
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name="explorer_%s" % uuid.uuid4().hex,
+                                              withhold=connection.get_autocommit())
+        cursor.itersize = self.fetch_size
         cursor.execute(self.query)
+        # named cursors only have a description once rows have been fetched
+        self._first_rows = cursor.fetchmany(self.fetch_size)
         return cursor
 
     @timed
@@ -424,29 +468,6 @@ class DatabaseUtils(object):
 
             yield form_model, section_model, cde_model
 
-    def run_mongo_one_row(self, sql_column_data, collection, max_items):
-        mongo_query = {
-            "django_model": "Patient",
-            "django_id": sql_column_data["id"],  # convention?
-        }
-
-        records = collection.find(**mongo_query).data()
-        num_records = records.count()
-        if num_records == 0:
-            yield None
-        else:
-            for mongo_document in records:
-                yield self._get_result_map(mongo_document, max_items=max_items)
-
-    def _process_all_rows(self, collection, max_items=3):
-
-        qry = collection.filter(django_model="Patient")
-        # list of clinical data
-        data = qry.values('django_id', 'context_id', 'data')
-        for item in data:
-            result_map = self._get_result_map(item['data'], max_items=max_items)
-            result_map['id'] = item['django_id']
-
     def _get_result_map(self, mongo_document, is_snapshot=False, max_items=3):
         result = {}
         if is_snapshot:
@@ -495,13 +516,6 @@ class DatabaseUtils(object):
                 result[column_name] = value
         return result
 
-    def run_mongo_one_row_longitudinal(self, sql_column_data, history, max_items):
-        mongo_query = {"django_id": sql_column_data["id"],
-                       "django_model": "Patient",
-                       "record_type": "snapshot"}
-        for snapshot in history.find(**mongo_query).data():
-            yield self._get_result_map(snapshot, is_snapshot=True, max_items=max_items)
-
     def _get_cde_value(self, form_model, section_model, cde_model, mongo_document):
         # retrieve value of cde
         for form_dict in mongo_document["forms"]:
@@ -590,62 +604,221 @@ class ParseQuery(object):
         pass
 
 
-def create_field_values(registry_model, patient_model, context_model, remove_existing=False, form_model=None):
+class FieldValueBuilder(object):
     """
-    Create faster representations of the clinical data for reporting
+    Builds unsaved FieldValue rows from nested clinical data, resolving forms,
+    sections and cdes through the registry graph instead of a query per value.
     """
-    if remove_existing:
-        qry = FieldValue.objects.filter(registry=registry_model,
-                                        patient=patient_model,
-                                        context=context_model)
 
-        if form_model:
-            qry = qry.filter(form=form_model)
-
-        qry.delete()
+    def __init__(self, registry_model):
+        self.registry_model = registry_model
+        self.registry_graph = get_registry_graph(registry_model)
+        # sections and cdes used in the data but no longer on the registry's forms
+        self.other_sections = {}
+        self.other_cdes = {}
+
+    def _get_section(self, section_code):
+        section_model = self.registry_graph.section(section_code)
+        if section_model is None:
+            if section_code not in self.other_sections:
+                self.other_sections[section_code] = Section.objects.filter(code=section_code).first()
+            section_model = self.other_sections[section_code]
+        return section_model
+
+    def _get_cde(self, cde_code):
+        cde_model = self.registry_graph.cde(cde_code)
+        if cde_model is None:
+            if cde_code not in self.other_cdes:
+                self.other_cdes[cde_code] = CommonDataElement.objects.filter(code=cde_code).first()
+            cde_model = self.other_cdes[cde_code]
+        return cde_model
+
+    def build(self, patient_id, context_id, dynamic_data, form_model=None):
+        """
+        :param form_model: if given only the values of this form are built
+        :return: a list of unsaved FieldValue models
+        """
+        field_values = []
+        if not dynamic_data:
+            return field_values
 
-    dynamic_data = patient_model.get_dynamic_data(registry_model,
-                                                  context_id=context_model.id)
-    if dynamic_data:
         for form_dict in dynamic_data["forms"]:
-            try:
-                form_model = RegistryForm.objects.get(name=form_dict["name"],
-                                                      registry=registry_model)
-            except RegistryForm.DoesNotExist:
+            data_form_model = self.registry_graph.form(form_dict["name"])
+            if data_form_model is None:
+                continue
+            if form_model is not None and data_form_model.pk != form_model.pk:
                 continue
             for section_dict in form_dict["sections"]:
-                try:
-                    section_model = Section.objects.get(code=section_dict["code"])
-                except Section.DoesNotExist:
+                section_model = self._get_section(section_dict["code"])
+                if section_model is None:
                     continue
                 if not section_dict["allow_multiple"]:
-                    for cde_dict in section_dict["cdes"]:
-                        try:
-                            cde_model = CommonDataElement.objects.get(code=cde_dict["code"])
-                        except CommonDataElement.DoesNotExist:
+                    items = [section_dict["cdes"]]
+                else:
+                    items = section_dict["cdes"]
+                for index, item in enumerate(items):
+                    for cde_dict in item:
+                        cde_model = self._get_cde(cde_dict["code"])
+                        if cde_model is None:
                             continue
+                        field_values.append(FieldValue.build(self.registry_model,
+                                                             patient_id,
+                                                             context_id,
+                                                             data_form_model,
+                                                             section_model,
+                                                             cde_model,
+                                                             index,
+                                                             cde_dict["value"]))
+        return field_values
+
+
+def _replace_field_values(existing, field_values, remove_existing, batch_size=None):
+    """
+    Saves field values in place of the existing ones in one transaction.
+    Unless remove_existing only the existing values at the paths saved are replaced.
+    """
+    if not remove_existing:
+        paths = OrderedDict()
+        for field_value in field_values:
+            paths.setdefault((field_value.patient_id, field_value.context_id), set()).add(field_value.column_name)
+        if paths:
+            existing = existing.filter(reduce(operator.or_, [Q(patient_id=patient_id,
+                                                               context_id=context_id,
+                                                               column_name__in=column_names)
+                                                             for (patient_id, context_id), column_names
+                                                             in paths.items()]))
+        else:
+            existing = existing.none()
 
-                        FieldValue.put(registry_model,
-                                       patient_model,
-                                       context_model,
-                                       form_model,
-                                       section_model,
-                                       cde_model,
-                                       0,
-                                       cde_dict["value"])
-                else:
-                    for index, item in enumerate(section_dict["cdes"]):
-                        for cde_dict in item:
-                            try:
-                                cde_model = CommonDataElement.objects.get(code=cde_dict["code"])
-                            except CommonDataElement.DoesNotExist:
-                                continue
-
-                            FieldValue.put(registry_model,
-                                           patient_model,
-                                           context_model,
-                                           form_model,
-                                           section_model,
-                                           cde_model,
-                                           index,
-                                           cde_dict["value"])
+    with transaction.atomic():
+        existing.delete()
+        FieldValue.objects.bulk_create(field_values, batch_size=batch_size)
+
+
+def create_field_values(registry_model, patient_model, context_model, remove_existing=False, form_model=None):
+    """
+    Create faster representations of the clinical data for reporting.
+    With remove_existing the field values of the patient and context ( or just
+    form_model if given ) are replaced as a whole, otherwise values no longer
+    in the data are kept.
+    """
+    qry = FieldValue.objects.filter(registry=registry_model,
+                                    patient=patient_model,
+                                    context=context_model)
+
+    if form_model:
+        qry = qry.filter(form=form_model)
+
+    dynamic_data = patient_model.get_dynamic_data(registry_model,
+                                                  context_id=context_model.id)
+    builder = FieldValueBuilder(registry_model)
+    field_values = builder.build(patient_model.pk, context_model.pk, dynamic_data, form_model)
+    _replace_field_values(qry, field_values, remove_existing)
+
+
+class FieldValueMaterialiser(object):
+    """
+    (Re)creates the field values of a whole registry. Clinical data records are
+    read in pk ordered chunks and each chunk's field values replace those of its
+    contexts in one transaction, so chunks can be processed by separate workers.
+    """
+
+    def __init__(self, registry_model, batch_size=500):
+        self.registry_model = registry_model
+        self.batch_size = batch_size
+        self.builder = FieldValueBuilder(registry_model)
+        self.patient_contexts = None
+
+    def _records(self):
+        records = ClinicalData.objects.collection(self.registry_model.code, "cdes")
+        return records.filter(django_model="Patient", context_id__isnull=False)
+
+    def _patient_contexts(self):
+        # clinical data can be in another database so these can't be subqueries
+        from django.contrib.contenttypes.models import ContentType
+        from rdrf.models.definition.models import RDRFContext
+        from registry.patients.models import Patient
+        patient_ids = Patient.objects.filter(rdrf_registry=self.registry_model).values("id")
+        contexts = RDRFContext.objects.filter(registry=self.registry_model,
+                                              content_type=ContentType.objects.get_for_model(Patient),
+                                              object_id__in=patient_ids)
+        return set(contexts.values_list("object_id", "id"))
+
+    def chunks(self):
+        """
+        :return: (first pk, last pk) of each chunk of clinical data records
+        """
+        patient_contexts = self._patient_contexts()
+        pks = [pk for pk, patient_id, context_id in self._records().values_list("pk", "django_id", "context_id")
+               if (patient_id, context_id) in patient_contexts]
+        return [(pks[i], pks[min(i + self.batch_size, len(pks)) - 1])
+                for i in range(0, len(pks), self.batch_size)]
+
+    def create_chunk(self, first_pk, last_pk, remove_existing=True):
+        """
+        :param remove_existing: replace all field values of the chunk's contexts,
+        rather than just those at the paths in their data
+        :return: the number of field values created
+        """
+        records = (self._records().filter(pk__gte=first_pk, pk__lte=last_pk)
+                                  .values_list("django_id", "context_id", "data"))
+        if self.patient_contexts is None:
+            self.patient_contexts = self._patient_contexts()
+        seen = set()
+        field_values = []
+        for patient_id, context_id, dynamic_data in records:
+            # the first record is the one get_dynamic_data returns
+            if (patient_id, context_id) in seen or (patient_id, context_id) not in self.patient_contexts:
+                continue
+            seen.add((patient_id, context_id))
+            field_values.extend(self.builder.build(patient_id, context_id, dynamic_data))
+        # a context belongs to one patient
+        existing = FieldValue.objects.filter(registry=self.registry_model,
+                                             context_id__in=set(context_id for _, context_id in seen))
+        _replace_field_values(existing, field_values, remove_existing, self.batch_size)
+        return len(field_values)
+
+
+_worker_materialiser = None
+
+
+def _create_field_values_chunk(args):
+    # runs in a pool process - each process builds its own materialiser once
+    global _worker_materialiser
+    registry_code, batch_size, remove_existing, first_pk, last_pk = args
+    if _worker_materialiser is None or _worker_materialiser.registry_model.code != registry_code:
+        _worker_materialiser = FieldValueMaterialiser(Registry.objects.get(code=registry_code), batch_size)
+    return _worker_materialiser.create_chunk(first_pk, last_pk, remove_existing)
+
+
+def create_registry_field_values(registry_model, batch_size=500, workers=1, remove_existing=True):
+    """
+    Replaces the field values of a registry a chunk at a time, so reporting
+    keeps working while this runs.
+    Yields the number of field values created as each chunk completes. With
+    remove_existing the field values of contexts without clinical data are
+    deleted once every chunk has completed.
+    """
+    started = timezone.now()
+    materialiser = FieldValueMaterialiser(registry_model, batch_size)
+    chunks = materialiser.chunks()
+
+    if workers <= 1:
+        for first_pk, last_pk in chunks:
+            yield materialiser.create_chunk(first_pk, last_pk, remove_existing)
+    else:
+        # forked workers must not share the parent's database connection
+        connections.close_all()
+        pool = Pool(workers, initializer=connections.close_all)
+        try:
+            work = [(registry_model.code, batch_size, remove_existing, first_pk, last_pk)
+                    for first_pk, last_pk in chunks]
+            for num_values in pool.imap_unordered(_create_field_values_chunk, work):
+                yield num_values
+        finally:
+            pool.close()
+            pool.join()
+
+    if remove_existing:
+        # every context with clinical data got new field values above
+        FieldValue.objects.filter(registry=registry_model, timestamp__lt=started).delete()
@@ -8,7 +8,7 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.urls import reverse
-from django.http import HttpResponse, FileResponse, HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, FileResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.utils.decorators import method_decorator
 from django.views.generic.base import View
@@ -26,6 +26,7 @@ from rdrf.services.io.reporting.reporting_table import ReportingTableGenerator
 
 from rdrf.helpers.utils import models_from_mongo_key, is_delimited_key, BadKeyError, cached
 from rdrf.helpers.utils import mongo_key_from_models, check_suspicious_sql
+from rdrf.helpers.permitted_values import get_permitted_values
 
 logger = logging.getLogger(__name__)
 
@@ -190,7 +191,7 @@ class DownloadQueryView(LoginRequiredMixin, View):
     def _spreadsheet(self, query_model):
         # longitudinal spreadsheet required by FKRP
         humaniser = Humaniser(query_model.registry)
-        spreadsheet_report = SpreadSheetReport(query_model, humaniser)
+        spreadsheet_report = SpreadSheetReport(query_model, humaniser, streaming=True)
         with NamedTemporaryFile(suffix=".xlsx") as output:
             spreadsheet_report.run(output.name)
             response = FileResponse(
@@ -252,9 +253,9 @@ class DownloadQueryView(LoginRequiredMixin, View):
             return self._extract(query_model.title, rtg)
 
     def _extract(self, title, report_table_generator):
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(report_table_generator.stream_csv(), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="query_%s.csv"' % title.lower()
-        return report_table_generator.dump_csv(response)
+        return response
 
 
 class SqlQueryView(View):
@@ -332,12 +333,9 @@ class Humaniser(object):
                 logger.error("Key %s refers to non-existant models" % key)
                 return mongo_value
 
-            if cde_model.pv_group:
+            if cde_model.pv_group_id:
                 # look up the stored code and return the display value
-                range_dict = cde_model.pv_group.as_dict()
-                for value_dict in range_dict["values"]:
-                    if mongo_value == value_dict["code"]:
-                        return value_dict["value"]
+                return get_permitted_values(cde_model.pv_group_id).display_value(mongo_value, mongo_value)
         return mongo_value
 
     def display_value2(self, form_model, section_model, cde_model, mongo_value):
@@ -19,3 +19,7 @@ class RDRFConfig(AppConfig):
         import rdrf.models.proms.models
         import rdrf.models.definition.review_models
         import rdrf.models.definition.verification_models
+        import rdrf.models.definition.progress_models
+        import rdrf.models.definition.post_save_models
+        # invalidates compiled registry definitions ( and permitted values ) when the definition changes
+        import rdrf.helpers.registry_graph
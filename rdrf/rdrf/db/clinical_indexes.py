@@ -0,0 +1,105 @@
+"""
+Expression indexes on the values of individual cdes in the cdes collection.
+
+The GIN index on ClinicalData.data ( migration 0125 ) serves containment
+searches such as ClinicalDataQuerySet.cde_contains. Lookups that compare or
+sort on the value of a particular cde ( context naming, listing columns,
+explorer filters ) use the rdrf_cde_value function instead and need an
+expression index per cde. A registry declares the cdes to index in its
+metadata, as "form/section/cde" paths:
+
+    "clinical_data_indexes": ["ClinicalForm/DiagnosisSection/DiagnosisDate"]
+
+The naming cdes of the registry's context form groups are always indexed.
+"""
+import hashlib
+import logging
+
+from django.db import connections, router
+
+from rdrf.models.definition.models import ClinicalData, ContextFormGroup
+
+logger = logging.getLogger(__name__)
+
+INDEX_PREFIX = "rdrf_cde_"
+
+CREATE_INDEX_SQL = """
+CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ((rdrf_cde_value(data, %s, %s, %s)))
+WHERE registry_code = %s AND collection = 'cdes'
+"""
+
+DROP_INDEX_SQL = "DROP INDEX CONCURRENTLY IF EXISTS {name}"
+
+EXISTING_INDEXES_SQL = """
+SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname LIKE %s
+"""
+
+
+def _connection():
+    # ClinicalData may live in the clinical database
+    return connections[router.db_for_write(ClinicalData)]
+
+
+def index_name(registry_code, cde_path):
+    # postgres names are limited to 63 characters so the path is hashed
+    digest = hashlib.md5(cde_path.encode("utf-8")).hexdigest()[:12]
+    return "%s%s_%s" % (INDEX_PREFIX, registry_code.lower(), digest)
+
+
+def declared_cde_paths(registry_model):
+    """
+    :return: the "form/section/cde" paths to index for a registry
+    """
+    paths = list(registry_model.metadata.get("clinical_data_indexes", []))
+    for naming_cde in (ContextFormGroup.objects.filter(registry=registry_model)
+                                               .exclude(naming_cde_to_use__isnull=True)
+                                               .exclude(naming_cde_to_use="")
+                                               .values_list("naming_cde_to_use", flat=True)):
+        paths.append(naming_cde)
+    return sorted(set(paths))
+
+
+def existing_indexes(registry_code):
+    with _connection().cursor() as cursor:
+        cursor.execute(EXISTING_INDEXES_SQL, [ClinicalData._meta.db_table,
+                                              "%s%s\\_%%" % (INDEX_PREFIX, registry_code.lower())])
+        return set(row[0] for row in cursor.fetchall())
+
+
+def create_index(registry_code, cde_path):
+    form_name, section_code, cde_code = cde_path.split("/")
+    name = index_name(registry_code, cde_path)
+    sql = CREATE_INDEX_SQL.format(name=name, table=ClinicalData._meta.db_table)
+    with _connection().cursor() as cursor:
+        cursor.execute(sql, [form_name, section_code, cde_code, registry_code])
+    logger.info("Created index %s on %s" % (name, cde_path))
+    return name
+
+
+def drop_index(name):
+    with _connection().cursor() as cursor:
+        cursor.execute(DROP_INDEX_SQL.format(name=name))
+    logger.info("Dropped index %s" % name)
+
+
+def sync_indexes(registry_model):
+    """
+    Creates the declared indexes of a registry that don't exist and drops
+    the ones no longer declared
+    :return: (names created, names dropped)
+    """
+    existing = existing_indexes(registry_model.code)
+    wanted = {index_name(registry_model.code, path): path for path in declared_cde_paths(registry_model)}
+    created = [create_index(registry_model.code, path) for name, path in sorted(wanted.items())
+               if name not in existing]
+    dropped = sorted(existing - set(wanted))
+    for name in dropped:
+        drop_index(name)
+    return created, dropped
+
+
+def drop_indexes(registry_model):
+    names = sorted(existing_indexes(registry_model.code))
+    for name in names:
+        drop_index(name)
+    return names
@@ -1,17 +1,22 @@
+from collections import OrderedDict
+from collections.abc import Mapping
 import datetime
+import json
 from operator import itemgetter
 from itertools import zip_longest
 import logging
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.conf import settings
+from django.db.models.expressions import RawSQL
 
-from rdrf.helpers.utils import BadKeyError
+from rdrf.helpers.utils import BadKeyError, timed
 
 from rdrf.db import filestorage
 from rdrf.forms.file_upload import FileUpload, wrap_fs_data_for_form
-from rdrf.models.definition.models import Registry, ClinicalData
-from rdrf.helpers.utils import get_code, models_from_mongo_key, is_delimited_key, mongo_key, is_multisection
+from rdrf.models.definition.models import ClinicalData
+from rdrf.helpers.utils import get_code, is_delimited_key, mongo_key
 from rdrf.helpers.utils import is_file_cde, is_multiple_file_cde, is_uploaded_file
+from rdrf.helpers.registry_graph import get_registry_graph
 
 logger = logging.getLogger(__name__)
 
@@ -84,8 +89,7 @@ def get_mongo_value(registry_code, nested_data, delimited_key, multisection_inde
       nested_data: mongo document dict
       delimited_key: form_name____section_code____cde_code
     """
-    registry_model = Registry.objects.get(code=registry_code)
-    form_model, section_model, cde_model = models_from_mongo_key(registry_model, delimited_key)
+    form_model, section_model, cde_model = get_registry_graph(registry_code).models_from_mongo_key(delimited_key)
 
     if multisection_index is None:
         sectionp = None
@@ -173,7 +177,8 @@ def parse_form_data(registry,
                     is_multisection=False,
                     parse_all_forms=False,
                     django_instance=None,
-                    skip_bad_key=False):
+                    skip_bad_key=False,
+                    registry_graph=None):
     """
     This class takes a bag of values with keys like:
     Takes a bag of values with keys like:
@@ -184,7 +189,7 @@ def parse_form_data(registry,
     This is more or less the opposite of `build_form_data`.
     """
     return FormDataParser(registry, form, data, existing_record, is_multisection, parse_all_forms,
-                          django_instance, skip_bad_key).nested_data
+                          django_instance, skip_bad_key, registry_graph).nested_data
 
 
 class FormDataParser(object):
@@ -204,8 +209,10 @@ class FormDataParser(object):
                  is_multisection=False,
                  parse_all_forms=False,
                  django_instance=None,
-                 skip_bad_key=False):
+                 skip_bad_key=False,
+                 registry_graph=None):
         self.registry_model = registry_model
+        self.registry_graph = registry_graph or get_registry_graph(registry_model)
         self.form_data = form_data
         self.parsed_data = {}
         self.parsed_multisections = {}
@@ -305,10 +312,10 @@ class FormDataParser(object):
                 pass
             elif key == "PatientDataAddressSection":
                 pass
-            elif is_multisection(key):
+            elif self.registry_graph.is_multisection(key):
                 self._parse_multisection(key)
             elif is_delimited_key(key):
-                form_model, section_model, cde_model = models_from_mongo_key(self.registry_model, key)
+                form_model, section_model, cde_model = self.registry_graph.models_from_mongo_key(key)
                 value = self.form_data[key]
                 self.parsed_data[(form_model, section_model, cde_model)] = self._parse_value(value)
 
@@ -318,8 +325,10 @@ class FormDataParser(object):
         the_section_model = None
         multisection_item_list = self.form_data[multisection_code]
         if len(multisection_item_list) == 0:
-            from rdrf.models.definition.models import Section
-            section_model = Section.objects.get(code=multisection_code)
+            section_model = self.registry_graph.section(multisection_code)
+            if section_model is None:
+                from rdrf.models.definition.models import Section
+                section_model = Section.objects.get(code=multisection_code)
             self.parsed_multisections[(self.form_model, section_model)] = []
             return
         items = []
@@ -336,7 +345,7 @@ class FormDataParser(object):
             for key in item_dict:
                 if is_delimited_key(key):
                     value = item_dict[key]
-                    form_model, section_model, cde_model = models_from_mongo_key(self.registry_model, key)
+                    form_model, section_model, cde_model = self.registry_graph.models_from_mongo_key(key)
                     if the_form_model is None:
                         the_form_model = form_model
                     if the_section_model is None:
@@ -381,11 +390,11 @@ class FormDataParser(object):
                 elif is_delimited_key(key):
                     if self.skip_bad_key is True:
                         try:
-                            form_model, section_model, cde_model = models_from_mongo_key(self.registry_model, key)
+                            form_model, section_model, cde_model = self.registry_graph.models_from_mongo_key(key)
                         except BadKeyError:
                             logger.info(f"we are skipping the form data key '{key}'")
                     else:
-                        form_model, section_model, cde_model = models_from_mongo_key(self.registry_model, key)
+                        form_model, section_model, cde_model = self.registry_graph.models_from_mongo_key(key)
                     value = self.form_data[key]
                     self.parsed_data[(form_model, section_model, cde_model)] = self._parse_value(value)
         else:
@@ -403,9 +412,8 @@ class FormDataParser(object):
 
     def _get_multisection_code(self):
         # NB this assumes we're only parsing multisection forms one  at at time
-        from rdrf.helpers.utils import is_multisection
         for key in self.form_data:
-            if is_multisection(key):
+            if self.registry_graph.is_multisection(key):
                 return key
 
     def _get_cde_dict(self, form_model, section_model, cde_model, data):
@@ -435,6 +443,58 @@ class FormDataParser(object):
         return form_dict
 
 
+# keeps only the named forms of a record so that a batch doesn't transfer every form
+FORMS_PROJECTION_SQL = """
+CASE WHEN jsonb_typeof({table}.data->'forms') = 'array' THEN
+    jsonb_set({table}.data, '{{forms}}', COALESCE(
+        (SELECT jsonb_agg(form) FROM jsonb_array_elements({table}.data->'forms') AS form
+         WHERE form->>'name' = ANY(%s)), '[]'::jsonb))
+ELSE {table}.data END::text
+"""
+
+
+class ClinicalDataBatch(Mapping):
+    """
+    The clinical data records of many (patient id, context id) pairs, loaded
+    with one query by DynamicDataWrapper.load_batch.
+    Maps each requested pair to the nested data of its record ( None if there
+    isn't one ), as DynamicDataWrapper.load_dynamic_data(flattened=False) would.
+    Records are fetched as JSON text and only parsed when they are looked up.
+    """
+
+    def __init__(self, keys, records):
+        self._keys = OrderedDict.fromkeys(keys)
+        self._records = records
+        self._parsed = {}
+        self._flattened = {}
+
+    def __getitem__(self, key):
+        if key not in self._parsed:
+            if key not in self._keys:
+                raise KeyError(key)
+            json_text = self._records.get(key)
+            self._parsed[key] = json.loads(json_text) if json_text is not None else None
+        return self._parsed[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def flattened(self, key):
+        """
+        :return: the data of key flattened for form views ( see build_form_data )
+        """
+        if key not in self._flattened:
+            nested_data = self[key]
+            self._flattened[key] = build_form_data(nested_data) if nested_data is not None else None
+        return self._flattened[key]
+
+
 class DynamicDataWrapper(object):
     """
     Utility class to save and load dynamic data for a Django model object
@@ -466,9 +526,18 @@ class DynamicDataWrapper(object):
         # holds reference to the complete data record for this object
         self.patient_record = None
 
+        # compiled registry definition - see _get_registry_graph
+        self.registry_graph = None
+
     def __str__(self):
         return "Dynamic Data Wrapper for %s id=%s" % (self.obj.__class__.__name__, self.obj.pk)
 
+    def _get_registry_graph(self, registry_code):
+        # fetched once per wrapper ( ie per request ) rather than per section saved
+        if self.registry_graph is None or self.registry_graph.registry_model.code != registry_code:
+            self.registry_graph = get_registry_graph(registry_code)
+        return self.registry_graph
+
     def _get_record(self, registry, collection_name, filter_by_context=True):
         qs = ClinicalData.objects.collection(registry, collection_name)
         context_id_to_search_for = None if self.rdrf_context_id == "add" else self.rdrf_context_id
@@ -492,6 +561,7 @@ class DynamicDataWrapper(object):
     def has_data(self, registry_code):
         return self._get_record(registry_code, "cdes").exists()
 
+    @timed
     def load_dynamic_data(self, registry, collection_name, flattened=True):
         """
         :param registry: e.g. sma or dmd
@@ -506,27 +576,60 @@ class DynamicDataWrapper(object):
         else:
             return nested_data
 
-    def get_cde_val(self, registry_code, form_name, section_code, cde_code, collection="cdes"):
-        modjgo_queryset = self._get_record(registry_code, collection)
-        if modjgo_queryset:
-            # NB data is a ClinicalData queryset
-            modjgo_object = modjgo_queryset.first()
-            return modjgo_object.cde_val(form_name, section_code, cde_code)
+    @staticmethod
+    def load_batch(registry_code, patient_contexts, collection="cdes", form_names=None, django_model="Patient"):
+        """
+        Loads the records of many objects with one query rather than a
+        load_dynamic_data call per object.
+        :param patient_contexts: (patient, context) pairs - models or ids. A context of
+        None gets the first record of the patient, like a wrapper without a context.
+        :param collection: a collection with one record per context e.g. cdes or progress
+        :param form_names: if given only these forms are loaded
+        :return: a ClinicalDataBatch keyed by (patient id, context id)
+        """
+        keys = [(getattr(patient, "pk", patient), getattr(context, "pk", context))
+                for patient, context in patient_contexts]
+        patient_ids = set(patient_id for patient_id, _ in keys)
+        context_ids = set(context_id for _, context_id in keys)
+
+        qs = ClinicalData.objects.collection(registry_code, collection).filter(django_model=django_model,
+                                                                               django_id__in=patient_ids)
+        if None not in context_ids:
+            qs = qs.filter(context_id__in=context_ids)
+
+        if form_names is None:
+            qs = qs.annotate(json_text=RawSQL("%s.data::text" % ClinicalData._meta.db_table, ()))
         else:
-            return None
+            projection = FORMS_PROJECTION_SQL.format(table=ClinicalData._meta.db_table)
+            qs = qs.annotate(json_text=RawSQL(projection, (list(form_names),)))
+
+        records = {}
+        for patient_id, context_id, json_text in qs.values_list("django_id", "context_id", "json_text"):
+            # records are in pk order - the first one wins as in load_dynamic_data
+            records.setdefault((patient_id, context_id), json_text)
+            records.setdefault((patient_id, None), json_text)
+        return ClinicalDataBatch(keys, records)
+
+    def get_cde_val(self, registry_code, form_name, section_code, cde_code, collection="cdes"):
+        cde_dict = self.find_cde(registry_code, form_name, section_code, cde_code, collection=collection)
+        return cde_dict.get("value") if cde_dict else None
+
+    def find_cde(self, registry_code, form_name, section_code, cde_code, multisection=False, collection="cdes"):
+        """
+        find_cde ( see rdrf.helpers.utils ) on the record of this object,
+        with the lookup done in the database
+        """
+        return self._get_record(registry_code, collection).cde_value(form_name, section_code, cde_code, multisection)
 
     def get_cde_history(self, registry_code, form_name, section_code, cde_code):
-        from rdrf.helpers.utils import get_cde_value
-        from rdrf.models.definition.models import Registry, RegistryForm, Section, CommonDataElement
-        registry_model = Registry.objects.get(code=registry_code)
-        form_model = RegistryForm.objects.get(registry=registry_model, name=form_name)
+        from rdrf.db.history import cde_series
+        from rdrf.models.definition.models import Section
         section_model = Section.objects.get(code=section_code)
-        cde_model = CommonDataElement.objects.get(code=cde_code)
 
-        def fmt(snapshot, snapshot_number):
+        def fmt(snapshot, value, snapshot_number):
             return {
                 "timestamp": datetime.datetime.strptime(snapshot["timestamp"][:19], "%Y-%m-%d %H:%M:%S"),
-                "value": get_cde_value(form_model, section_model, cde_model, snapshot["record"]),
+                "value": value,
                 "user": snapshot.get("username", ""),
                 "id": str(snapshot_number),
             }
@@ -544,7 +647,8 @@ class DynamicDataWrapper(object):
 
         record_query = self._get_record(registry_code, "history", filter_by_context=False)
         record_query = record_query.find(record_type="snapshot")
-        data = [fmt(snapshot, i) for i, snapshot in enumerate(record_query.data())]
+        series = cde_series(record_query.data(), form_name, section_code, cde_code, section_model.allow_multiple)
+        data = [fmt(snapshot, value, i) for i, (snapshot, value) in enumerate(series)]
         return collapse_same(sorted(data, key=itemgetter("timestamp")))
 
     def load_registry_specific_data(self, registry_model=None):
@@ -575,11 +679,6 @@ class DynamicDataWrapper(object):
             record.data.update(registry_data)
             record.save()
 
-    def _is_section_code(self, code):
-        # Supplied code will be non-delimited
-        from rdrf.models.definition.models import Section
-        return Section.objects.filter(code=code).exists()
-
     @staticmethod
     def handle_file_upload(registry_code, key, value, current_value):
         to_delete = False
@@ -614,16 +713,17 @@ class DynamicDataWrapper(object):
         return list(filter(bool, updated))
 
     def _update_files_in_fs(self, existing_record, registry, new_data, index_map):
+        registry_graph = self._get_registry_graph(registry)
         for key, value in new_data.items():
-            cde_code = get_code(key)
-            if is_file_cde(cde_code):
+            cde_model = registry_graph.cde(get_code(key))
+            if cde_model is not None and cde_model.datatype == "file":
                 existing_value = get_mongo_value(registry, existing_record, key)
-                if is_multiple_file_cde(cde_code):
+                if cde_model.allow_multiple:
                     new_data[key] = self.handle_file_uploads(registry, key, value, existing_value)
                 else:
                     new_data[key] = self.handle_file_upload(registry, key, value, existing_value)
 
-            elif (self._is_section_code(key) and self.current_form_model and index_map is not None):
+            elif (registry_graph.section(key) is not None and self.current_form_model and index_map is not None):
                 new_data[key] = update_multisection_file_cdes(registry, key, value, self.current_form_model,
                                                               existing_record, index_map)
 
@@ -685,6 +785,7 @@ class DynamicDataWrapper(object):
         context_model.save()
         return context_model.pk
 
+    @timed
     def save_dynamic_data(self,
                           registry,
                           collection_name,
@@ -713,15 +814,17 @@ class DynamicDataWrapper(object):
 
         self._update_files_in_fs(record.data, registry, form_data, index_map)
 
+        registry_graph = self._get_registry_graph(registry)
         nested_data = parse_form_data(
-            Registry.objects.get(code=registry),
+            registry_graph.registry_model,
             self.current_form_model,
             form_data,
             existing_record=record.data,
             is_multisection=multisection,
             parse_all_forms=parse_all_forms,
             django_instance=self.obj,
-            skip_bad_key=skip_bad_key)
+            skip_bad_key=skip_bad_key,
+            registry_graph=registry_graph)
 
         if additional_data is not None:
             nested_data.update(additional_data)
@@ -759,6 +862,9 @@ class DynamicDataWrapper(object):
             }
 
             history = self._make_record(registry_code, "history", data=snapshot)
+            if settings.HISTORY_STORAGE == "deltas":
+                from rdrf.db.history import delta_encode
+                delta_encode(history)
             history.save()
         except Exception as ex:
             from registry.patients.models import Patient
@@ -772,7 +878,7 @@ class DynamicDataWrapper(object):
 
     def save_form_progress(self, registry_code, context_model=None):
         from rdrf.forms.progress.form_progress import FormProgress
-        registry_model = Registry.objects.get(code=registry_code)
+        registry_model = self._get_registry_graph(registry_code).registry_model
         form_progress = FormProgress(registry_model)
         dynamic_data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
         return form_progress.save_progress(self.obj, dynamic_data, context_model)
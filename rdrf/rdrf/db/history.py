@@ -0,0 +1,193 @@
+"""
+Delta encoded longitudinal history.
+
+Every form save adds a snapshot of the saved cdes record to the history
+collection. By default ( settings.HISTORY_STORAGE = "snapshots" ) each
+snapshot holds a full copy of the record under "record". With
+HISTORY_STORAGE = "deltas" a snapshot holds only the forms and top level
+keys that changed since the previous snapshot of the same record, under
+"delta", and every HISTORY_CHECKPOINT_INTERVAL snapshots a full one is
+written as a checkpoint.
+
+The snapshots of a record form a chain ( same registry, object and context )
+in pk order. Delta snapshots name the pk of their checkpoint ( "base" ) and
+their position after it ( "sequence" ). Code reading history should pass the
+snapshots through materialise(), which gives every snapshot a "record" whether
+it is stored in full or as a delta.
+"""
+from django.conf import settings
+from django.db import router, transaction
+
+from rdrf.helpers.utils import find_cde
+from rdrf.models.definition.models import ClinicalData
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DELTA_KEY = "delta"
+
+
+def is_delta(snapshot):
+    return DELTA_KEY in snapshot
+
+
+def chain_key(snapshot):
+    return (snapshot.get("registry_code"), snapshot.get("django_model"),
+            snapshot.get("django_id"), snapshot.get("context_id"))
+
+
+def diff_records(old_record, new_record):
+    """
+    :return: the delta which turns old_record into new_record ( see apply_delta )
+    """
+    old_forms = {form_dict["name"]: form_dict for form_dict in old_record.get("forms", [])}
+    new_forms = new_record.get("forms")
+    return {
+        "keys": {key: value for key, value in new_record.items()
+                 if key != "forms" and old_record.get(key) != value},
+        "removed_keys": [key for key in old_record if key != "forms" and key not in new_record],
+        "forms": {form_dict["name"]: form_dict for form_dict in new_forms or []
+                  if old_forms.get(form_dict["name"]) != form_dict},
+        "form_order": None if new_forms is None else [form_dict["name"] for form_dict in new_forms],
+    }
+
+
+def apply_delta(record, delta):
+    """
+    :return: a new record - the forms of record that didn't change are shared, not copied
+    """
+    new_record = {key: value for key, value in record.items()
+                  if key != "forms" and key not in delta["removed_keys"]}
+    new_record.update(delta["keys"])
+    if delta["form_order"] is not None:
+        forms = {form_dict["name"]: form_dict for form_dict in record.get("forms", [])}
+        forms.update(delta["forms"])
+        new_record["forms"] = [forms[name] for name in delta["form_order"]]
+    return new_record
+
+
+def materialise(snapshots, key_func=chain_key):
+    """
+    :param snapshots: history data dicts in pk order. A delta needs the earlier
+    snapshots of its chain back to its checkpoint, e.g. all the history of a patient.
+    :param key_func: maps a snapshot to its chain
+    :return: generator of the snapshots, each with its full "record"
+    """
+    records = {}
+    for snapshot in snapshots:
+        key = key_func(snapshot)
+        if is_delta(snapshot):
+            if key not in records:
+                logger.error("History delta for %s without its checkpoint %s" % (key, snapshot.get("base")))
+            record = apply_delta(records.get(key, {}), snapshot[DELTA_KEY])
+            snapshot = {k: v for k, v in snapshot.items() if k not in ("delta", "base", "sequence")}
+            snapshot["record"] = record
+        else:
+            record = snapshot.get("record", {})
+        records[key] = record
+        yield snapshot
+
+
+def chain_query(history_model):
+    # the history of the record a history model was taken from
+    return ClinicalData.objects.collection(history_model.registry_code, "history").filter(
+        django_model=history_model.django_model,
+        django_id=history_model.django_id,
+        context_id=history_model.context_id)
+
+
+def snapshot_record(history_model):
+    """
+    :return: the full record of one history model
+    """
+    if not is_delta(history_model.data):
+        return history_model.data.get("record")
+    rows = chain_query(history_model).filter(pk__gte=history_model.data["base"], pk__lte=history_model.pk)
+    snapshot = None
+    for snapshot in materialise(rows.data(), key_func=lambda snapshot: None):
+        pass
+    return snapshot["record"] if snapshot else None
+
+
+def cde_series(snapshots, form_name, section_code, cde_code, multisection=False):
+    """
+    The values of one cde through history
+    :param snapshots: as for materialise
+    :return: generator of (snapshot, value) - value is None if the cde isn't in the snapshot
+    ( for a multisection, the list of the cde's values in each item )
+    """
+    for snapshot in materialise(snapshots):
+        found = find_cde(snapshot["record"], form_name, section_code, cde_code, multisection)
+        if multisection or found is None:
+            yield snapshot, found
+        else:
+            yield snapshot, found["value"]
+
+
+def delta_encode(history_model, checkpoint_interval=None):
+    """
+    Replaces the record of a new ( unsaved ) history model with a delta against
+    the previous snapshot of its chain, unless a checkpoint is due.
+    """
+    checkpoint_interval = checkpoint_interval or settings.HISTORY_CHECKPOINT_INTERVAL
+    last = chain_query(history_model).order_by("-pk").first()
+    if last is None:
+        return
+    if is_delta(last.data):
+        base, sequence = last.data["base"], last.data["sequence"]
+    else:
+        base, sequence = last.pk, 0
+    if sequence + 1 >= checkpoint_interval:
+        return
+
+    previous = snapshot_record(last)
+    record = history_model.data.pop("record")
+    history_model.data[DELTA_KEY] = diff_records(previous or {}, record)
+    history_model.data["base"] = base
+    history_model.data["sequence"] = sequence + 1
+
+
+def compact_chain(rows, checkpoint_interval):
+    """
+    Re-encodes the history models of one chain, in pk order, as checkpoints
+    and deltas. A checkpoint_interval of 1 expands every snapshot to a full one.
+    :return: the number of models changed
+    """
+    # the rows are one chain whatever their data says
+    snapshots = list(materialise((row.data for row in rows), key_func=lambda snapshot: None))
+    changed = 0
+    previous = None
+    base = None
+    for position, (row, snapshot) in enumerate(zip(rows, snapshots)):
+        sequence = position % checkpoint_interval
+        data = {k: v for k, v in snapshot.items() if k != "record"}
+        if sequence == 0:
+            data["record"] = snapshot["record"]
+            base = row.pk
+        else:
+            data[DELTA_KEY] = diff_records(previous, snapshot["record"])
+            data["base"] = base
+            data["sequence"] = sequence
+        previous = snapshot["record"]
+        if data != row.data:
+            ClinicalData.objects.filter(pk=row.pk).update(data=data)
+            changed += 1
+    return changed
+
+
+def compact_history(registry_code, checkpoint_interval=None, patient_ids=None):
+    """
+    Re-encodes the history of a registry chain by chain
+    :param patient_ids: only re-encode the history of these patients
+    :return: generator of the number of models changed per chain
+    """
+    checkpoint_interval = checkpoint_interval or settings.HISTORY_CHECKPOINT_INTERVAL
+    history = ClinicalData.objects.collection(registry_code, "history")
+    if patient_ids is not None:
+        history = history.filter(django_model="Patient", django_id__in=patient_ids)
+    chains = history.order_by().values_list("django_model", "django_id", "context_id").distinct()
+    for django_model, django_id, context_id in list(chains):
+        rows = list(history.filter(django_model=django_model, django_id=django_id, context_id=context_id))
+        with transaction.atomic(using=router.db_for_write(ClinicalData)):
+            yield compact_chain(rows, checkpoint_interval)
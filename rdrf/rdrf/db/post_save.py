@@ -0,0 +1,220 @@
+"""
+Deferred work after a form save.
+
+Saving a form writes the cdes record and its history snapshot. The data
+derived from the record - the form progress of the patient's context and the
+reporting field values of the saved form - is brought up to date by post
+save jobs. With settings.POST_SAVE_JOBS = "sync" ( the default ) the jobs run
+straight away. With "queue" they are stored as PostSaveJob rows when the save
+commits and run by the run_post_save_jobs command, so the save only waits for
+its own record. Queued jobs coalesce - saving a form again before its jobs
+have run adds nothing - and the worker runs the jobs of many patients
+together, loading their records with one query.
+A job stays in the table while it runs and is only deleted once it succeeded,
+so the jobs of a worker which dies are claimed again after CLAIM_TIMEOUT.
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from functools import reduce
+import operator
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from rdrf.forms.progress.bulk_progress import BulkProgressCalculator
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.models.definition.models import ClinicalData
+from rdrf.models.definition.post_save_models import PostSaveJob
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# a failing job is queued again until it has been tried this many times
+MAX_ATTEMPTS = 3
+
+# a claimed job not finished by then is taken to belong to a dead worker
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def form_save_jobs(registry_model, patient_id, context_id, form_model):
+    return [PostSaveJob(registry=registry_model, patient_id=patient_id, context_id=context_id,
+                        kind=PostSaveJob.PROGRESS),
+            PostSaveJob(registry=registry_model, patient_id=patient_id, context_id=context_id,
+                        kind=PostSaveJob.FIELD_VALUES, form_name=form_model.name)]
+
+
+def schedule_form_save_jobs(registry_model, patient_model, context_model, form_model):
+    """
+    Brings the progress and field values of a saved form up to date, now or
+    after the save commits depending on settings.POST_SAVE_JOBS
+    """
+    jobs = form_save_jobs(registry_model, patient_model.pk, context_model.pk, form_model)
+    if settings.POST_SAVE_JOBS == "queue":
+        transaction.on_commit(lambda: queue_jobs(jobs))
+    else:
+        # errors reach the form save, as they did before the jobs existed
+        _run_registry_jobs(registry_model, jobs)
+
+
+def queue_jobs(jobs):
+    """
+    :return: the number of jobs queued - a job already waiting isn't queued again
+    """
+    queued = 0
+    for job in jobs:
+        if _queue_job(job):
+            queued += 1
+    return queued
+
+
+def _queue_job(job):
+    while True:
+        try:
+            with transaction.atomic():
+                job.save()
+            return True
+        except IntegrityError:
+            pass
+        # the job is waiting, or running on the record as it was before this
+        # save - then it has to run again when it finishes
+        requeued = PostSaveJob.objects.filter(registry_id=job.registry_id, patient_id=job.patient_id,
+                                              context_id=job.context_id, kind=job.kind,
+                                              form_name=job.form_name).update(requeued=True)
+        if requeued:
+            return False
+        # finished in between - queue it afresh
+
+
+def claim_jobs(batch_size=200):
+    """
+    Claims the oldest waiting jobs. Jobs other workers are claiming are
+    skipped, and claims older than CLAIM_TIMEOUT are taken over. The jobs
+    stay in the table until finish_jobs.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(PostSaveJob.objects.select_for_update(skip_locked=True, of=("self",))
+                                       .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - CLAIM_TIMEOUT))
+                                       .select_related("registry")
+                                       .order_by("pk")[:batch_size])
+        claimed = PostSaveJob.objects.filter(pk__in=[job.pk for job in jobs])
+        claimed.update(claimed_at=now, requeued=False, attempts=F("attempts") + 1)
+    for job in jobs:
+        job.claimed_at = now
+        job.requeued = False
+        job.attempts += 1
+    return jobs
+
+
+def finish_jobs(jobs, failed):
+    """
+    Deletes the claimed jobs which ran and releases the failed ones to be
+    tried again, up to MAX_ATTEMPTS. A job queued again while it ran is
+    released rather than deleted. Jobs claimed since by another worker are left alone.
+    """
+    failed_pks = set(job.pk for job in failed)
+    done = []
+    retries = []
+    for job in jobs:
+        if job.pk not in failed_pks:
+            done.append(job)
+        elif job.attempts >= MAX_ATTEMPTS:
+            logger.error("Post save job failed %s times, dropped: %s" % (MAX_ATTEMPTS, job))
+            done.append(job)
+        else:
+            retries.append(job)
+
+    with transaction.atomic():
+        _claimed(done).filter(requeued=False).delete()
+        _claimed(done).update(claimed_at=None, requeued=False, attempts=0)
+        _claimed(retries).update(claimed_at=None)
+
+
+def _claimed(jobs):
+    # the jobs, unless another worker has claimed them since
+    return PostSaveJob.objects.filter(pk__in=[job.pk for job in jobs],
+                                      claimed_at__in=set(job.claimed_at for job in jobs))
+
+
+def run_jobs(jobs):
+    """
+    Runs jobs a registry at a time
+    :return: the jobs which failed
+    """
+    registry_jobs = OrderedDict()
+    for job in jobs:
+        registry_jobs.setdefault(job.registry_id, []).append(job)
+
+    failed = []
+    for jobs_of_registry in registry_jobs.values():
+        try:
+            _run_registry_jobs(jobs_of_registry[0].registry, jobs_of_registry)
+        except Exception as ex:
+            logger.exception("Error running post save jobs: %s" % ex)
+            failed.extend(jobs_of_registry)
+    return failed
+
+
+def _load_records(registry_model, patient_contexts):
+    # (patient id, context id) -> the cdes record get_dynamic_data would load
+    records = ClinicalData.objects.collection(registry_model.code, "cdes").filter(
+        django_model="Patient",
+        django_id__in=set(patient_id for patient_id, _ in patient_contexts),
+        context_id__in=set(context_id for _, context_id in patient_contexts))
+    loaded = {}
+    for patient_id, context_id, data in records.order_by("pk").values_list("django_id", "context_id", "data"):
+        if (patient_id, context_id) in patient_contexts:
+            loaded.setdefault((patient_id, context_id), data)
+    return loaded
+
+
+def _run_registry_jobs(registry_model, jobs):
+    progress_jobs = OrderedDict()
+    field_value_jobs = OrderedDict()
+    for job in jobs:
+        key = (job.patient_id, job.context_id)
+        if job.kind == PostSaveJob.PROGRESS:
+            progress_jobs[key] = job
+        elif job.kind == PostSaveJob.FIELD_VALUES:
+            field_value_jobs[key + (job.form_name,)] = job
+        else:
+            logger.error("Unknown post save job: %s" % job)
+
+    records = _load_records(registry_model, set(progress_jobs) | set(key[:2] for key in field_value_jobs))
+
+    progress = [(patient_id, context_id, records[(patient_id, context_id)])
+                for patient_id, context_id in progress_jobs if (patient_id, context_id) in records]
+    if progress:
+        BulkProgressCalculator(registry_model).update_records(progress)
+
+    if field_value_jobs:
+        update_field_values(registry_model, field_value_jobs, records)
+
+
+def update_field_values(registry_model, patient_context_forms, records):
+    """
+    Replaces the field values of forms with ones built from their cdes records
+    :param patient_context_forms: (patient id, context id, form name) of the forms
+    :param records: (patient id, context id) -> cdes record
+    """
+    from explorer.models import FieldValue
+    from explorer.utils import FieldValueBuilder
+
+    graph = get_registry_graph(registry_model)
+    builder = FieldValueBuilder(registry_model)
+    replaced = []
+    field_values = []
+    for patient_id, context_id, form_name in patient_context_forms:
+        form_model = graph.form(form_name)
+        if form_model is None or (patient_id, context_id) not in records:
+            continue
+        replaced.append(Q(patient_id=patient_id, context_id=context_id, form=form_model))
+        field_values.extend(builder.build(patient_id, context_id, records[(patient_id, context_id)], form_model))
+
+    if replaced:
+        with transaction.atomic():
+            FieldValue.objects.filter(registry=registry_model).filter(reduce(operator.or_, replaced)).delete()
+            FieldValue.objects.bulk_create(field_values)
@@ -1,5 +1,6 @@
 import logging
 from django.conf import settings
+from rdrf.forms.fields.calculation_engine import CALCULATIONS, calculation_inputs
 from registry.patients.models import Patient
 from rest_framework.reverse import reverse
 
@@ -35,18 +36,14 @@ class CalculatedFieldScriptCreator(object):
         observer_code = self.cde.code
         logger.debug("generating script for %s" % observer_code)
 
-        mod = __import__('rdrf.forms.fields.calculated_functions', fromlist=['object'])
-        func = getattr(mod, f"{self.cde.code}_inputs")
-        # required_cde_inputs = {}
-        if func:
-            cde_inputs = func()
-        else:
+        if self.cde.code not in CALCULATIONS:
             raise Exception(f"Trying to call an unknown calculated cde inputs function {self.cde.code}_inputs()")
+        cde_inputs = calculation_inputs(self.cde.code)
 
         patient_model = Patient.objects.get(id=self.injected_model_id)
         registry_model = self.registry
         patient_date_of_birth = patient_model.date_of_birth.__format__("%Y-%m-%d")
-        wsurl = reverse("v1:calculatedcde-list")
+        wsurl = reverse("v1:calculatedcdebatch-list")
         javascript = """
             <script>
             $(document).ready(function(){
@@ -3,10 +3,15 @@ from collections import OrderedDict
 from rdrf.forms.dynamic.field_lookup import FieldFactory
 from django.conf import settings
 import logging
-from rdrf.models.definition.models import CdePolicy
 
 logger = logging.getLogger(__name__)
 
+# Section form fields are built once per definition version:
+# (registry code, form id, section code, questionnaire context, is superuser,
+#  codes of the cdes the policies allow) -> SectionFormFields
+_section_form_fields = {}
+_section_form_fields_version = None
+
 
 def create_form_class(owner_class_name):
     from rdrf.models.definition.models import CommonDataElement
@@ -34,11 +39,82 @@ def create_form_class(owner_class_name):
     return form_class
 
 
-def get_cde_policy(registry, cde):
-    try:
-        return CdePolicy.objects.get(registry=registry, cde=cde)
-    except CdePolicy.DoesNotExist:
-        return None
+class SectionFormFields(object):
+    """
+    The fields of a section form. Fields of calculated cdes and parametrised
+    widgets refer to the patient so are built for each form class - the rest
+    are shared ( forms deep copy their base fields. )
+    """
+
+    def __init__(self, fields):
+        # (field code on form, cde model, field or None if patient bound)
+        self.fields = fields
+        self.patient_bound = any(field is None for _, _, field in fields)
+        self.form_class = None if self.patient_bound else make_section_form_class(
+            OrderedDict((code, field) for code, _, field in fields))
+
+
+def make_section_form_class(base_fields):
+    form_class_dict = {"base_fields": base_fields, "auto_id": True}
+    return type("SectionForm", (BaseForm,), form_class_dict)
+
+
+def is_patient_bound(cde):
+    return bool(cde.calculation) or ":" in (cde.widget_name or "")
+
+
+def cde_allowed(registry_graph, cde, user_groups, patient_model, is_superuser):
+    cde_policy = registry_graph.cde_policy(cde.code)
+    if cde_policy and user_groups:
+        return cde_policy.is_allowed(user_groups, patient_model, is_superuser=is_superuser)
+    return True
+
+
+def get_section_form_fields(registry_graph, registry_form, section, cde_models, questionnaire_context,
+                            is_superuser):
+    global _section_form_fields_version
+    if _section_form_fields_version != registry_graph.version:
+        _section_form_fields.clear()
+        _section_form_fields_version = registry_graph.version
+
+    key = (registry_graph.registry_model.code, registry_form.pk, section.code, questionnaire_context,
+           bool(is_superuser), tuple(cde.code for cde in cde_models))
+    section_form_fields = _section_form_fields.get(key)
+    if section_form_fields is None:
+        fields = []
+        for cde in cde_models:
+            field = None
+            if not is_patient_bound(cde):
+                field = create_section_field(registry_graph.registry_model, registry_form, section, cde,
+                                             questionnaire_context, is_superuser=is_superuser)
+            fields.append((section_field_code(registry_form, section, cde), cde, field))
+        section_form_fields = SectionFormFields(fields)
+        _section_form_fields[key] = section_form_fields
+    return section_form_fields
+
+
+def section_field_code(registry_form, section, cde):
+    return "%s%s%s%s%s" % (registry_form.name,
+                           settings.FORM_SECTION_DELIMITER,
+                           section.code,
+                           settings.FORM_SECTION_DELIMITER,
+                           cde.code)
+
+
+def create_section_field(registry, registry_form, section, cde, questionnaire_context,
+                         injected_model=None, injected_model_id=None, is_superuser=None):
+    cde_field = FieldFactory(
+        registry,
+        registry_form,
+        section,
+        cde,
+        questionnaire_context,
+        injected_model=injected_model,
+        injected_model_id=injected_model_id,
+        is_superuser=is_superuser).create_field()
+
+    cde_field.important = cde.important
+    return cde_field
 
 
 def create_form_class_for_section(
@@ -50,39 +126,33 @@ def create_form_class_for_section(
         injected_model_id=None,
         is_superuser=None,
         user_groups=None,
-        patient_model=None):
+        patient_model=None,
+        registry_graph=None):
 
-    base_fields = OrderedDict()
-    for cde in section.cde_models:
-        cde_policy = get_cde_policy(registry, cde)
-        if cde_policy and user_groups:
-            if not cde_policy.is_allowed(user_groups.all(),
-                                         patient_model,
-                                         is_superuser=is_superuser):
-                continue
-
-        cde_field = FieldFactory(
-            registry,
-            registry_form,
-            section,
-            cde,
-            questionnaire_context,
-            injected_model=injected_model,
-            injected_model_id=injected_model_id,
-            is_superuser=is_superuser).create_field()
-
-        cde_field.important = cde.important
-
-        field_code_on_form = "%s%s%s%s%s" % (registry_form.name,
-                                             settings.FORM_SECTION_DELIMITER,
-                                             section.code,
-                                             settings.FORM_SECTION_DELIMITER,
-                                             cde.code)
-        base_fields[field_code_on_form] = cde_field
+    if registry_graph is None:
+        from rdrf.helpers.registry_graph import get_registry_graph
+        registry_graph = get_registry_graph(registry)
 
-    form_class_dict = {"base_fields": base_fields, "auto_id": True}
+    if user_groups is not None:
+        user_groups = list(user_groups)
+    cde_models = [cde for cde in registry_graph.cde_models(section)
+                  if cde_allowed(registry_graph, cde, user_groups, patient_model, is_superuser)]
 
-    return type("SectionForm", (BaseForm,), form_class_dict)
+    section_form_fields = get_section_form_fields(registry_graph, registry_form, section, cde_models,
+                                                  questionnaire_context, is_superuser)
+    if section_form_fields.form_class is not None:
+        return section_form_fields.form_class
+
+    # bind the fields which refer to the patient
+    base_fields = OrderedDict()
+    for field_code_on_form, cde, field in section_form_fields.fields:
+        if field is None:
+            field = create_section_field(registry, registry_form, section, cde, questionnaire_context,
+                                         injected_model=injected_model,
+                                         injected_model_id=injected_model_id,
+                                         is_superuser=is_superuser)
+        base_fields[field_code_on_form] = field
+    return make_section_form_class(base_fields)
 
 
 def create_form_class_for_consent_section(
@@ -11,9 +11,11 @@ from rdrf.forms.widgets import widgets
 import logging
 from rdrf.forms.dynamic.calculated_fields import CalculatedFieldScriptCreator, CalculatedFieldScriptCreatorError
 from rdrf.forms.dynamic.validation import ValidatorFactory
+from rdrf.helpers.permitted_values import get_permitted_values
 from rdrf.models.definition.models import CommonDataElement
 
 from django.utils.functional import lazy
+from django.utils.text import format_lazy
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
@@ -132,7 +134,8 @@ class FieldFactory(object):
         if not settings.DESIGN_MODE:
             return name
         cde_url = reverse('admin:rdrf_commondataelement_change', args=[self.cde.code])
-        label_link = mark_safe_lazy("<a target='_blank' href='%s'>%s</a>" % (cde_url, name))
+        # stays lazy - section fields are cached and shared between languages
+        label_link = mark_safe_lazy(format_lazy("<a target='_blank' href='{}'>{}</a>", cde_url, name))
         return label_link
 
     def _get_code(self):
@@ -160,12 +163,15 @@ class FieldFactory(object):
         return self.cde.is_required
 
     def _is_dropdown(self):
-        return self.cde.pv_group is not None
+        return self.cde.pv_group_id is not None
+
+    def _get_permitted_values(self):
+        return get_permitted_values(self.cde.pv_group_id)
 
     def _has_other_please_specify(self):
         # todo improve other please specify check
-        if self.cde.pv_group:
-            for permitted_value in self.cde.pv_group.permitted_value_set.all():
+        if self.cde.pv_group_id:
+            for permitted_value in self._get_permitted_values().values:
                 if permitted_value.value and permitted_value.value.lower().find("specify") > -1:
                     return True
         return False
@@ -222,9 +228,8 @@ class FieldFactory(object):
 
     def _get_permitted_value_choices(self):
         choices = [(self.UNSET_CHOICE, "---")]
-        if self.cde.pv_group:
-            for permitted_value in self.cde.pv_group.permitted_value_set.all().order_by(
-                    'position'):
+        if self.cde.pv_group_id:
+            for permitted_value in self._get_permitted_values().values:
                 value = _(permitted_value.value)
                 if self.context == FieldContext.QUESTIONNAIRE:
                     q_value = getattr(permitted_value, 'questionnaire_value')
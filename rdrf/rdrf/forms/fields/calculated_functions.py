@@ -61,8 +61,7 @@ class AcrossFormsInfo:
 
 
 def fill_missing_input(context, input_func_name, across_forms_info=None):
-    mod = __import__('rdrf.forms.fields.calculated_functions', fromlist=['object'])
-    func = getattr(mod, input_func_name)
+    func = globals()[input_func_name]
     if across_forms_info is not None:
         # the input cdes are on another form
         for cde_code in func():
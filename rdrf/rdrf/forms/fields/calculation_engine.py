@@ -0,0 +1,338 @@
+"""
+Recalculates the calculated cdes of many patients at once.
+
+A calculated cde can be an input of another one ( see the *_inputs functions
+in calculated_functions ). The engine orders the calculated cdes of each form
+so that a cde is calculated after the calculated cdes it depends on, which
+means one pass over a record gives the values update_calculated_fields used
+to reach by re-running itself.
+The cdes collection of a registry is read in pk ordered chunks and each chunk
+is written back with one UPDATE, one bulk INSERT of history snapshots, a
+bulk progress update and the field values of the changed forms. Chunks don't overlap so they can be handed to a process pool.
+"""
+from collections import OrderedDict
+from multiprocessing import Pool
+import datetime
+import json
+import logging
+
+from django.db import connections, router, transaction
+
+from rdrf.db.post_save import update_field_values
+from rdrf.forms.fields import calculated_functions
+from rdrf.forms.progress.bulk_progress import BulkProgressCalculator
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.models.definition.models import ClinicalData, Registry
+from registry.patients.models import Patient
+
+logger = logging.getLogger(__name__)
+
+# username recorded in the history snapshots of recalculated records
+CALCULATION_USER = "Calculated field script"
+
+UPDATE_DATA_SQL = """
+UPDATE {table} AS cd SET data = v.data, last_updated = now()
+FROM (VALUES {values}) AS v(id, data)
+WHERE cd.id = v.id
+"""
+
+VALUES_TEMPLATE = "(%s, %s::jsonb)"
+
+
+class CalculationCycleError(Exception):
+    pass
+
+
+class UnknownCalculationError(Exception):
+    pass
+
+
+def _compile_calculations():
+    # cde code -> (function, input cde codes) for every function of
+    # calculated_functions that has a matching *_inputs function
+    calculations = {}
+    for name, func in vars(calculated_functions).items():
+        inputs_func = getattr(calculated_functions, name + "_inputs", None)
+        if callable(func) and callable(inputs_func):
+            calculations[name] = (func, tuple(inputs_func()))
+    return calculations
+
+
+CALCULATIONS = _compile_calculations()
+
+
+def calculation_function(cde_code):
+    try:
+        return CALCULATIONS[cde_code][0]
+    except KeyError:
+        raise UnknownCalculationError("Unknown calculated cde %s" % cde_code)
+
+
+def calculation_inputs(cde_code):
+    """
+    :return: the cde codes the calculation of cde_code reads
+    """
+    return list(CALCULATIONS[cde_code][1]) if cde_code in CALCULATIONS else []
+
+
+def calculation_order(cde_codes):
+    """
+    Orders calculated cde codes so that each comes after the calculated cdes
+    among them that it depends on. Otherwise the given order is kept.
+    """
+    cde_codes = list(OrderedDict.fromkeys(cde_codes))
+    dependencies = OrderedDict((code, set(calculation_inputs(code)) & set(cde_codes) - {code})
+                               for code in cde_codes)
+    ordered = []
+    while dependencies:
+        ready = [code for code, inputs in dependencies.items() if not inputs]
+        if not ready:
+            raise CalculationCycleError("Calculated cdes depend on each other: %s" % ", ".join(dependencies))
+        for code in ready:
+            ordered.append(code)
+            del dependencies[code]
+        for inputs in dependencies.values():
+            inputs.difference_update(ready)
+    return ordered
+
+
+def evaluate_calculations(cde_codes, patient_values, form_values):
+    """
+    Evaluates several calculated cdes of a form in dependency order, each
+    calculation seeing the values calculated before it
+    :return: (OrderedDict of cde code -> value, dict of cde code -> error message)
+    """
+    form_values = dict(form_values)
+    values = OrderedDict()
+    errors = {}
+    for cde_code in calculation_order(cde_codes):
+        try:
+            value = calculation_function(cde_code)(patient_values, dict(form_values))
+        except Exception as ex:
+            logger.error("Error calculating %s: %s" % (cde_code, ex))
+            errors[cde_code] = str(ex)
+            continue
+        values[cde_code] = value
+        form_values[cde_code] = value
+    return values, errors
+
+
+class CalculationEngine(object):
+
+    def __init__(self, registry_model, cde_codes=None, form_names=None, section_codes=None,
+                 patient_ids=None, context_ids=None, chunk_size=200):
+        self.registry_model = registry_model
+        self.patient_ids = patient_ids
+        self.context_ids = context_ids
+        self.chunk_size = chunk_size
+        self.progress_calculator = BulkProgressCalculator(registry_model, chunk_size)
+        # form name -> [(section model, cde model, function)] in calculation order
+        self.calculations = OrderedDict()
+
+        graph = get_registry_graph(registry_model)
+        for form_model in graph.forms:
+            if form_names and form_model.name not in form_names:
+                continue
+            locations = OrderedDict()
+            for section_model in graph.section_models(form_model):
+                if section_model.allow_multiple:
+                    # calculations only read the values of single sections
+                    continue
+                if section_codes and section_model.code not in section_codes:
+                    continue
+                for cde_model in graph.cde_models(section_model):
+                    if cde_codes and cde_model.code not in cde_codes:
+                        continue
+                    if not cde_codes and cde_model.datatype.strip().lower() != "calculated":
+                        continue
+                    if cde_model.code not in CALCULATIONS:
+                        logger.warning("No calculation for calculated cde %s" % cde_model.code)
+                        continue
+                    locations.setdefault(cde_model.code,
+                                         (section_model, cde_model, calculation_function(cde_model.code)))
+            if locations:
+                self.calculations[form_model.name] = [locations[code] for code in calculation_order(locations)]
+
+    def _cdes_records(self):
+        records = ClinicalData.objects.collection(self.registry_model.code, "cdes").filter(django_model="Patient")
+        if self.patient_ids:
+            records = records.filter(django_id__in=self.patient_ids)
+        if self.context_ids:
+            records = records.filter(context_id__in=self.context_ids)
+        return records
+
+    def chunks(self):
+        """
+        :return: (first pk, last pk) of each chunk of cdes records
+        """
+        if not self.calculations:
+            return []
+        pks = list(self._cdes_records().values_list("pk", flat=True))
+        return [(pks[i], pks[min(i + self.chunk_size, len(pks)) - 1])
+                for i in range(0, len(pks), self.chunk_size)]
+
+    def calculate(self, patient_model, data):
+        """
+        Recalculates the calculated cdes of a nested cdes record in place
+        :return: the names of the forms whose values changed
+        """
+        patient_values = {"date_of_birth": patient_model.date_of_birth,
+                          "sex": patient_model.sex,
+                          "patient_id": patient_model.pk,
+                          "registry_code": self.registry_model.code}
+        now = datetime.datetime.now().isoformat()
+        changed_forms = []
+        form_dicts = {form_dict.get("name"): form_dict for form_dict in data.get("forms", [])}
+        for form_name, calculations in self.calculations.items():
+            form_dict = form_dicts.get(form_name)
+            if form_dict is None:
+                # form never saved for this context
+                continue
+            form_values = {cde_dict["code"]: cde_dict["value"]
+                           for section_dict in form_dict.get("sections", [])
+                           for cde_dict in section_dict.get("cdes", []) if not isinstance(cde_dict, list)}
+            changed = False
+            for section_model, cde_model, func in calculations:
+                if cde_model.code in form_values:
+                    # the form sends unfilled values as empty strings
+                    old_value = form_values[cde_model.code]
+                    old_value = "" if old_value is None else old_value
+                else:
+                    old_value = None
+                try:
+                    new_value = func(patient_values, dict(form_values))
+                except Exception as ex:
+                    logger.error("Error calculating %s for patient %s: %s" % (cde_model.code, patient_model.pk, ex))
+                    continue
+                if new_value != old_value:
+                    self._set_value(form_dict, section_model, cde_model.code, new_value)
+                    # later calculations in the pass see the new value
+                    form_values[cde_model.code] = new_value
+                    changed = True
+            if changed:
+                data["%s_timestamp" % form_name] = now
+                changed_forms.append(form_name)
+        if changed_forms:
+            data["timestamp"] = now
+        return changed_forms
+
+    def _set_value(self, form_dict, section_model, cde_code, value):
+        for section_dict in form_dict["sections"]:
+            if section_dict["code"] == section_model.code:
+                break
+        else:
+            section_dict = {"code": section_model.code, "cdes": [], "allow_multiple": False}
+            form_dict["sections"].append(section_dict)
+        for cde_dict in section_dict["cdes"]:
+            if cde_dict["code"] == cde_code:
+                cde_dict["value"] = value
+                return
+        section_dict["cdes"].append({"code": cde_code, "value": value})
+
+    def update_chunk(self, first_pk, last_pk):
+        """
+        Recalculates and saves the cdes records with pks in [first_pk, last_pk]
+        :return: the number of records changed
+        """
+        records = list(self._cdes_records()
+                           .filter(pk__gte=first_pk, pk__lte=last_pk)
+                           .values_list("pk", "django_id", "context_id", "data"))
+        patients = (Patient.objects.filter(pk__in=set(record[1] for record in records),
+                                           rdrf_registry=self.registry_model)
+                                   .only("id", "date_of_birth", "sex")
+                                   .in_bulk())
+
+        changed = []
+        for pk, patient_id, context_id, data in records:
+            patient_model = patients.get(patient_id)
+            if patient_model is None or not data:
+                continue
+            changed_forms = self.calculate(patient_model, data)
+            if changed_forms:
+                changed.append((pk, patients[patient_id], context_id, data, changed_forms))
+
+        if changed:
+            self._save(changed)
+        return len(changed)
+
+    def _save(self, changed):
+        values = []
+        params = []
+        for pk, _, _, data, _ in changed:
+            values.append(VALUES_TEMPLATE)
+            params.extend([pk, json.dumps(data)])
+        sql = UPDATE_DATA_SQL.format(table=ClinicalData._meta.db_table, values=", ".join(values))
+
+        # one snapshot per changed form, as a form save makes
+        timestamp = str(datetime.datetime.now())
+        snapshots = []
+        for _, patient_model, context_id, data, changed_forms in changed:
+            for form_name in changed_forms:
+                snapshot = {"context_id": context_id,
+                            "django_id": patient_model.pk,
+                            "django_model": "Patient",
+                            "registry_code": self.registry_model.code,
+                            "record_type": "snapshot",
+                            "username": CALCULATION_USER,
+                            "timestamp": timestamp,
+                            "form_user": CALCULATION_USER,
+                            "form_name": form_name,
+                            "record": data}
+                snapshots.append(ClinicalData.create(patient_model,
+                                                     registry_code=self.registry_model.code,
+                                                     collection="history",
+                                                     context_id=context_id,
+                                                     data=snapshot))
+
+        db = router.db_for_write(ClinicalData)
+        with transaction.atomic(using=db):
+            with connections[db].cursor() as cursor:
+                cursor.execute(sql, params)
+            ClinicalData.objects.bulk_create(snapshots, batch_size=self.chunk_size)
+            self.progress_calculator.update_records([(patient_model.pk, context_id, data)
+                                                     for _, patient_model, context_id, data, _ in changed])
+
+        # the reporting field values of the forms, as a form save refreshes them
+        update_field_values(self.registry_model,
+                            [(patient_model.pk, context_id, form_name)
+                             for _, patient_model, context_id, _, changed_forms in changed
+                             for form_name in changed_forms],
+                            {(patient_model.pk, context_id): data for _, patient_model, context_id, data, _ in changed})
+
+
+_worker_engine = None
+
+
+def _update_chunk(args):
+    # runs in a pool process - each process builds its own engine once
+    global _worker_engine
+    registry_code, engine_options, first_pk, last_pk = args
+    if _worker_engine is None or _worker_engine.registry_model.code != registry_code:
+        _worker_engine = CalculationEngine(Registry.objects.get(code=registry_code), **engine_options)
+    return _worker_engine.update_chunk(first_pk, last_pk)
+
+
+def update_registry_calculations(registry_model, processes=1, **engine_options):
+    """
+    Recalculates the calculated cdes of every patient ( and context ) of a registry.
+    Yields the number of records changed as each chunk completes.
+    """
+    engine = CalculationEngine(registry_model, **engine_options)
+    chunks = engine.chunks()
+    logger.info("Recalculating registry %s in %s chunks" % (registry_model.code, len(chunks)))
+
+    if processes <= 1:
+        for first_pk, last_pk in chunks:
+            yield engine.update_chunk(first_pk, last_pk)
+        return
+
+    # forked workers must not share the parent's database connection
+    connections.close_all()
+    pool = Pool(processes, initializer=connections.close_all)
+    try:
+        work = [(registry_model.code, engine_options, first_pk, last_pk) for first_pk, last_pk in chunks]
+        for num_records in pool.imap_unordered(_update_chunk, work):
+            yield num_records
+    finally:
+        pool.close()
+        pool.join()
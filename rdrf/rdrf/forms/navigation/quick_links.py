@@ -48,6 +48,7 @@ class Links:
         Registries = QuickLink(reverse("admin:rdrf_registry_changelist"), _("Registries"))
 
         Importer = QuickLink(reverse("import_registry"), _("Importer"))
+        Performance = QuickLink(reverse("performance"), _("Performance"))
         Groups = QuickLink(reverse("admin:auth_group_changelist"), _("Groups"))
         NextOfKinRelationship = QuickLink(
             reverse("admin:patients_nextofkinrelationship_changelist"),
@@ -187,6 +188,8 @@ class Links:
                 Verifications.text: Verifications,
                 Custom_Actions.text: Custom_Actions,
             }
+        if settings.PROFILING_ENABLED:
+            OTHER[Performance.text] = Performance
         EXPLORER = {
             Explorer.text: Explorer,
         }
@@ -0,0 +1,155 @@
+"""
+Recalculates form progress for many patients at once.
+
+FormProgress.save_for_patient loads and saves one patient at a time.
+BulkProgressCalculator reads the cdes collection of a registry in pk ordered
+chunks, calculates the progress of every (patient, context) record in the chunk
+and writes the progress collection with one UPDATE and one bulk INSERT per chunk
+( plus the PatientFormProgress rows used by the patient listing ).
+Chunks don't overlap so they can be handed to a process pool.
+"""
+from collections import OrderedDict
+from multiprocessing import Pool
+import json
+import logging
+
+from django.db import connections, router, transaction
+
+from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.models.definition.models import ClinicalData, Registry
+from rdrf.models.definition.progress_models import save_patient_form_progress
+from registry.patients.models import Patient
+
+logger = logging.getLogger(__name__)
+
+# merges the new progress into existing progress records, returning the keys it updated
+UPDATE_PROGRESS_SQL = """
+UPDATE {table} AS cd SET data = cd.data || v.data, last_updated = now()
+FROM (VALUES {values}) AS v(registry_code, django_id, context_id, data)
+WHERE cd.collection = 'progress' AND cd.django_model = 'Patient'
+AND cd.registry_code = v.registry_code AND cd.django_id = v.django_id
+AND cd.context_id IS NOT DISTINCT FROM v.context_id
+RETURNING cd.django_id, cd.context_id
+"""
+
+VALUES_TEMPLATE = "(%s, %s, %s::integer, %s::jsonb)"
+
+
+class BulkProgressCalculator(object):
+
+    def __init__(self, registry_model, chunk_size=500):
+        self.registry_model = registry_model
+        self.chunk_size = chunk_size
+        self.form_progress = FormProgress(registry_model)
+
+    def _cdes_records(self):
+        return ClinicalData.objects.collection(self.registry_model.code, "cdes").filter(django_model="Patient")
+
+    def chunks(self):
+        """
+        :return: (first pk, last pk) of each chunk of cdes records
+        """
+        pks = list(self._cdes_records().values_list("pk", flat=True))
+        return [(pks[i], pks[min(i + self.chunk_size, len(pks)) - 1])
+                for i in range(0, len(pks), self.chunk_size)]
+
+    def update_chunk(self, first_pk, last_pk):
+        """
+        Recalculates and saves the progress of the cdes records with pks in [first_pk, last_pk]
+        :return: the number of progress records written
+        """
+        records = list(self._cdes_records()
+                           .filter(pk__gte=first_pk, pk__lte=last_pk)
+                           .values_list("django_id", "context_id", "data"))
+        return self.update_records(records)
+
+    def update_records(self, records):
+        """
+        Recalculates and saves the progress of cdes records already loaded
+        :param records: (patient id, context id, data) of each record
+        :return: the number of progress records written
+        """
+        patient_ids = set(patient_id for patient_id, _, _ in records)
+        patients = (Patient.objects.filter(pk__in=patient_ids, rdrf_registry=self.registry_model)
+                                   .only("id", "patient_type")
+                                   .in_bulk())
+
+        progress = OrderedDict()
+        for patient_id, context_id, dynamic_data in records:
+            patient_model = patients.get(patient_id)
+            if patient_model is None or not dynamic_data:
+                continue
+            progress[(patient_id, context_id)] = self.form_progress.calculate_progress(patient_model,
+                                                                                       dynamic_data)
+
+        if progress:
+            self._save(progress, patients)
+        return len(progress)
+
+    def _save(self, progress, patients):
+        values = []
+        params = []
+        for (patient_id, context_id), progress_data in progress.items():
+            values.append(VALUES_TEMPLATE)
+            params.extend([self.registry_model.code, patient_id, context_id, json.dumps(progress_data)])
+        sql = UPDATE_PROGRESS_SQL.format(table=ClinicalData._meta.db_table, values=", ".join(values))
+
+        # ClinicalData may live in the clinical database
+        db = router.db_for_write(ClinicalData)
+        with transaction.atomic(using=db):
+            with connections[db].cursor() as cursor:
+                cursor.execute(sql, params)
+                updated = set(cursor.fetchall())
+
+            new_records = []
+            for (patient_id, context_id), progress_data in progress.items():
+                if (patient_id, context_id) in updated:
+                    continue
+                # same as FormProgress.save_progress for a patient without progress
+                record = ClinicalData.create(patients[patient_id],
+                                             collection="progress",
+                                             registry_code=self.registry_model.code,
+                                             context_id=context_id,
+                                             data=dict(context_id=context_id))
+                record.data.update(progress_data)
+                new_records.append(record)
+            ClinicalData.objects.bulk_create(new_records, batch_size=self.chunk_size)
+            save_patient_form_progress(self.registry_model, progress)
+
+
+_worker_calculator = None
+
+
+def _update_chunk(args):
+    # runs in a pool process - each process builds its own calculator once
+    global _worker_calculator
+    registry_code, chunk_size, first_pk, last_pk = args
+    if _worker_calculator is None or _worker_calculator.registry_model.code != registry_code:
+        _worker_calculator = BulkProgressCalculator(Registry.objects.get(code=registry_code), chunk_size)
+    return _worker_calculator.update_chunk(first_pk, last_pk)
+
+
+def update_registry_progress(registry_model, chunk_size=500, processes=1):
+    """
+    Recalculates the progress of every patient ( and context ) of a registry.
+    Yields the number of progress records written as each chunk completes.
+    """
+    calculator = BulkProgressCalculator(registry_model, chunk_size)
+    chunks = calculator.chunks()
+    logger.info("Recalculating progress for registry %s in %s chunks" % (registry_model.code, len(chunks)))
+
+    if processes <= 1:
+        for first_pk, last_pk in chunks:
+            yield calculator.update_chunk(first_pk, last_pk)
+        return
+
+    # forked workers must not share the parent's database connection
+    connections.close_all()
+    pool = Pool(processes, initializer=connections.close_all)
+    try:
+        work = [(registry_model.code, chunk_size, first_pk, last_pk) for first_pk, last_pk in chunks]
+        for num_records in pool.imap_unordered(_update_chunk, work):
+            yield num_records
+    finally:
+        pool.close()
+        pool.join()
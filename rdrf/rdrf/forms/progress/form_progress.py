@@ -1,6 +1,7 @@
 from django.urls import reverse
 from django.templatetags.static import static
 from rdrf.helpers.utils import de_camelcase, parse_iso_datetime
+from rdrf.helpers.registry_graph import get_registry_graph
 from rdrf.models.definition.models import ClinicalData
 
 import math
@@ -47,6 +48,7 @@ class FormProgress(object):
 
     def __init__(self, registry_model):
         self.registry_model = registry_model
+        self.registry_graph = get_registry_graph(registry_model)
         self.progress_data = {}
         self.progress_collection = self._get_progress_collection()
         self.progress_cdes_map = self._build_progress_map()
@@ -84,10 +86,9 @@ class FormProgress(object):
     def _build_progress_map(self):
         # maps form names to sets of required cde codes
         result = {}
-        for form_model in self.registry_model.forms:
+        for form_model in self.registry_graph.forms:
             if not form_model.is_questionnaire:
-                result[form_model.name] = set([cde_model.code for cde_model in
-                                               form_model.complete_form_cdes.all()])
+                result[form_model.name] = set(self.registry_graph.completion_cde_codes(form_model))
         return result
 
     def _calculate_form_progress(self, form_model, dynamic_data):
@@ -192,14 +193,10 @@ class FormProgress(object):
                                         return cde_dict["value"]
 
     def _get_progress_cdes(self, form_model_required):
-        cdes_required = self.progress_cdes_map[form_model_required.name]
-        for form_model in self.registry_model.forms:
-            if not form_model.is_questionnaire:
-                if form_model.name == form_model_required.name:
-                    for section_model in form_model.section_models:
-                        for cde_model in section_model.cde_models:
-                            if cde_model.code in cdes_required:
-                                yield section_model, cde_model
+        form_model = self.registry_graph.form(form_model_required.name)
+        if form_model is None or form_model.is_questionnaire:
+            return []
+        return self.registry_graph.progress_cdes(form_model)
 
     def _get_progress_metadata(self):
         pm = {}
@@ -211,7 +208,7 @@ class FormProgress(object):
             else:
                 # default behaviour - this is the old behaviour
                 groups_dict = {"diagnosis": [], "genetic": []}
-                for form_model in self.registry_model.forms:
+                for form_model in self.registry_graph.forms:
                     if "genetic" in form_model.name.lower():
                         groups_dict["genetic"].append(form_model.name)
                     else:
@@ -305,12 +302,10 @@ class FormProgress(object):
         if not progress_metadata:
             return
 
-        self._build_progress_map()
-
         groups_progress = {}
         forms_progress = {}
 
-        for form_model in self.registry_model.forms:
+        for form_model in self.registry_graph.forms:
             if not form_model.is_questionnaire and self._applicable(form_model):
                 form_progress_dict = self._calculate_form_progress(form_model, dynamic_data)
                 form_currency = self._calculate_form_currency(form_model, dynamic_data)
@@ -479,6 +474,12 @@ class FormProgress(object):
 
     #########################################################################################
     # save progress
+    def calculate_progress(self, patient_model, dynamic_data):
+        # the progress data for a cdes record without loading or saving anything
+        self.progress_data = {}
+        self._calculate(dynamic_data, patient_model)
+        return self.progress_data
+
     def save_progress(self, patient_model, dynamic_data, context_model=None):
         if not dynamic_data:
             return self.progress_data
@@ -493,6 +494,9 @@ class FormProgress(object):
                                          data=ctx)
         record.data.update(self.progress_data)
         record.save()
+        from rdrf.models.definition.progress_models import save_patient_form_progress
+        context_id = context_model.id if context_model else None
+        save_patient_form_progress(self.registry_model, {(patient_model.pk, context_id): self.progress_data})
         return self.progress_data
 
     # a convenience method
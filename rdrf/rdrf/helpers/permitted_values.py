@@ -0,0 +1,123 @@
+"""
+A process wide cache of permitted value groups.
+
+The same groups ( yes / no, units ... ) are shared by many cdes, and building
+their dropdown fields or the display values of a report queried
+CDEPermittedValue for every cde. get_permitted_values() loads a group once
+and keeps it until the definition version changes ( see DefinitionVersion ):
+the version is checked once per request, or at most every
+VERSION_CHECK_SECONDS outside a request. RegistryGraph.permitted_values reads
+from here too and invalidate_registry_graphs drops the cache straight away when
+a group or value is saved in this process.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from rdrf.helpers.request_cache import get_request_cache
+from rdrf.models.definition.models import CDEPermittedValue, DefinitionVersion
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+VERSION_CHECK_SECONDS = 5
+
+_lock = threading.Lock()
+# pv group code -> PermittedValues
+_groups = {}
+_version = None
+_checked_at = 0.0
+
+
+class PermittedValues(object):
+    """
+    The values of a permitted value group, ordered by position. Read only -
+    shared by every request in the process.
+    """
+
+    def __init__(self, code, values):
+        self.code = code
+        self.values = tuple(values)
+        self.display_values = {pv.code: pv.value for pv in self.values}
+
+    def members(self, get_code=True):
+        att = "code" if get_code else "value"
+        return [getattr(pv, att) for pv in self.values]
+
+    def choices(self, questionnaire=False):
+        """
+        :return: (code, text) pairs - the questionnaire value is used on questionnaires if set
+        """
+        return [(pv.code, pv.questionnaire_value if questionnaire and pv.questionnaire_value else pv.value)
+                for pv in self.values]
+
+    def display_value(self, code, default=None):
+        try:
+            return self.display_values.get(code, default)
+        except TypeError:
+            # unhashable - a list of codes isn't a code
+            return default
+
+    @property
+    def options(self):
+        return [{"code": pv.code, "text": pv.value} for pv in self.values]
+
+    def as_dict(self):
+        return {"code": self.code,
+                "values": [{"code": pv.code,
+                            "value": pv.value,
+                            "questionnaire_value": pv.questionnaire_value,
+                            "desc": pv.desc,
+                            "position": pv.position} for pv in self.values]}
+
+
+def _check_version():
+    global _version, _checked_at
+    in_request = get_request_cache() is not None
+    now = time.monotonic()
+    if not in_request and now - _checked_at < VERSION_CHECK_SECONDS:
+        return
+    version = DefinitionVersion.current()
+    with _lock:
+        _checked_at = now
+        if version != _version:
+            _groups.clear()
+            _version = version
+
+
+def get_permitted_values(pv_group_code):
+    """
+    :param pv_group_code: code of a CDEPermittedValueGroup ( cde.pv_group_id )
+    :return: PermittedValues of the group - empty if the group doesn't exist
+    """
+    _check_version()
+    group = _groups.get(pv_group_code)
+    if group is None:
+        group = _load([pv_group_code])[pv_group_code]
+    return group
+
+
+def preload_permitted_values(pv_group_codes):
+    """
+    Loads the groups which aren't cached yet with one query
+    """
+    _check_version()
+    missing = [code for code in pv_group_codes if code not in _groups]
+    if missing:
+        _load(missing)
+
+
+def _load(pv_group_codes):
+    values = OrderedDict((code, []) for code in pv_group_codes)
+    for pv in CDEPermittedValue.objects.filter(pv_group_id__in=pv_group_codes).order_by("position", "pk"):
+        values[pv.pv_group_id].append(pv)
+    groups = {code: PermittedValues(code, group_values) for code, group_values in values.items()}
+    with _lock:
+        _groups.update(groups)
+    return groups
+
+
+def invalidate_permitted_values():
+    with _lock:
+        _groups.clear()
@@ -0,0 +1,217 @@
+"""
+Request profiling.
+
+ProfilingMiddleware ( registry.common.middleware, switched on by
+settings.PROFILING_ENABLED ) profiles each request: the queries run on every
+database and their time, queries repeated within the request, template render
+time and the time spent in functions decorated with rdrf.helpers.utils.timed.
+The profiles are aggregated per url name in memory - each server process keeps
+its own figures - and shown by the performance page ( PerformanceView ) and
+its json endpoint.
+"""
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+import threading
+import time
+
+from django.db import connections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# statements kept per url name, by how often they repeat within a request
+MAX_REPEATED_QUERIES = 10
+
+_local = threading.local()
+_lock = threading.Lock()
+# url name -> UrlStats
+_stats = {}
+_templates_instrumented = False
+
+
+class RequestProfile(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = None
+        # (database alias, sql, params, seconds)
+        self.queries = []
+        self.template_time = 0.0
+        self.template_depth = 0
+        # function name -> [calls, seconds]
+        self.functions = {}
+
+    def record_query(self, alias, sql, params, seconds):
+        self.queries.append((alias, sql, repr(params), seconds))
+
+    def record_function(self, name, seconds):
+        timing = self.functions.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    @property
+    def db_time(self):
+        return sum(query[3] for query in self.queries)
+
+    @property
+    def duplicate_queries(self):
+        # the same statement with the same parameters run again
+        counts = Counter((alias, sql, params) for alias, sql, params, _ in self.queries)
+        return sum(count - 1 for count in counts.values())
+
+    def repeated_statements(self):
+        """
+        :return: Counter of statements run more than once, whatever their
+        parameters - usually a query in a loop
+        """
+        counts = Counter(sql for _, sql, _, _ in self.queries)
+        return Counter({sql: count for sql, count in counts.items() if count > 1})
+
+
+class UrlStats(object):
+
+    def __init__(self, url_name):
+        self.url_name = url_name
+        self.requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.duplicate_queries = 0
+        self.template_time = 0.0
+        self.functions = {}
+        self.repeated_statements = Counter()
+
+    def add(self, profile):
+        self.requests += 1
+        self.total_time += profile.elapsed
+        self.max_time = max(self.max_time, profile.elapsed)
+        self.queries += len(profile.queries)
+        self.max_queries = max(self.max_queries, len(profile.queries))
+        self.db_time += profile.db_time
+        self.duplicate_queries += profile.duplicate_queries
+        self.template_time += profile.template_time
+        for name, (calls, seconds) in profile.functions.items():
+            timing = self.functions.setdefault(name, [0, 0.0])
+            timing[0] += calls
+            timing[1] += seconds
+        # highest repeat count seen in one request
+        for sql, count in profile.repeated_statements().items():
+            self.repeated_statements[sql] = max(self.repeated_statements[sql], count)
+        self.repeated_statements = Counter(dict(self.repeated_statements.most_common(MAX_REPEATED_QUERIES)))
+
+    def as_dict(self):
+        def ms(seconds):
+            return round(seconds * 1000, 1)
+
+        return {
+            "url_name": self.url_name,
+            "requests": self.requests,
+            "mean_ms": ms(self.total_time / self.requests),
+            "max_ms": ms(self.max_time),
+            "total_ms": ms(self.total_time),
+            "mean_queries": round(self.queries / self.requests, 1),
+            "max_queries": self.max_queries,
+            "mean_db_ms": ms(self.db_time / self.requests),
+            "mean_duplicate_queries": round(self.duplicate_queries / self.requests, 1),
+            "mean_template_ms": ms(self.template_time / self.requests),
+            "functions": [{"name": name, "calls": calls, "total_ms": ms(seconds)}
+                          for name, (calls, seconds) in sorted(self.functions.items(),
+                                                               key=lambda item: -item[1][1])],
+            "repeated_queries": [{"sql": sql, "max_per_request": count}
+                                 for sql, count in self.repeated_statements.most_common()],
+        }
+
+
+def current_profile():
+    return getattr(_local, "profile", None)
+
+
+def record_function(name, seconds):
+    profile = current_profile()
+    if profile is not None:
+        profile.record_function(name, seconds)
+
+
+def _query_wrapper(alias):
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            profile = current_profile()
+            if profile is not None:
+                profile.record_query(alias, sql, params, time.perf_counter() - start)
+    return wrapper
+
+
+@contextmanager
+def profile_request():
+    """
+    Profiles the code run in the block on this thread
+    """
+    profile = RequestProfile()
+    _local.profile = profile
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(_query_wrapper(alias)))
+            yield profile
+    finally:
+        _local.profile = None
+        profile.finish()
+
+
+def instrument_templates():
+    """
+    Times template rendering. Only the outermost render of nested templates
+    ( extends, include ) is counted.
+    """
+    global _templates_instrumented
+    if _templates_instrumented:
+        return
+    from django.template.base import Template
+    original_render = Template.render
+
+    def render(self, context):
+        profile = current_profile()
+        if profile is None:
+            return original_render(self, context)
+        profile.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return original_render(self, context)
+        finally:
+            profile.template_depth -= 1
+            if profile.template_depth == 0:
+                profile.template_time += time.perf_counter() - start
+
+    Template.render = render
+    _templates_instrumented = True
+
+
+def record_profile(url_name, profile):
+    with _lock:
+        stats = _stats.get(url_name)
+        if stats is None:
+            stats = _stats[url_name] = UrlStats(url_name)
+        stats.add(profile)
+
+
+def profile_summary():
+    """
+    :return: the stats of each url name, slowest ( in total ) first
+    """
+    with _lock:
+        summary = [stats.as_dict() for stats in _stats.values()]
+    return sorted(summary, key=lambda stats: -stats["total_ms"])
+
+
+def reset_profiles():
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,216 @@
+"""
+A compiled, read only view of a registry definition.
+
+Walking RegistryForm.section_models and Section.cde_models issues a query
+per form, section and cde, and the hot paths ( form view, form data parsing,
+form progress ) do this on every request. A RegistryGraph loads the forms,
+sections, cdes and cde policies of a registry in a handful of queries
+and is shared by every request in the process until the definition version
+changes ( see DefinitionVersion.) Permitted values come from the process wide
+cache of rdrf.helpers.permitted_values.
+"""
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from rdrf.helpers.permitted_values import get_permitted_values, invalidate_permitted_values
+from rdrf.helpers.permitted_values import preload_permitted_values
+from rdrf.helpers.utils import BadKeyError, get_form_section_code
+from rdrf.models.definition.models import Registry, RegistryForm, Section, CommonDataElement
+from rdrf.models.definition.models import CDEPermittedValueGroup, CDEPermittedValue
+from rdrf.models.definition.models import CdePolicy, DefinitionVersion
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+FormNode = namedtuple("FormNode", ["model", "sections", "completion_cde_codes"])
+SectionNode = namedtuple("SectionNode", ["model", "cdes"])
+
+
+class RegistryGraph(object):
+    """
+    forms -> sections -> cdes -> permitted value groups for one registry.
+    Built once per definition version - don't mutate the models it holds.
+    """
+
+    def __init__(self, registry_model, version):
+        self.registry_model = registry_model
+        self.version = version
+
+        form_models = list(RegistryForm.objects.filter(registry=registry_model)
+                                               .order_by("position")
+                                               .prefetch_related("complete_form_cdes"))
+
+        section_codes = [code for form_model in form_models for code in form_model.get_sections()]
+        section_codes.extend(registry_model.generic_sections)
+        section_qs = Section.objects.filter(code__in=set(section_codes))
+        if registry_model.patient_data_section_id:
+            section_qs = section_qs | Section.objects.filter(pk=registry_model.patient_data_section_id)
+        section_map = {s.code: s for s in section_qs}
+
+        cde_codes = set(code for s in section_map.values() for code in s.get_elements())
+        cde_map = {c.code: c for c in CommonDataElement.objects.filter(code__in=cde_codes)
+                                                               .select_related("pv_group")}
+
+        preload_permitted_values(sorted(set(c.pv_group_id for c in cde_map.values() if c.pv_group_id)))
+
+        sections = OrderedDict()
+        for code, section_model in section_map.items():
+            section_cdes = []
+            for cde_code in section_model.get_elements():
+                if cde_code in cde_map:
+                    section_cdes.append(cde_map[cde_code])
+                else:
+                    logger.warning("Section %s refers to missing cde %s" % (code, cde_code))
+            sections[code] = SectionNode(section_model, tuple(section_cdes))
+
+        forms = OrderedDict()
+        for form_model in form_models:
+            form_sections = tuple(sections[code] for code in form_model.get_sections() if code in sections)
+            completion_codes = frozenset(cde.code for cde in form_model.complete_form_cdes.all())
+            forms[form_model.name] = FormNode(form_model, form_sections, completion_codes)
+
+        self._forms = MappingProxyType(forms)
+        self._forms_by_id = MappingProxyType({node.model.pk: node for node in forms.values()})
+        self._sections = MappingProxyType(sections)
+        self._cdes = MappingProxyType(cde_map)
+        self._cde_policies = MappingProxyType({policy.cde_id: policy for policy in
+                                               CdePolicy.objects.filter(registry=registry_model)
+                                                                .prefetch_related("groups_allowed")})
+        self.forms = tuple(node.model for node in forms.values())
+
+    def __str__(self):
+        return "RegistryGraph for %s version %s" % (self.registry_model.code, self.version)
+
+    def form(self, form_name):
+        node = self._forms.get(form_name)
+        return node.model if node else None
+
+    def form_by_id(self, form_id):
+        try:
+            node = self._forms_by_id.get(int(form_id))
+        except (TypeError, ValueError):
+            return None
+        return node.model if node else None
+
+    def section(self, section_code):
+        node = self._sections.get(section_code)
+        return node.model if node else None
+
+    def cde(self, cde_code):
+        return self._cdes.get(cde_code)
+
+    def is_multisection(self, section_code):
+        section_model = self.section(section_code)
+        return bool(section_model and section_model.allow_multiple)
+
+    def section_models(self, form_model):
+        node = self._forms.get(form_model.name)
+        if node is None or node.model.pk != form_model.pk:
+            return form_model.section_models
+        return [section_node.model for section_node in node.sections]
+
+    def cde_models(self, section_model):
+        node = self._sections.get(section_model.code)
+        if node is None:
+            return section_model.cde_models
+        return list(node.cdes)
+
+    def completion_cde_codes(self, form_model):
+        node = self._forms.get(form_model.name)
+        if node is None:
+            return frozenset(cde.code for cde in form_model.complete_form_cdes.all())
+        return node.completion_cde_codes
+
+    def progress_cdes(self, form_model):
+        """
+        (section model, cde model) pairs of the completion cdes of a form,
+        in the order they appear on the form
+        """
+        completion_codes = self.completion_cde_codes(form_model)
+        return [(section_model, cde_model)
+                for section_model in self.section_models(form_model)
+                for cde_model in self.cde_models(section_model)
+                if cde_model.code in completion_codes]
+
+    def permitted_values(self, pv_group_code):
+        """
+        Permitted value models of a group ordered by position
+        """
+        return get_permitted_values(pv_group_code).values
+
+    def cde_policy(self, cde_code):
+        """
+        :return: the CdePolicy of a cde in this registry or None
+        """
+        return self._cde_policies.get(cde_code)
+
+    def models_from_mongo_key(self, delimited_key):
+        """
+        Same contract as rdrf.helpers.utils.models_from_mongo_key
+        """
+        form_name, section_code, cde_code = get_form_section_code(delimited_key)
+        form_model = self.form(form_name)
+        if form_model is None:
+            raise BadKeyError()
+
+        section_model = self.section(section_code)
+        if section_model is None:
+            try:
+                section_model = Section.objects.get(code=section_code)
+            except Section.DoesNotExist:
+                raise BadKeyError()
+
+        cde_model = self.cde(cde_code)
+        if cde_model is None:
+            try:
+                cde_model = CommonDataElement.objects.get(code=cde_code)
+            except CommonDataElement.DoesNotExist:
+                raise BadKeyError()
+
+        return form_model, section_model, cde_model
+
+
+_registry_graphs = {}
+
+
+def get_registry_graph(registry):
+    """
+    :param registry: registry model or code
+    :return: the RegistryGraph for the current definition version
+    """
+    registry_code = registry if isinstance(registry, str) else registry.code
+    version = DefinitionVersion.current()
+    graph = _registry_graphs.get(registry_code)
+    if graph is None or graph.version != version:
+        # we load our own registry instance as callers may modify theirs
+        registry_model = Registry.objects.get(code=registry_code)
+        graph = RegistryGraph(registry_model, version)
+        _registry_graphs[registry_code] = graph
+    return graph
+
+
+def invalidate_registry_graphs():
+    DefinitionVersion.bump()
+    _registry_graphs.clear()
+    invalidate_permitted_values()
+
+
+@receiver([post_save, post_delete], sender=Registry)
+@receiver([post_save, post_delete], sender=RegistryForm)
+@receiver([post_save, post_delete], sender=Section)
+@receiver([post_save, post_delete], sender=CommonDataElement)
+@receiver([post_save, post_delete], sender=CDEPermittedValueGroup)
+@receiver([post_save, post_delete], sender=CDEPermittedValue)
+@receiver([post_save, post_delete], sender=CdePolicy)
+@receiver(m2m_changed, sender=RegistryForm.complete_form_cdes.through)
+@receiver(m2m_changed, sender=CdePolicy.groups_allowed.through)
+def definition_changed(sender, **kwargs):
+    if kwargs.get("action", "").startswith("pre_"):
+        # m2m_changed fires before and after the change
+        return
+    invalidate_registry_graphs()
@@ -0,0 +1,81 @@
+"""
+A request scoped identity map.
+
+Templates and views ask for the same things many times while handling one
+request: registry features ( parsed from metadata_json ), the user's groups
+and registries, the current definition version. RequestCacheMiddleware
+( registry.common.middleware ) gives each request an empty dict which
+request_cached() memoises such lookups in. Outside a request ( management
+commands, tests without the middleware ) nothing is cached unless the code
+runs in a request_cache_scope().
+
+Entries are keyed by tuples whose first item names the kind of lookup so
+that signal receivers can drop what a save makes stale.
+"""
+from contextlib import contextmanager
+import threading
+
+_local = threading.local()
+
+_MISSING = object()
+
+
+def start_request_cache():
+    _local.cache = {}
+
+
+def end_request_cache():
+    _local.cache = None
+
+
+@contextmanager
+def request_cache_scope():
+    """
+    Caches lookups for the duration of the block ( or decorated function ) as
+    for a request - for management commands, which would otherwise e.g. read
+    the definition version every time they ask for a registry graph.
+    Inside a request or another scope the existing cache is used.
+    """
+    if get_request_cache() is not None:
+        yield
+        return
+    start_request_cache()
+    try:
+        yield
+    finally:
+        end_request_cache()
+
+
+def get_request_cache():
+    """
+    :return: the cache dict of the current request or None
+    """
+    return getattr(_local, "cache", None)
+
+
+def request_cached(key, func):
+    """
+    :return: the value cached under key for this request, calling func to get it if needed
+    """
+    cache = get_request_cache()
+    if cache is None:
+        return func()
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = func()
+        cache[key] = value
+    return value
+
+
+def invalidate_request_cache(kind=None):
+    """
+    Drops the entries of one kind of lookup ( first item of the key ), or all of them
+    """
+    cache = get_request_cache()
+    if cache is None:
+        return
+    if kind is None:
+        cache.clear()
+        return
+    for key in [key for key in cache if key[0] == kind]:
+        del cache[key]
@@ -341,6 +341,8 @@ def get_error_messages(forms):
 
 
 def timed(func):
+    # also recorded in the request profile when profiling is on ( see rdrf.helpers.profiling )
+    from rdrf.helpers.profiling import record_function
     logger = logging.getLogger(__name__)
 
     def wrapper(*args, **kwargs):
@@ -350,6 +352,7 @@ def timed(func):
         c = b - a
         func_name = func.__name__
         logger.debug("%s time = %s secs" % (func_name, c))
+        record_function(func.__qualname__, c.total_seconds())
         return result
     return wrapper
 
@@ -364,24 +367,42 @@ def get_cde_value2(form_name, section_code, cde_code, patient_record):
 
 def get_cde_value(form_model, section_model, cde_model, patient_record):
     # should refactor code everywhere to use this func
-    if patient_record is None:
+    found = find_cde(patient_record, form_model.name, section_model.code, cde_model.code,
+                     section_model.allow_multiple)
+    if section_model.allow_multiple or found is None:
+        return found
+    return found["value"]
+
+
+def find_cde(patient_record, form_name, section_code, cde_code, multisection=False):
+    """
+    Python version of the lookup ClinicalDataQuerySet.cde_values does in the database.
+    :return: the cde's dict ( code and value ), or for a multisection the list of the
+    cde's values in each item. None if the cde ( or multisection ) isn't in the record
+    """
+    if not patient_record:
         return None
-    for form_dict in patient_record["forms"]:
-        if form_dict["name"] == form_model.name:
-            for section_dict in form_dict["sections"]:
-                if section_dict["code"] == section_model.code:
-                    if not section_dict["allow_multiple"]:
-                        for cde_dict in section_dict["cdes"]:
-                            if cde_dict["code"] == cde_model.code:
-                                return cde_dict["value"]
-                    else:
-                        values = []
-                        items = section_dict["cdes"]
-                        for item in items:
-                            for cde_dict in item:
-                                if cde_dict['code'] == cde_model.code:
-                                    values.append(cde_dict["value"])
-                        return values
+    for form_dict in patient_record.get("forms", []):
+        if form_dict.get("name") != form_name:
+            continue
+        for section_dict in form_dict.get("sections", []):
+            if section_dict.get("code") != section_code:
+                continue
+            if multisection:
+                return multisection_values(section_dict.get("cdes"), cde_code)
+            for cde_dict in section_dict.get("cdes", []):
+                if isinstance(cde_dict, dict) and cde_dict.get("code") == cde_code:
+                    return cde_dict
+            return None
+    return None
+
+
+def multisection_values(items, cde_code):
+    # the values of a cde in each item of a multisection
+    if items is None:
+        return None
+    return [cde_dict["value"] for item in items if isinstance(item, list)
+            for cde_dict in item if cde_dict.get("code") == cde_code]
 
 
 def report_function(func):
@@ -2,21 +2,13 @@ import sys
 from datetime import datetime, timedelta
 from django.core.management import BaseCommand
 from rdrf.models.definition.models import Registry
-from rdrf.services.io.notifications.reminders import ReminderProcessor
-from rdrf.services.io.notifications.email_notification import process_notification
+from django.db.models import Q
+from rdrf.services.io.notifications.reminders import ReminderEngine
 
+from registry.groups import GROUPS as RDRF_GROUPS
 from registry.groups.models import CustomUser
 
 
-def send_reminder(user, registry_model, process_func=None):
-    if process_func:
-        rp = ReminderProcessor(user, registry_model, process_func)
-    else:
-        rp = ReminderProcessor(user, registry_model)
-    sent = rp.process()
-    return sent
-
-
 class Command(BaseCommand):
     help = "Lists users who haven't logged in for a while"
 
@@ -92,39 +84,31 @@ class Command(BaseCommand):
         test_mode = options.get("test_mode", False)
 
         if action == "print":
-            def action_func(user):
-                return self._print(user.username)
+            for user in self._get_users(registry_model, threshold):
+                self._print(user.username)
         elif action == "send-reminders":
-            if test_mode:
-                def action_func(user):
-                    return send_reminder(
-                        user,
-                        registry_model,
-                        self._dummy_send)
-            else:
-                def action_func(user):
-                    return send_reminder(
-                        user,
-                        registry_model,
-                        process_notification)
+            self._send_reminders(registry_model, threshold, test_mode)
         else:
             self._error("Unknown action: %s" % action)
             sys.exit(1)
 
-        for user in self._get_users(registry_model):
-            if user.last_login is None or user.last_login < threshold:
+    def _send_reminders(self, registry_model, threshold, test_mode):
+        engine = ReminderEngine(registry_model, self._dummy_send if test_mode else None)
+        try:
+            for user, can_send in engine.check(self._get_users(registry_model, threshold)):
                 try:
-                    reminders_sent = action_func(user)
+                    reminders_sent = can_send and engine.send(user)
                     if test_mode:
                         if not reminders_sent:
                             self._print("not sent")
                 except Exception as ex:
-                    self._error("Error performing %s on user %s: %s" % (action,
-                                                                        user,
-                                                                        ex))
-
-    def _get_users(self, registry_model):
-        for user in CustomUser.objects.filter(registry__in=[registry_model],
-                                              is_active=True):
-            if user.is_patient or user.is_parent:
-                yield user
+                    self._error("Error performing send-reminders on user %s: %s" % (user, ex))
+        finally:
+            engine.close()
+
+    def _get_users(self, registry_model, threshold):
+        # patients and parents who haven't logged in since the threshold
+        in_group = Q(groups__name__icontains=RDRF_GROUPS.PATIENT) | Q(groups__name__icontains=RDRF_GROUPS.PARENT)
+        not_logged_in = Q(last_login__isnull=True) | Q(last_login__lt=threshold)
+        users = CustomUser.objects.filter(in_group, not_logged_in, registry__in=[registry_model], is_active=True)
+        return users.distinct().order_by("pk").iterator()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry
+from rdrf.db import clinical_indexes
+
+
+class Command(BaseCommand):
+    help = "Creates, drops or lists the per cde indexes on clinical data ( see rdrf.db.clinical_indexes )"
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["sync", "drop", "list"],
+                            help="sync creates the declared indexes and drops undeclared ones")
+        parser.add_argument("--registry", dest="registry_code", default=None,
+                            help="Registry code - all registries if not given")
+
+    def handle(self, action, **options):
+        registries = Registry.objects.all()
+        if options["registry_code"]:
+            registries = registries.filter(code=options["registry_code"])
+            if not registries.exists():
+                raise CommandError("Unknown registry code: %s" % options["registry_code"])
+
+        for registry_model in registries:
+            if action == "sync":
+                created, dropped = clinical_indexes.sync_indexes(registry_model)
+                for name in created:
+                    self.stdout.write("%s: created %s" % (registry_model.code, name))
+                for name in dropped:
+                    self.stdout.write("%s: dropped %s" % (registry_model.code, name))
+            elif action == "drop":
+                for name in clinical_indexes.drop_indexes(registry_model):
+                    self.stdout.write("%s: dropped %s" % (registry_model.code, name))
+            else:
+                existing = clinical_indexes.existing_indexes(registry_model.code)
+                for cde_path in clinical_indexes.declared_cde_paths(registry_model):
+                    name = clinical_indexes.index_name(registry_model.code, cde_path)
+                    status = "exists" if name in existing else "missing"
+                    self.stdout.write("%s: %s %s (%s)" % (registry_model.code, cde_path, name, status))
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry
+from rdrf.db.history import compact_history
+
+
+class Command(BaseCommand):
+    help = "Re-encodes history snapshots as deltas with periodic full checkpoints ( see rdrf.db.history )"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", dest="registry_code", default=None,
+                            help="Registry code - all registries if not given")
+        parser.add_argument("--checkpoint-interval", type=int, dest="checkpoint_interval",
+                            default=settings.HISTORY_CHECKPOINT_INTERVAL,
+                            help="Number of snapshots from one full checkpoint to the next")
+        parser.add_argument("--expand", action="store_true",
+                            help="Store every snapshot in full again")
+
+    def handle(self, *args, **options):
+        registries = Registry.objects.all()
+        if options["registry_code"]:
+            registries = registries.filter(code=options["registry_code"])
+            if not registries.exists():
+                raise CommandError("Unknown registry code: %s" % options["registry_code"])
+
+        checkpoint_interval = 1 if options["expand"] else options["checkpoint_interval"]
+        if checkpoint_interval < 1:
+            raise CommandError("The checkpoint interval must be at least 1")
+
+        for registry_model in registries:
+            changed = sum(compact_history(registry_model.code, checkpoint_interval))
+            self.stdout.write("%s: re-encoded %s history snapshots" % (registry_model.code, changed))
@@ -1,8 +1,7 @@
 from django.core.management import BaseCommand
 from rdrf.models.definition.models import Registry
-from registry.patients.models import Patient
-from explorer.models import FieldValue
-from explorer.utils import create_field_values
+from explorer.utils import create_registry_field_values
+from rdrf.helpers.request_cache import request_cache_scope
 
 
 class Command(BaseCommand):
@@ -11,12 +10,18 @@ class Command(BaseCommand):
     """
     help = "Creates field values for reporting"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, dest="batch_size",
+                            help="Number of clinical data records processed per batch")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of worker processes")
+
+    @request_cache_scope
     def handle(self, *args, **options):
         for registry_model in Registry.objects.all():
-            FieldValue.objects.filter(registry=registry_model).delete()
-            for patient_model in Patient.objects.filter(rdrf_registry__in=[registry_model]):
-                for context_model in patient_model.context_models:
-                    if context_model.registry.code == registry_model.code:
-                        create_field_values(registry_model,
-                                            patient_model,
-                                            context_model)
+            total = 0
+            for num_values in create_registry_field_values(registry_model,
+                                                           options["batch_size"],
+                                                           options["workers"]):
+                total += num_values
+            self.stdout.write("Created %s field values for registry %s" % (total, registry_model.code))
@@ -1,6 +1,7 @@
 import time
 import json
 from django.core.management.base import BaseCommand
+from rdrf.db.history import materialise
 from rdrf.helpers.utils import catch_and_log_exceptions
 from rdrf.models.definition.models import ClinicalData, RegistryForm, CommonDataElement, Section
 
@@ -112,10 +113,10 @@ class Command(BaseCommand):
             self.display_user_row("----------", "---------", "---------", "-------------------------", "---------")
 
         # Retrieve bad codes from ClinicalData.
-        clinicaldatas = ClinicalData.objects.all()
-        for clinicaldata in clinicaldatas:
-            if clinicaldata.collection == "history":
-                bad_codes = self.get_bad_codes_from_collection(clinicaldata.data, form_names, section_codes, cde_codes, bad_codes)
+        # delta encoded snapshots are materialised so every snapshot has its full record
+        history = ClinicalData.objects.filter(collection="history").order_by("pk")
+        for snapshot in materialise(history.values_list("data", flat=True)):
+            bad_codes = self.get_bad_codes_from_collection(snapshot, form_names, section_codes, cde_codes, bad_codes)
 
         return bad_codes
 
@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand, CommandError
 
 from rdrf.services.io.content import export_import
 from rdrf.services.io.content.export_import import definitions
+from rdrf.services.io.content.export_import.exporters import FORMATS
 from rdrf.models.definition.models import Registry
 
 
@@ -23,6 +24,10 @@ class Command(BaseCommand):
             help='the code of the Registry')
         parser.add_argument('--verbose', action='store_true', help='less verbose output')
         parser.add_argument('--filename', help='the zip file name to export to')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes exporting models in parallel')
+        parser.add_argument('--format', choices=FORMATS, default=FORMATS[0],
+                            help='format of the exported model files')
 
     def handle(self, **options):
         export_type = options['export_type']
@@ -38,6 +43,8 @@ class Command(BaseCommand):
         options = {
             'verbose': options.get('verbose'),
             'filename': options.get('filename'),
+            'workers': options.get('workers'),
+            'format': options.get('format'),
         }
 
         if export_type == definitions.ExportTypes.REGISTRY_DEF.code:
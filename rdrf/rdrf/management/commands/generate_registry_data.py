@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rdrf.models.definition.models import Registry
+from rdrf.services.io.defs.importer import Importer
+from rdrf.testing.synthetic_data import SyntheticDataGenerator
+from rdrf.helpers.request_cache import request_cache_scope
+
+
+class Command(BaseCommand):
+    help = "Fills a registry with synthetic patients and clinical data for performance testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", dest="registry_code", default=None,
+                            help="Code of the registry to fill - the registry of --definition if not given")
+        parser.add_argument("--definition", dest="definition_file", default=None,
+                            help="Registry definition yaml to import first")
+        parser.add_argument("--patients", type=int, default=100, help="Number of patients to create")
+        parser.add_argument("--contexts", type=int, default=1,
+                            help="Contexts per patient, for registries with contexts")
+        parser.add_argument("--forms", type=int, default=None,
+                            help="Maximum number of forms filled per context - all if not given")
+        parser.add_argument("--multisection-items", type=int, dest="multisection_items", default=2,
+                            help="Items in each multisection")
+        parser.add_argument("--history", type=int, default=3,
+                            help="Extra form saves kept in the history of each record")
+        parser.add_argument("--fill-ratio", type=float, dest="fill_ratio", default=0.9,
+                            help="Chance of a cde having a value")
+        parser.add_argument("--batch-size", type=int, dest="batch_size", default=200,
+                            help="Patients written per transaction")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed, for repeatable data")
+
+    @request_cache_scope
+    def handle(self, *args, **options):
+        registry_code = options["registry_code"]
+        if options["definition_file"]:
+            importer = Importer()
+            with open(options["definition_file"]) as definition_file:
+                importer.load_yaml_from_string(definition_file.read())
+            if registry_code:
+                importer.data["code"] = registry_code
+            with transaction.atomic():
+                importer.create_registry()
+            registry_code = importer.data["code"]
+            self.stdout.write("Imported registry %s" % registry_code)
+        if not registry_code:
+            raise CommandError("--registry or --definition required")
+
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            raise CommandError("Unknown registry code: %s" % registry_code)
+
+        if not 0 <= options["fill_ratio"] <= 1:
+            raise CommandError("The fill ratio must be between 0 and 1")
+
+        generator = SyntheticDataGenerator(registry_model,
+                                           contexts=options["contexts"],
+                                           forms=options["forms"],
+                                           multisection_items=options["multisection_items"],
+                                           history=options["history"],
+                                           fill_ratio=options["fill_ratio"],
+                                           batch_size=options["batch_size"],
+                                           seed=options["seed"])
+        created = 0
+        for num_patients in generator.generate(options["patients"]):
+            created += num_patients
+            self.stdout.write("%s: created %s of %s patients" % (registry_code, created, options["patients"]))
+        generator.finish()
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from rdrf.models.definition.models import Registry
+from rdrf.reports.generator import Generator
+from rdrf.helpers.request_cache import request_cache_scope
+
+import sys
+
+
+class Command(BaseCommand):
+    help = "Builds the reporting tables of a registry's clinical data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("registry_code")
+        parser.add_argument("--db", choices=["reporting", "clinical", "default"], default="reporting",
+                            help="Database the tables are written to")
+        parser.add_argument("--refresh", action="store_true", default=False,
+                            help="Only re-extract the clinical data changed since the last build")
+
+    @request_cache_scope
+    def handle(self, registry_code, **options):
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            self.stderr.write("Error: Unknown registry code: %s" % registry_code)
+            sys.exit(1)
+            return
+
+        generator = Generator(registry_model, db=options["db"])
+        if options["refresh"]:
+            generator.refresh()
+            self.stdout.write("Reporting tables refreshed OK")
+        else:
+            generator.create_tables()
+            self.stdout.write("Reporting tables created OK")
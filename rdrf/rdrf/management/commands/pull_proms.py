@@ -1,14 +1,18 @@
 from django.core.management.base import BaseCommand
 from rdrf.models.definition.models import Registry
 
-from rdrf.services.rest.views.proms_api import PromsProcessor
+from rdrf.services.rest.views.proms_api import PromsProcessor, PAGE_SIZE
 
 
 class Command(BaseCommand):
     help = 'Pulls proms from associated proms system'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                            help='Number of completed surveys downloaded and saved at a time')
+
     def handle(self, *args, **options):
         for registry_model in Registry.objects.all():
             if registry_model.proms_system_url:
                 proms_processor = PromsProcessor(registry_model)
-                proms_processor.download_proms()
+                proms_processor.download_proms(page_size=options['page_size'])
@@ -0,0 +1,75 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry
+from rdrf.testing.benchmarks import BENCHMARKS, BenchmarkError, compare_results, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Times form views, patient listing, progress, reports and explorer queries against a registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", dest="registry_code", required=True, help="Registry code")
+        parser.add_argument("--user", dest="username", default=None,
+                            help="User the views are requested as - the first superuser if not given")
+        parser.add_argument("--benchmark", dest="names", action="append", choices=list(BENCHMARKS),
+                            help="Benchmark to run ( repeatable ) - all if not given")
+        parser.add_argument("--runs", type=int, default=5, help="Times each benchmark is run")
+        parser.add_argument("--sample-size", type=int, dest="sample_size", default=20,
+                            help="Patient contexts the form and progress benchmarks use")
+        parser.add_argument("--reporting-db", dest="reporting_db", default="reporting",
+                            help="Database the reporting tables are written to")
+        parser.add_argument("--output", dest="output_file", default=None,
+                            help="File the json results are written to - stdout if not given")
+        parser.add_argument("--compare", dest="baseline_file", default=None,
+                            help="Json results of an earlier run to compare against")
+        parser.add_argument("--threshold", type=float, default=1.2,
+                            help="Median time ratio over the baseline reported as a regression")
+
+    def handle(self, *args, **options):
+        try:
+            registry_model = Registry.objects.get(code=options["registry_code"])
+        except Registry.DoesNotExist:
+            raise CommandError("Unknown registry code: %s" % options["registry_code"])
+
+        users = get_user_model().objects.filter(is_active=True)
+        if options["username"]:
+            user = users.filter(username=options["username"]).first()
+        else:
+            user = users.filter(is_superuser=True).order_by("pk").first()
+        if user is None:
+            raise CommandError("No user to run the benchmarks as")
+
+        try:
+            results = run_benchmarks(registry_model, user,
+                                     names=options["names"],
+                                     runs=options["runs"],
+                                     sample_size=options["sample_size"],
+                                     reporting_db=options["reporting_db"])
+        except BenchmarkError as ex:
+            raise CommandError(str(ex))
+
+        results_json = json.dumps(results, indent=2)
+        if options["output_file"]:
+            with open(options["output_file"], "w") as output_file:
+                output_file.write(results_json)
+        else:
+            self.stdout.write(results_json)
+
+        for result in results["results"]:
+            if "error" in result:
+                self.stderr.write("%s failed: %s" % (result["name"], result["error"]))
+
+        if options["baseline_file"]:
+            with open(options["baseline_file"]) as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = []
+            for name, old, new, ratio, regressed in compare_results(baseline, results, options["threshold"]):
+                self.stderr.write("%-20s %10.1f ms -> %10.1f ms %s%s" % (
+                    name, old, new, "x%.2f" % ratio if ratio is not None else "",
+                    " REGRESSION" if regressed else ""))
+                if regressed:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError("Slower than %s: %s" % (options["baseline_file"], ", ".join(regressions)))
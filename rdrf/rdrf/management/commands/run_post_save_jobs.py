@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from rdrf.db.post_save import claim_jobs, finish_jobs, run_jobs
+from rdrf.helpers.request_cache import request_cache_scope
+
+
+class Command(BaseCommand):
+    help = "Runs the form progress and field value jobs queued by form saves ( POST_SAVE_JOBS = queue )"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, dest="batch_size", default=200,
+                            help="Jobs claimed and run together")
+        parser.add_argument("--once", action="store_true", default=False,
+                            help="Exit when the queue is empty instead of waiting for more jobs")
+        parser.add_argument("--sleep", type=float, default=2.0,
+                            help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = claim_jobs(options["batch_size"])
+            if not jobs:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+                continue
+            # a batch at a time - the worker has to see definition changes
+            with request_cache_scope():
+                failed = run_jobs(jobs)
+            finish_jobs(jobs, failed)
+            self.stdout.write("Ran %s post save jobs, %s failed" % (len(jobs), len(failed)))
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from rdrf.models.definition.models import Registry
-from registry.patients.models import Patient
-from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.forms.progress.bulk_progress import update_registry_progress
+from rdrf.helpers.request_cache import request_cache_scope
 
 import sys
 
@@ -11,7 +11,12 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("registry_code")
+        parser.add_argument("--chunk-size", type=int, default=500, dest="chunk_size",
+                            help="Number of clinical data records processed per batch")
+        parser.add_argument("--processes", type=int, default=1,
+                            help="Number of worker processes")
 
+    @request_cache_scope
     def handle(self, registry_code, **options):
         self.registry_model = None
         try:
@@ -23,20 +28,11 @@ class Command(BaseCommand):
             return
 
         if self.registry_model is not None:
-            self._update_progress()
+            self._update_progress(options["chunk_size"], options["processes"])
             self.stdout.write("Progress recalculated OK")
 
-    def _update_progress(self):
-        form_progress = FormProgress(self.registry_model)
-
-        for patient_model in Patient.objects.filter(rdrf_registry__in=[self.registry_model]):
-            if not self.registry_model.has_feature("contexts"):
-                default_context = patient_model.default_context(
-                    self.registry_model)
-                form_progress.save_for_patient(patient_model, default_context)
-                self.stdout.write("Recalculated progress for Patient %s" % patient_model.pk)
-
-            else:
-                self.stderr.write(
-                    "Script does not support registries with multiple contexts allowed, yet")
-                sys.exit(1)
+    def _update_progress(self, chunk_size, processes):
+        total = 0
+        for num_records in update_registry_progress(self.registry_model, chunk_size, processes):
+            total += num_records
+            self.stdout.write("Recalculated progress for %s records" % total)
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.15 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0121_auto_20200213_1430'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DefinitionVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.1.15 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0035_auto_20200107_0908'),
+        ('rdrf', '0122_definitionversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientFormProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('context_id', models.IntegerField(blank=True, null=True)),
+                ('form_name', models.CharField(max_length=80)),
+                ('required', models.IntegerField(default=0)),
+                ('filled', models.IntegerField(default=0)),
+                ('percentage', models.IntegerField(default=0)),
+                ('current', models.BooleanField(default=False)),
+                ('has_data', models.BooleanField(default=False)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='form_progress_rows', to='patients.Patient')),
+                ('registry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rdrf.Registry')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='patientformprogress',
+            index=models.Index(fields=['patient', 'registry', 'form_name'], name='rdrf_pfp_patient_form_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientformprogress',
+            index=models.Index(fields=['registry', 'form_name', 'percentage'], name='rdrf_pfp_form_percentage_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.15 on 2026-10-18 12:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0123_patientformprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinicaldata',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.1.15 on 2026-10-18 14:05
+
+from django.db import migrations
+
+# value of a cde in a cdes record - immutable so that it can be used in
+# the per cde expression indexes ( see rdrf.db.clinical_indexes )
+CREATE_CDE_VALUE_FUNCTION = """
+CREATE OR REPLACE FUNCTION rdrf_cde_value(data jsonb, form_name text, section_code text, cde_code text)
+RETURNS jsonb AS $$
+    SELECT cde->'value'
+    FROM jsonb_array_elements(CASE WHEN jsonb_typeof(data->'forms') = 'array'
+                                   THEN data->'forms' ELSE '[]'::jsonb END) AS form,
+         jsonb_array_elements(form->'sections') AS section,
+         jsonb_array_elements(section->'cdes') AS cde
+    WHERE form->>'name' = form_name AND section->>'code' = section_code AND cde->>'code' = cde_code
+    LIMIT 1
+$$ LANGUAGE sql IMMUTABLE
+"""
+
+DROP_CDE_VALUE_FUNCTION = "DROP FUNCTION IF EXISTS rdrf_cde_value(jsonb, text, text, text)"
+
+# serves the @> containment lookups of ClinicalDataQuerySet.find and cde_contains -
+# built concurrently so the clinical data table stays writable meanwhile
+CREATE_GIN_INDEX = """
+CREATE INDEX CONCURRENTLY IF NOT EXISTS rdrf_clinicaldata_data_gin ON rdrf_clinicaldata USING gin (data jsonb_path_ops)
+"""
+
+DROP_GIN_INDEX = "DROP INDEX CONCURRENTLY IF EXISTS rdrf_clinicaldata_data_gin"
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rdrf', '0124_clinicaldata_last_updated'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_CDE_VALUE_FUNCTION, DROP_CDE_VALUE_FUNCTION,
+                          hints={"model_name": "clinicaldata"}),
+        migrations.RunSQL(CREATE_GIN_INDEX, DROP_GIN_INDEX,
+                          hints={"model_name": "clinicaldata"}),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.1.15 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0125_clinicaldata_data_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostSaveJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_id', models.IntegerField()),
+                ('context_id', models.IntegerField()),
+                ('kind', models.CharField(choices=[('progress', 'Form progress'), ('field_values', 'Field values')], max_length=20)),
+                ('form_name', models.CharField(blank=True, default='', max_length=80)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('registry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rdrf.Registry')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='postsavejob',
+            unique_together={('registry', 'patient_id', 'context_id', 'kind', 'form_name')},
+        ),
+    ]
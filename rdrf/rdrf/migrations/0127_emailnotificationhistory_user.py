@@ -0,0 +1,55 @@
+# Generated by Django 2.1.15 on 2026-10-18 18:40
+
+import json
+
+from django.db import migrations, models
+
+
+def template_data_ids(template_data):
+    # ids of the "user" and "registry" models saved in the template data
+    try:
+        template_data = json.loads(template_data or "{}")
+        user_id = template_data.get("user", {}).get("id")
+        registry_id = template_data.get("registry", {}).get("id")
+    except (ValueError, AttributeError):
+        return None, None
+    return user_id, registry_id
+
+
+def fill_user_and_registry(apps, schema_editor):
+    EmailNotificationHistory = apps.get_model("rdrf", "EmailNotificationHistory")
+    Registry = apps.get_model("rdrf", "Registry")
+    registry_codes = dict(Registry.objects.values_list("id", "code"))
+    history = EmailNotificationHistory.objects.filter(template_data__contains='"user"')
+    for enh in history.select_related("email_notification__registry").iterator():
+        user_id, registry_id = template_data_ids(enh.template_data)
+        if isinstance(user_id, int):
+            registry_code = registry_codes.get(registry_id, enh.email_notification.registry.code)
+            EmailNotificationHistory.objects.filter(pk=enh.pk).update(user_id=user_id,
+                                                                       registry_code=registry_code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0126_postsavejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailnotificationhistory',
+            name='registry_code',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailnotificationhistory',
+            name='user_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='emailnotificationhistory',
+            index=models.Index(fields=['registry_code', 'user_id', 'date_stamp'], name='rdrf_enh_user_idx'),
+        ),
+        migrations.RunPython(fill_user_and_registry, migrations.RunPython.noop,
+                             hints={"model_name": "emailnotificationhistory"}),
+    ]
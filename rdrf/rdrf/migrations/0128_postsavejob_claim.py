@@ -0,0 +1,23 @@
+# Generated by Django 2.1.15 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0127_emailnotificationhistory_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postsavejob',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='postsavejob',
+            name='requeued',
+            field=models.BooleanField(default=False),
+        ),
+    ]
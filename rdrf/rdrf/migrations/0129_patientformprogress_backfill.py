@@ -0,0 +1,69 @@
+# Generated by Django 2.1.15 on 2026-10-18 19:45
+
+from django.db import migrations, router
+from django.db.utils import DatabaseError
+
+BATCH_SIZE = 1000
+
+
+def progress_rows(PatientFormProgress, registry_id, patient_id, context_id, progress_data):
+    # same as rdrf.models.definition.progress_models.save_patient_form_progress
+    for key, form_progress_dict in progress_data.items():
+        if not key.endswith("_form_progress") or not isinstance(form_progress_dict, dict):
+            continue
+        form_name = key[:-len("_form_progress")]
+        yield PatientFormProgress(patient_id=patient_id,
+                                  registry_id=registry_id,
+                                  context_id=context_id,
+                                  form_name=form_name,
+                                  required=form_progress_dict.get("required", 0),
+                                  filled=form_progress_dict.get("filled", 0),
+                                  percentage=form_progress_dict.get("percentage", 0),
+                                  current=bool(progress_data.get(form_name + "_form_current")),
+                                  has_data=bool(progress_data.get(form_name + "_form_has_data")))
+
+
+def backfill_patient_form_progress(apps, schema_editor):
+    # copies the progress collection into PatientFormProgress for the records
+    # which have no rows yet, so the patient listing shows existing progress
+    ClinicalData = apps.get_model("rdrf", "ClinicalData")
+    PatientFormProgress = apps.get_model("rdrf", "PatientFormProgress")
+    Registry = apps.get_model("rdrf", "Registry")
+    Patient = apps.get_model("patients", "Patient")
+
+    registry_ids = dict(Registry.objects.values_list("code", "id"))
+    patient_ids = set(Patient.objects.values_list("id", flat=True))
+    existing = set(PatientFormProgress.objects.values_list("patient_id", "context_id").distinct())
+
+    progress = (ClinicalData.objects.using(router.db_for_read(ClinicalData))
+                                    .filter(collection="progress", django_model="Patient")
+                                    .order_by("pk")
+                                    .values_list("registry_code", "django_id", "context_id", "data"))
+    rows = []
+    try:
+        for registry_code, patient_id, context_id, data in progress.iterator():
+            registry_id = registry_ids.get(registry_code)
+            if registry_id is None or patient_id not in patient_ids or (patient_id, context_id) in existing:
+                continue
+            existing.add((patient_id, context_id))
+            rows.extend(progress_rows(PatientFormProgress, registry_id, patient_id, context_id, data or {}))
+            if len(rows) >= BATCH_SIZE:
+                PatientFormProgress.objects.bulk_create(rows)
+                rows = []
+    except DatabaseError:
+        # the clinical database isn't migrated yet - a new installation has no progress to copy
+        return
+    PatientFormProgress.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0128_postsavejob_claim'),
+        ('patients', '0035_auto_20200107_0908'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_patient_form_progress, migrations.RunPython.noop,
+                             hints={"model_name": "patientformprogress"}),
+    ]
@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import jsonschema
@@ -13,7 +14,8 @@ from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.urls import reverse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
-from django.db import models
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
 from django.db.models.signals import pre_delete
 from django.dispatch.dispatcher import receiver
 from django.forms.models import model_to_dict
@@ -21,7 +23,9 @@ from django.utils.safestring import mark_safe
 from django.core.exceptions import PermissionDenied
 
 from rdrf.helpers.utils import format_date, parse_iso_datetime
+from rdrf.helpers.utils import find_cde, multisection_values
 from rdrf.helpers.utils import LinkWrapper
+from rdrf.helpers.request_cache import request_cached, invalidate_request_cache
 from rdrf.events.events import EventType
 
 from rdrf.forms.fields.jsonb import DataField
@@ -184,7 +188,7 @@ class Registry(models.Model):
 
     @property
     def features(self):
-        return self.metadata.get("features", [])
+        return list(self._parsed_metadata()[0].get("features", []))
 
     @features.setter
     def features(self, features):
@@ -204,7 +208,7 @@ class Registry(models.Model):
     @property
     def diagnosis_code(self):
         # used by verification workflow
-        return self.metadata.get("diagnosis_code", None)
+        return self._parsed_metadata()[0].get("diagnosis_code", None)
 
     @property
     def has_groups(self):
@@ -216,6 +220,7 @@ class Registry(models.Model):
 
     @property
     def metadata(self):
+        # a fresh copy callers can modify
         if self.metadata_json:
             try:
                 return json.loads(self.metadata_json)
@@ -226,16 +231,32 @@ class Registry(models.Model):
         else:
             return {}
 
+    def _parsed_metadata(self):
+        """
+        (metadata, feature set) shared by all the registry instances of a request
+        with the same metadata_json - read only
+        """
+        metadata_json = self.metadata_json
+        cached = getattr(self, "_metadata_cache", None)
+        if cached is None or cached[0] != metadata_json:
+            def parse():
+                metadata = self.metadata
+                return metadata, frozenset(metadata.get("features", []))
+            cached = (metadata_json, request_cached(("registry_metadata", metadata_json), parse))
+            self._metadata_cache = cached
+        return cached[1]
+
     def get_metadata_item(self, item):
         try:
-            return self.metadata[item]
+            return copy.deepcopy(self._parsed_metadata()[0][item])
         except KeyError:
             return True
 
     def shows(self, element):
         # does this registry make visible extra/custom functionality ( false by default)
-        if "visibility" in self.metadata:
-            return element in self.metadata["visibility"]
+        metadata = self._parsed_metadata()[0]
+        if "visibility" in metadata:
+            return element in metadata["visibility"]
 
     @property
     def questionnaire(self):
@@ -430,10 +451,7 @@ class Registry(models.Model):
         return [f for f in RegistryForm.objects.filter(registry=self).order_by('position')]
 
     def has_feature(self, feature):
-        if "features" in self.metadata:
-            return feature in self.metadata["features"]
-        else:
-            return False
+        return feature in self._parsed_metadata()[1]
 
     def clean(self):
         self._check_metadata()
@@ -500,6 +518,31 @@ class Registry(models.Model):
             return None
 
 
+class DefinitionVersion(models.Model):
+    """
+    A single row counter bumped whenever a registry definition model
+    ( registry, form, section, cde, permitted values ) is saved or deleted.
+    Processes compare it with the version of their compiled registry
+    metadata to know when to rebuild it - see rdrf.helpers.registry_graph
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        # read once per request
+        return request_cached(("definition_version",), cls._current)
+
+    @classmethod
+    def _current(cls):
+        return cls.objects.filter(pk=1).values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        invalidate_request_cache("definition_version")
+        if not cls.objects.filter(pk=1).update(version=models.F("version") + 1):
+            cls.objects.get_or_create(pk=1, defaults={"version": 1})
+
+
 def get_owner_choices():
     """
     Get choices for CDE owner drop down.
@@ -518,36 +561,22 @@ class CDEPermittedValueGroup(models.Model):
     code = models.CharField(max_length=250, primary_key=True)
 
     def as_dict(self):
-        d = {}
-        d["code"] = self.code
-        d["values"] = []
-        for value in CDEPermittedValue.objects.filter(pv_group=self):
-            value_dict = {}
-            value_dict["code"] = value.code
-            value_dict["value"] = value.value
-            value_dict["questionnaire_value"] = value.questionnaire_value
-            value_dict["desc"] = value.desc
-            value_dict["position"] = value.position
-            d["values"].append(value_dict)
-        return d
+        return self.permitted_values.as_dict()
 
     def members(self, get_code=True):
-        if get_code:
-            att = "code"
-        else:
-            att = "value"
-
-        return [
-            getattr(
-                v,
-                att) for v in CDEPermittedValue.objects.filter(
-                pv_group=self).order_by('position')]
+        return self.permitted_values.members(get_code)
 
     # interface used by proms
 
     @property
     def options(self):
-        return [{"code": pv.code, "text": pv.value} for pv in CDEPermittedValue.objects.filter(pv_group=self).order_by('position')]
+        return self.permitted_values.options
+
+    @property
+    def permitted_values(self):
+        # the cached values - see rdrf.helpers.permitted_values
+        from rdrf.helpers.permitted_values import get_permitted_values
+        return get_permitted_values(self.code)
 
     def __str__(self):
         return "PVG %s containing %d items" % (self.code, len(self.members()))
@@ -687,14 +716,13 @@ class CommonDataElement(models.Model):
         elif stored_value == "NaN":
             # the DataTable was not escaping this value and interpreting it as NaN
             return ":NaN"
-        elif self.pv_group:
+        elif self.pv_group_id:
             # if a range, return the display value
             try:
-                values_dict = self.pv_group.as_dict()
-                for value_dict in values_dict["values"]:
-                    if value_dict["code"] == stored_value:
-                        display_value = value_dict["value"]
-                        return display_value
+                from rdrf.helpers.permitted_values import get_permitted_values
+                display_value = get_permitted_values(self.pv_group_id).display_value(stored_value)
+                if display_value is not None:
+                    return display_value
 
             except Exception as ex:
                 logger.error("bad value for cde %s %s: %s" % (self.code,
@@ -1436,6 +1464,15 @@ class EmailNotificationHistory(models.Model):
     language = models.CharField(max_length=10)
     email_notification = models.ForeignKey(EmailNotification, on_delete=models.CASCADE)
     template_data = models.TextField(null=True, blank=True)
+    # the registry and user of template_data, so the notifications sent about a user
+    # ( e.g. reminders ) can be found without decoding template_data
+    registry_code = models.CharField(max_length=10, blank=True, null=True)
+    user_id = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["registry_code", "user_id", "date_stamp"], name="rdrf_enh_user_idx"),
+        ]
 
 
 class RDRFContextError(Exception):
@@ -1747,6 +1784,55 @@ class ContextFormGroupItem(models.Model):
     registry_form = models.ForeignKey(RegistryForm, on_delete=models.CASCADE)
 
 
+# the dict of one cde in a record
+CDE_SQL = """
+(SELECT cde FROM jsonb_array_elements({table}.data->'forms') AS form,
+                 jsonb_array_elements(form->'sections') AS section,
+                 jsonb_array_elements(section->'cdes') AS cde
+ WHERE form->>'name' = %s AND section->>'code' = %s AND cde->>'code' = %s
+ LIMIT 1)
+"""
+
+# the items of one multisection in a record
+MULTISECTION_SQL = """
+(SELECT section->'cdes' FROM jsonb_array_elements({table}.data->'forms') AS form,
+                             jsonb_array_elements(form->'sections') AS section
+ WHERE form->>'name' = %s AND section->>'code' = %s
+ LIMIT 1)
+"""
+
+# the value of one cde in a record, with the expression of the per cde indexes
+# of rdrf.db.clinical_indexes ( rdrf_cde_value is created by migration 0125 )
+CDE_VALUE_SQL = "rdrf_cde_value({table}.data, %s, %s, %s)"
+
+# json values FormProgress doesn't count as filled in
+EMPTY_VALUES_SQL = "'null', 'false', '\"\"', '0', '[]', '{}'"
+
+# records with a filled in value in one of the forms
+FILLED_FORMS_SQL = """
+EXISTS (SELECT 1 FROM jsonb_array_elements({table}.data->'forms') AS form,
+                      jsonb_array_elements(form->'sections') AS section,
+                      jsonb_array_elements(section->'cdes') AS cde
+        WHERE form->>'name' = ANY(%s)
+          AND CASE WHEN jsonb_typeof(cde) = 'array'
+                   THEN EXISTS (SELECT 1 FROM jsonb_array_elements(cde) AS item_cde
+                                WHERE COALESCE(item_cde->'value', 'null') NOT IN ({empty}))
+                   ELSE COALESCE(cde->'value', 'null') NOT IN ({empty}) END)
+"""
+
+
+def _has_filled_form(data, form_names):
+    # python version of FILLED_FORMS_SQL
+    for form_dict in (data or {}).get("forms", []):
+        if form_dict.get("name") not in form_names:
+            continue
+        for section_dict in form_dict.get("sections", []):
+            for cde in section_dict.get("cdes", []):
+                if any(cde_dict.get("value") for cde_dict in (cde if isinstance(cde, list) else [cde])):
+                    return True
+    return False
+
+
 class ClinicalDataQuerySet(models.QuerySet):
     def collection(self, registry_code, collection):
         qs = self.filter(registry_code=registry_code, collection=collection)
@@ -1759,13 +1845,104 @@ class ClinicalDataQuerySet(models.QuerySet):
             q["django_model"] = obj.__class__.__name__
         if context_id is not None:
             q["context_id"] = context_id
+        contains = {}
         for attr, value in query.items():
-            q["data__" + attr] = value
+            if "__" not in attr and isinstance(value, (str, int, float, bool, type(None))):
+                # a containment predicate can use the GIN index on data
+                contains[attr] = value
+            else:
+                q["data__" + attr] = value
+        if contains:
+            q["data__contains"] = contains
         return self.filter(**q)
 
     def data(self):
         return self.values_list("data", flat=True)
 
+    def cde_contains(self, form_name, section_code, cde_code, value, multisection=False):
+        """
+        Records where the cde has the value ( in any item for a multisection ),
+        as a containment predicate served by the GIN index on data
+        """
+        cde_dict = {"code": cde_code, "value": value}
+        section_dict = {"code": section_code, "cdes": [[cde_dict]] if multisection else [cde_dict]}
+        return self.filter(data__contains={"forms": [{"name": form_name, "sections": [section_dict]}]})
+
+    def with_cde_value(self, form_name, section_code, cde_code):
+        """
+        Annotates the records with the value of a ( non multisection ) cde as cde_value.
+        Filters and orderings on it are served by the per cde indexes of rdrf.db.clinical_indexes
+        """
+        expression = RawSQL(CDE_VALUE_SQL.format(table=self.model._meta.db_table),
+                            (form_name, section_code, cde_code))
+        return self.annotate(cde_value=expression)
+
+    def cde_equals(self, form_name, section_code, cde_code, value):
+        """
+        Records where the ( non multisection ) cde has the value, compared with
+        the expression used by the per cde indexes of rdrf.db.clinical_indexes
+        """
+        where = "%s = %%s::jsonb" % CDE_VALUE_SQL.format(table=self.model._meta.db_table)
+        return self.extra(where=[where], params=[form_name, section_code, cde_code, json.dumps(value)])
+
+    def updated_since(self, form_names, since):
+        """
+        Records where one of the forms was saved at or after since ( see the
+        <form name>_timestamp keys of cdes records )
+        """
+        keys = ["%s_timestamp" % form_name for form_name in form_names]
+        if not keys:
+            return self.none()
+        # timestamps are stored in iso format so they compare as strings
+        since = since.isoformat()
+        if connections[self.db].vendor != "postgresql":
+            return self.filter(pk__in=[pk for pk, data in self.values_list("pk", "data")
+                                       if any((data.get(key) or "") >= since for key in keys)])
+        table = self.model._meta.db_table
+        where = " OR ".join(["%s.data->>%%s >= %%s" % table] * len(keys))
+        params = [param for key in keys for param in (key, since)]
+        return self.extra(where=["(%s)" % where], params=params)
+
+    def with_filled_forms(self, form_names):
+        """
+        Records with some value filled in on one of the forms
+        """
+        form_names = list(form_names)
+        if not form_names:
+            return self.none()
+        if connections[self.db].vendor != "postgresql":
+            return self.filter(pk__in=[pk for pk, data in self.values_list("pk", "data")
+                                       if _has_filled_form(data, form_names)])
+        where = FILLED_FORMS_SQL.format(table=self.model._meta.db_table, empty=EMPTY_VALUES_SQL)
+        return self.extra(where=[where], params=[form_names])
+
+    def cde_values(self, form_name, section_code, cde_code, multisection=False, fields=("django_id", "context_id")):
+        """
+        Looks up one cde in each record without loading the whole records: on
+        PostgreSQL only the cde ( or multisection ) leaves the database.
+        :return: a list of the fields of each record followed by what find_cde returns
+        """
+        table = self.model._meta.db_table
+        if connections[self.db].vendor != "postgresql":
+            return [row[:-1] + (find_cde(row[-1], form_name, section_code, cde_code, multisection),)
+                    for row in self.values_list(*fields, "data")]
+
+        if multisection:
+            lookup = RawSQL(MULTISECTION_SQL.format(table=table), (form_name, section_code))
+        else:
+            lookup = RawSQL(CDE_SQL.format(table=table), (form_name, section_code, cde_code))
+        rows = self.annotate(cde_lookup=lookup).values_list(*fields, "cde_lookup")
+        if multisection:
+            return [row[:-1] + (multisection_values(row[-1], cde_code),) for row in rows]
+        return list(rows)
+
+    def cde_value(self, form_name, section_code, cde_code, multisection=False):
+        """
+        find_cde for the first record - None if there isn't one
+        """
+        values = self[:1].cde_values(form_name, section_code, cde_code, multisection, fields=())
+        return values[0][0] if values else None
+
 
 class ClinicalData(models.Model):
     """
@@ -1787,6 +1964,8 @@ class ClinicalData(models.Model):
     active = models.BooleanField(
         default=True, help_text="Indicate whether an entity is active or not")
     metadata = models.TextField(blank=True, null=True)
+    # lets incremental consumers ( e.g. the reporting generator ) find changed records
+    last_updated = models.DateTimeField(auto_now=True, db_index=True)
 
     objects = ClinicalDataQuerySet.as_manager()
 
@@ -1835,13 +2014,8 @@ class ClinicalData(models.Model):
         self.save()
 
     def cde_val(self, form_name, section_code, cde_code):
-        forms = self.data.get("forms", [])
-        form_map = {f.get("name"): f for f in forms}
-        sections = form_map.get(form_name, {}).get("sections", [])
-        section_map = {s.get("code"): s for s in sections}
-        cdes = section_map.get(section_code, {}).get("cdes", [])
-        cde_map = {c.get("code"): c for c in cdes}
-        return cde_map.get(cde_code, {}).get("value")
+        cde_dict = find_cde(self.data, form_name, section_code, cde_code)
+        return cde_dict.get("value") if cde_dict else None
 
     def save(self, *args, **kwargs):
         self.full_clean()
@@ -0,0 +1,34 @@
+from django.db import models
+from rdrf.models.definition.models import Registry
+
+
+class PostSaveJob(models.Model):
+    """
+    Derived data of a cdes record waiting to be brought up to date after a
+    form save ( see rdrf.db.post_save ). A job is only queued once until it runs.
+    """
+    PROGRESS = "progress"
+    FIELD_VALUES = "field_values"
+    KINDS = (
+        (PROGRESS, "Form progress"),
+        (FIELD_VALUES, "Field values"),
+    )
+
+    registry = models.ForeignKey(Registry, on_delete=models.CASCADE)
+    patient_id = models.IntegerField()
+    context_id = models.IntegerField()
+    kind = models.CharField(max_length=20, choices=KINDS)
+    # the saved form, for jobs which only concern one form
+    form_name = models.CharField(max_length=80, blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # set while a worker runs the job
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    # queued again while running - the job runs again instead of being deleted
+    requeued = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ("registry", "patient_id", "context_id", "kind", "form_name")
+
+    def __str__(self):
+        return "%s %s/%s %s %s" % (self.kind, self.patient_id, self.context_id, self.registry_id, self.form_name)
@@ -0,0 +1,91 @@
+from django.db import models, transaction
+from django.db.models import Exists, F, Func, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from registry.patients.models import Patient
+from rdrf.models.definition.models import Registry
+
+
+class PatientFormProgressQuerySet(models.QuerySet):
+
+    def _group_rows(self, registry_model, form_names):
+        # the rows of the patient of the outer Patient query
+        return self.filter(patient=OuterRef("pk"), registry=registry_model, form_name__in=form_names)
+
+    def group_progress(self, registry_model, form_names):
+        """
+        Expression for Patient querysets calculating the progress percentage
+        of a group of forms the same way FormProgress does
+        """
+        totals = (self._group_rows(registry_model, form_names)
+                      .order_by()
+                      .values("patient")
+                      .annotate(required_total=Sum("required"), filled_total=Sum("filled"))
+                      .annotate(group_percentage=Coalesce(
+                          F("filled_total") * 100 / Func(F("required_total"), Value(0), function="NULLIF"),
+                          Value(100),
+                          output_field=IntegerField()))
+                      .values("group_percentage"))
+        return Coalesce(Subquery(totals, output_field=IntegerField()), Value(0), output_field=IntegerField())
+
+    def group_current(self, registry_model, form_names):
+        # FormProgress marks a group current as soon as any of its forms has progress
+        return Exists(self._group_rows(registry_model, form_names))
+
+    def group_has_data(self, registry_model, form_names):
+        return Exists(self._group_rows(registry_model, form_names).filter(has_data=True))
+
+
+class PatientFormProgress(models.Model):
+    """
+    Denormalised copy of the per form data in the progress collection so
+    that patient listings can sort, filter and page on progress in SQL.
+    Kept up to date by FormProgress.save_progress and update_form_progress.
+    """
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="form_progress_rows")
+    registry = models.ForeignKey(Registry, on_delete=models.CASCADE)
+    context_id = models.IntegerField(blank=True, null=True)
+    form_name = models.CharField(max_length=80)
+    required = models.IntegerField(default=0)
+    filled = models.IntegerField(default=0)
+    percentage = models.IntegerField(default=0)
+    current = models.BooleanField(default=False)
+    has_data = models.BooleanField(default=False)
+
+    objects = PatientFormProgressQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient", "registry", "form_name"], name="rdrf_pfp_patient_form_idx"),
+            models.Index(fields=["registry", "form_name", "percentage"], name="rdrf_pfp_form_percentage_idx"),
+        ]
+
+
+def save_patient_form_progress(registry_model, progress_map):
+    """
+    Replaces the form progress rows of each (patient id, context id) key of
+    progress_map with the forms in its progress data ( see FormProgress._calculate )
+    """
+    if not progress_map:
+        return
+
+    keys = Q()
+    rows = []
+    for (patient_id, context_id), progress_data in progress_map.items():
+        keys |= Q(patient_id=patient_id, context_id=context_id)
+        for key, form_progress_dict in progress_data.items():
+            if not key.endswith("_form_progress"):
+                continue
+            form_name = key[:-len("_form_progress")]
+            rows.append(PatientFormProgress(patient_id=patient_id,
+                                            registry=registry_model,
+                                            context_id=context_id,
+                                            form_name=form_name,
+                                            required=form_progress_dict.get("required", 0),
+                                            filled=form_progress_dict.get("filled", 0),
+                                            percentage=form_progress_dict.get("percentage", 0),
+                                            current=bool(progress_data.get(form_name + "_form_current")),
+                                            has_data=bool(progress_data.get(form_name + "_form_has_data"))))
+
+    with transaction.atomic():
+        PatientFormProgress.objects.filter(registry=registry_model).filter(keys).delete()
+        PatientFormProgress.objects.bulk_create(rows)
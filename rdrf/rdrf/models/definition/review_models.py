@@ -356,23 +356,24 @@ class ReviewItem(models.Model):
     def _add_multisection_data(self, patient_model, context_model, form_data, user):
         pass
 
-    def get_data(self, patient_model, context_model, raw=False):
+    def get_data(self, patient_model, context_model, raw=False, data=None):
         # get previous responses so they can be displayed
+        # data: the patient's flattened cdes data if already loaded
 
         if self.item_type == ReviewItemTypes.CONSENT_FIELD:
             return self._get_consent_data(patient_model, raw=raw)
         elif self.item_type == ReviewItemTypes.DEMOGRAPHICS_FIELD:
             return self._get_demographics_data(patient_model, raw=raw)
         elif self.item_type == ReviewItemTypes.SECTION_CHANGE:
-            return self._get_section_data(patient_model, context_model, raw=raw)
+            return self._get_section_data(patient_model, context_model, raw=raw, data=data)
         elif self.item_type == ReviewItemTypes.MULTI_TARGET:
-            return self._get_multitarget_data(patient_model, context_model, raw=raw)
+            return self._get_multitarget_data(patient_model, context_model, raw=raw, data=data)
         elif self.item_type == ReviewItemTypes.VERIFICATION:
-            return self._get_verification_data(patient_model, context_model, raw=raw)
+            return self._get_verification_data(patient_model, context_model, raw=raw, data=data)
 
         raise Exception("Unknown Review Type: %s" % self.item_type)
 
-    def _get_verification_data(self, patient_model, context_model, raw):
+    def _get_verification_data(self, patient_model, context_model, raw, data=None):
         if raw:
             if self.fields:
                 use_fields = True
@@ -384,7 +385,8 @@ class ReviewItem(models.Model):
             return self._get_section_data(patient_model,
                                           context_model,
                                           raw,
-                                          use_fields=use_fields)
+                                          use_fields=use_fields,
+                                          data=data)
         else:
             return []
 
@@ -460,17 +462,18 @@ class ReviewItem(models.Model):
     def _get_demographics_fields(self, patient_model, raw):
         return []
 
-    def _get_section_data(self, patient_model, context_model, raw=False, use_fields=False):
+    def _get_section_data(self, patient_model, context_model, raw=False, use_fields=False, data=None):
         # we need raw values for initial data
         # display values for the read only
         if self.section:
             assert not self.section.allow_multiple
 
         pairs = []
-        data = patient_model.get_dynamic_data(self.review.registry,
-                                              collection="cdes",
-                                              context_id=context_model.pk,
-                                              flattened=True)
+        if data is None:
+            data = patient_model.get_dynamic_data(self.review.registry,
+                                                  collection="cdes",
+                                                  context_id=context_model.pk,
+                                                  flattened=True)
         if raw:
             if use_fields:
                 allowed_cde_codes = [x.strip() for x in self.fields.strip().split(",")]
@@ -552,12 +555,13 @@ class ReviewItem(models.Model):
 
         return pairs
 
-    def _get_multitarget_data(self, patient_model, context_model, raw=False):
+    def _get_multitarget_data(self, patient_model, context_model, raw=False, data=None):
         pairs = []
-        data = patient_model.get_dynamic_data(self.review.registry,
-                                              collection="cdes",
-                                              context_id=context_model.pk,
-                                              flattened=True)
+        if data is None:
+            data = patient_model.get_dynamic_data(self.review.registry,
+                                                  collection="cdes",
+                                                  context_id=context_model.pk,
+                                                  flattened=True)
 
         for form_model, section_model, cde_model in self.multitargets:
             try:
@@ -724,25 +728,30 @@ class PatientReview(models.Model):
 
     def _get_initial_data(self):
         d = {}
+        # the record is loaded once for every item of the review
+        data = self.patient.get_dynamic_data(self.review.registry,
+                                             collection="cdes",
+                                             context_id=self.context.pk,
+                                             flattened=True)
         for item_index, review_item in enumerate(self.review.items.all().order_by("id")):
-            d[str(item_index)] = self._get_initial_data_for_review_item(review_item)
+            d[str(item_index)] = self._get_initial_data_for_review_item(review_item, data)
         return d
 
-    def _get_initial_data_for_review_item(self, review_item):
+    def _get_initial_data_for_review_item(self, review_item, data=None):
         d = {}
         d["metadata_condition_changed"] = ConditionStates.UNKNOWN
         if review_item.item_type in [ReviewItemTypes.SECTION_CHANGE]:
             d["metadata_current_status"] = ConditionStates.UNKNOWN
 
         # get initial filled in data from rdrf form
-        self._load_initial_form_data_for_review_item(review_item, d)
+        self._load_initial_form_data_for_review_item(review_item, d, data)
         return d
 
-    def _load_initial_form_data_for_review_item(self, review_item, data_dict):
+    def _load_initial_form_data_for_review_item(self, review_item, data_dict, data=None):
         # update data_dict
         patient_model = self.patient
         context_model = self.context
-        review_item_data = review_item.get_data(patient_model, context_model, raw=True)
+        review_item_data = review_item.get_data(patient_model, context_model, raw=True, data=data)
         data_dict.update(review_item_data)
 
 
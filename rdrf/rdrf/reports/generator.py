@@ -3,22 +3,34 @@ from sqlalchemy import create_engine, MetaData
 from django.conf import settings
 from rdrf.models.definition.models import ContextFormGroup
 from rdrf.models.definition.models import CommonDataElement
-from rdrf.models.definition.models import ClinicalData
+from rdrf.models.definition.models import ClinicalData, DefinitionVersion, RDRFContext
 from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.history import is_delta
 from rdrf.forms.progress.form_progress import FormProgress
 from rdrf.helpers.utils import cached
 from registry.patients.models import Patient
 import logging
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max
+from datetime import timedelta
 import re
-from functools import lru_cache
 from operator import attrgetter
 
 logger = logging.getLogger(__name__)
 
 MAX_TABLE_NAME_LENGTH = 63
 
+# one row per registry recording what the reporting tables were last built from
+REFRESH_TABLE_NAME = "rdrf_reporting_refresh"
+
+# (patient, context) pairs extracted per clinical data query and reporting db transaction
+REFRESH_BATCH_SIZE = 200
+
+# a record saved in a transaction which commits after the watermark is taken
+# has an older last_updated - refresh looks back this far before the watermark
+REFRESH_WATERMARK_MARGIN = timedelta(minutes=10)
+
 
 def unambigious_name(section_code, cde_code):
     return no_space_lower(section_code + "_" + cde_code)
@@ -121,18 +133,36 @@ def nice_name(s):
     return nice
 
 
-@lru_cache(maxsize=100)
-def get_clinical_data(registry_code, patient_id, context_id):
-    patient_model = Patient.objects.get(pk=patient_id)
-    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
-    return wrapper.load_dynamic_data(registry_code, "cdes")
+class ClinicalDataCache(object):
+    """
+    The clinical data of the (patient, context) pairs being extracted.
+    Loaded a batch at a time with DynamicDataWrapper.load_batch instead
+    of a query per pair per table.
+    """
+
+    def __init__(self, registry_code):
+        self.registry_code = registry_code
+        self.batch = {}
+
+    def load(self, patient_contexts):
+        self.batch = DynamicDataWrapper.load_batch(self.registry_code, patient_contexts)
+
+    def clear(self):
+        self.batch = {}
+
+    def _get_batch(self, key):
+        if key not in self.batch:
+            # not part of the loaded batch
+            self.load([key])
+        return self.batch
 
+    def get_clinical_data(self, patient_id, context_id):
+        key = (patient_id, context_id)
+        return self._get_batch(key).flattened(key)
 
-@lru_cache(maxsize=100)
-def get_nested_clinical_data(registry_code, patient_id, context_id):
-    patient_model = Patient.objects.get(pk=patient_id)
-    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
-    return wrapper.load_dynamic_data(registry_code, "cdes", flattened=False)
+    def get_nested_clinical_data(self, patient_id, context_id):
+        key = (patient_id, context_id)
+        return self._get_batch(key)[key]
 
 
 class DataSource:
@@ -142,13 +172,15 @@ class DataSource:
                  form_model=None,
                  section_model=None,
                  cde_model=None,
-                 field=None):
+                 field=None,
+                 clinical_data=None):
         self.registry_model = registry_model
+        self.clinical_data = clinical_data or ClinicalDataCache(registry_model.code)
         self.column = column
         self.form_model = form_model
         self.section_model = section_model
         self.form_progress = FormProgress(self.registry_model)
-        self.progress_percentage = None
+        self.progress_percentages = {}
         if self.section_model:
             self.is_multiple = section_model.allow_multiple
         else:
@@ -191,11 +223,12 @@ class DataSource:
             raise Exception("Unknown field: %s" % self.field)
 
     def _get_form_progress(self, patient_model, context_model):
-        if self.progress_percentage is None:
-            self.progress_percentage = self.form_progress.get_form_progress(self.form_model,
-                                                                            patient_model,
-                                                                            context_model)
-        return self.progress_percentage
+        key = (patient_model.pk, context_model.pk)
+        if key not in self.progress_percentages:
+            self.progress_percentages[key] = self.form_progress.get_form_progress(self.form_model,
+                                                                                  patient_model,
+                                                                                  context_model)
+        return self.progress_percentages[key]
 
     def _get_last_user(self, patient_model, context_model):
         # last user to edit the _form_ in this context
@@ -205,8 +238,9 @@ class DataSource:
         snapshots = sorted([s for s in snapshots],
                            key=attrgetter("pk"), reverse=True)
         for snapshot in snapshots:
-            if snapshot.data and "record" in snapshot.data:
-                record = snapshot.data["record"]
+            if snapshot.data and ("record" in snapshot.data or is_delta(snapshot.data)):
+                # delta encoded snapshots carry the context id at the top level
+                record = snapshot.data.get("record", snapshot.data)
                 if "context_id" in record:
                     if context_model.pk == record["context_id"]:
                         if "form_name" in snapshot.data:
@@ -217,9 +251,7 @@ class DataSource:
 
     def _get_cde_value(self, patient_model, context_model):
         try:
-            data = get_clinical_data(self.registry_model.code,
-                                     patient_model.pk,
-                                     context_model.pk)
+            data = self.clinical_data.get_clinical_data(patient_model.pk, context_model.pk)
 
             raw_value = patient_model.get_form_value(self.registry_model.code,
                                                      self.form_model.name,
@@ -266,7 +298,8 @@ def get_column_type(cde_model):
 
 
 class Column:
-    def __init__(self, registry_model, form_model, section_model, cde_model, column_map, code_map=None):
+    def __init__(self, registry_model, form_model, section_model, cde_model, column_map, code_map=None,
+                 clinical_data=None):
         self.registry_model = registry_model
         self.form_model = form_model
         self.section_model = section_model
@@ -274,6 +307,8 @@ class Column:
         self.in_multisection = section_model.allow_multiple
         self.column_map = column_map  # ref to global map
         self.column_name_prefix = None
+        # shared with the generator so that a batch of records is loaded once for every column
+        self.clinical_data = clinical_data
 
         if code_map is not None:
             code_count = code_map.get(self.cde_model.code, 0)
@@ -303,7 +338,8 @@ class Column:
                                 column=column,
                                 form_model=self.form_model,
                                 section_model=self.section_model,
-                                cde_model=self.cde_model)
+                                cde_model=self.cde_model,
+                                clinical_data=self.clinical_data)
 
         self.column_map[column] = datasource
         return column
@@ -330,16 +366,16 @@ class ClinicalTable:
 
 
 class MultiSectionExtractor:
-    def __init__(self, registry_model, clinical_table, datasources):
+    def __init__(self, registry_model, clinical_table, datasources, clinical_data):
         self.registry_model = registry_model
         self.clinical_table = clinical_table
         self.datasources = datasources
+        self.clinical_data = clinical_data
 
     def get_rows(self, patient_model, context_model):
 
-        nested_clinical_data = get_nested_clinical_data(self.registry_model.code,
-                                                        patient_model.pk,
-                                                        context_model.pk)
+        nested_clinical_data = self.clinical_data.get_nested_clinical_data(patient_model.pk,
+                                                                           context_model.pk)
 
         items_list = patient_model.evaluate_field_expression(self.registry_model,
                                                              self.field_expression,
@@ -402,6 +438,7 @@ class Generator:
         self.table_list = []
         self.clinical_tables = []
         self.column_map = {}
+        self.clinical_data = ClinicalDataCache(registry_model.code)
 
         if db == "clinical":
             self.reporting_engine = self.clinical_engine
@@ -423,7 +460,8 @@ class Generator:
                                 form_model=form_model,
                                 section_model=section_model,
                                 cde_model=cde_model,
-                                field=field)
+                                field=field,
+                                clinical_data=self.clinical_data)
 
         self.column_map[column] = datasource
         return column
@@ -448,9 +486,9 @@ class Generator:
         table.create(dest_engine)
         rows = src_engine.execute(table.select()).fetchall()
 
-        with dest_engine.begin() as con:
-            for row in rows:
-                con.execute(table.insert().values(**row))
+        if rows:
+            with dest_engine.begin() as con:
+                con.execute(table.insert(), [dict(row) for row in rows])
 
     def clear(self):
         # drop tables etc
@@ -550,15 +588,168 @@ class Generator:
         self._copy_table_data(source_engine, target_engine, table)
 
     def create_tables(self):
+        self._clear_caches()
+        definition_version = DefinitionVersion.current()
+        # taken before extracting so that changes made meanwhile are picked up by refresh
+        watermark = self._get_clinical_data_watermark()
+
+        if self.reporting_engine is not self.default_engine:
+            self._create_demographic_tables()
+
+        self._create_clinical_tables(create=True)
+        self._extract_clinical_data()
+        self._save_refresh_state(watermark, definition_version)
+
+    def refresh(self):
+        """
+        Incremental version of create_tables: only the (patient, context) pairs
+        whose clinical data changed since the last run are re-extracted. The rows
+        of deleted patients and contexts are removed, and new contexts and contexts
+        whose record was deleted get the rows create_tables gives them.
+        Falls back to create_tables if there is no previous run or the
+        registry definition ( and so the table layout ) has changed.
+        """
+        self._clear_caches()
+        definition_version = DefinitionVersion.current()
+        state = self._get_refresh_state()
+        if state is None or state["definition_version"] != definition_version:
+            logger.info("Rebuilding reporting tables for %s" % self.registry_model.code)
+            return self.create_tables()
+
+        self._create_clinical_tables(create=False)
+        if not all(self.reporting_engine.has_table(t.table.name) for t in self.clinical_tables):
+            return self.create_tables()
+
+        watermark = self._get_clinical_data_watermark()
+
         if self.reporting_engine is not self.default_engine:
             self._create_demographic_tables()
 
+        patient_contexts = set(self._get_patient_contexts())
+        extracted = self._get_extracted_contexts()
+        removed = sorted(extracted - patient_contexts)
+        logger.info("Removing %s contexts for %s" % (len(removed), self.registry_model.code))
+        for i in range(0, len(removed), REFRESH_BATCH_SIZE):
+            self._delete_contexts(removed[i:i + REFRESH_BATCH_SIZE])
+
+        # contexts without a record are extracted again too - their record may have been
+        # deleted, and there is no clinical data to load for them
+        without_records = patient_contexts - self._get_record_contexts()
+        changed = self._get_changed_contexts(state["clinical_data_updated"], patient_contexts)
+        changed = sorted(changed.union(patient_contexts - extracted, without_records))
+        logger.info("Refreshing %s changed contexts for %s" % (len(changed), self.registry_model.code))
+        for i in range(0, len(changed), REFRESH_BATCH_SIZE):
+            self._extract_contexts(changed[i:i + REFRESH_BATCH_SIZE], delete=True)
+
+        self._save_refresh_state(watermark, definition_version)
+
+    def _clear_caches(self):
+        # a generator can be run more than once
+        self.clinical_data.clear()
+        self.clinical_tables = []
+
+    def _clinical_records(self):
+        return ClinicalData.objects.filter(registry_code=self.registry_model.code,
+                                           collection="cdes",
+                                           django_model="Patient")
+
+    def _get_clinical_data_watermark(self):
+        return self._clinical_records().aggregate(watermark=Max("last_updated"))["watermark"]
+
+    def _get_record_contexts(self):
+        # (patient id, context id) of the cdes records - clinical data can be in
+        # another database so this can't be a subquery
+        return set(self._clinical_records().filter(context_id__isnull=False)
+                                           .values_list("django_id", "context_id"))
+
+    def _get_changed_contexts(self, since, patient_contexts):
+        records = self._clinical_records().filter(context_id__isnull=False)
+        if since is not None:
+            # extracting a pair again is harmless, missing a change isn't
+            records = records.filter(last_updated__gte=since - REFRESH_WATERMARK_MARGIN)
+        return set(pair for pair in records.values_list("django_id", "context_id")
+                   if pair in patient_contexts)
+
+    def _get_extracted_contexts(self):
+        # pairs with rows in the reporting tables
+        extracted = set()
+        for clinical_table in self.clinical_tables:
+            table = clinical_table.table
+            query = alc.select([table.c.patient_id, table.c.context_id]).distinct()
+            extracted.update(tuple(pair) for pair in self.reporting_engine.execute(query))
+        return extracted
+
+    def _delete_contexts(self, patient_contexts):
+        with self.reporting_engine.begin() as con:
+            for patient_id, context_id in patient_contexts:
+                for clinical_table in self.clinical_tables:
+                    table = clinical_table.table
+                    con.execute(table.delete().where(alc.and_(table.c.patient_id == patient_id,
+                                                              table.c.context_id == context_id)))
+
+    def _extract_contexts(self, patient_contexts, delete=False):
+        """
+        Writes the rows of a batch of (patient id, context id) pairs to every
+        clinical table, replacing any existing rows of the pairs if delete is True
+        """
+        self.clinical_data.load(patient_contexts)
+        patient_map = Patient.objects.in_bulk(set(patient_id for patient_id, _ in patient_contexts))
+        context_map = RDRFContext.objects.select_related("context_form_group").in_bulk(
+            set(context_id for _, context_id in patient_contexts))
+
+        with self.reporting_engine.begin() as con:
+            for patient_id, context_id in patient_contexts:
+                patient_model = patient_map.get(patient_id)
+                context_model = context_map.get(context_id)
+                for clinical_table in self.clinical_tables:
+                    table = clinical_table.table
+                    if delete:
+                        con.execute(table.delete().where(alc.and_(table.c.patient_id == patient_id,
+                                                                  table.c.context_id == context_id)))
+                    if patient_model is None or context_model is None:
+                        continue
+                    if context_model.registry_id != self.registry_model.id:
+                        continue
+                    if not in_context(context_model, clinical_table):
+                        continue
+                    # executemany needs the same keys in every row
+                    column_names = [column.name for column in table.columns]
+                    rows = [{name: row.get(name) for name in column_names}
+                            for row in self._get_rows(clinical_table, patient_model, context_model)]
+                    if rows:
+                        con.execute(table.insert(), rows)
+
+    def _refresh_table(self):
+        return alc.Table(REFRESH_TABLE_NAME,
+                         MetaData(self.reporting_engine),
+                         alc.Column("registry_code", alc.String, primary_key=True),
+                         alc.Column("clinical_data_updated", alc.DateTime, nullable=True),
+                         alc.Column("definition_version", alc.Integer, nullable=False))
+
+    def _get_refresh_state(self):
+        table = self._refresh_table()
+        if not self.reporting_engine.has_table(table.name):
+            return None
+        row = self.reporting_engine.execute(
+            table.select().where(table.c.registry_code == self.registry_model.code)).first()
+        return dict(row) if row else None
+
+    def _save_refresh_state(self, watermark, definition_version):
+        table = self._refresh_table()
+        table.create(self.reporting_engine, checkfirst=True)
+        with self.reporting_engine.begin() as con:
+            con.execute(table.delete().where(table.c.registry_code == self.registry_model.code))
+            con.execute(table.insert().values(registry_code=self.registry_model.code,
+                                              clinical_data_updated=watermark,
+                                              definition_version=definition_version))
+
+    def _create_clinical_tables(self, create=True):
         for form_model in self.registry_model.forms:
             if form_model.name.startswith("GeneratedQuestionnaire"):
                 continue
 
             columns = self._create_form_columns(form_model)
-            table = self._create_table(form_model.name, columns)
+            table = self._create_table(form_model.name, columns, create)
 
             single_form_table = ClinicalTable(TableType.CLINICAL_FORM,
                                               table,
@@ -580,7 +771,7 @@ class Generator:
                     if "!" in table_name:
                         table_name = table_name.replace("!", "")
 
-                    table = self._create_table(table_name, columns)
+                    table = self._create_table(table_name, columns, create)
                     multisection_table = ClinicalTable(TableType.MULTISECTION,
                                                        table,
                                                        columns,
@@ -589,48 +780,39 @@ class Generator:
 
                     self.clinical_tables.append(multisection_table)
 
-        self._extract_clinical_data()
-
     @property
     def patients(self):
         return Patient.objects.filter(rdrf_registry__in=[self.registry_model])
 
     def _extract_clinical_data(self):
-        form_tables = [
-            t for t in self.clinical_tables if not t.is_multisection]
-        multi_tables = [t for t in self.clinical_tables if t.is_multisection]
-        for clinical_table in form_tables:
-            row_count = 0
-            datasources = [self.column_map[column]
-                           for column in clinical_table.columns]
-            for patient_model in self.patients:
-                for context_model in patient_model.context_models:
-                    if context_model.registry.id == self.registry_model.id:
-                        if in_context(context_model, clinical_table):
-                            row = {ds.column_name: ds.get_value(
-                                patient_model, context_model) for ds in datasources}
-                            self.reporting_engine.execute(
-                                clinical_table.table.insert().values(**row))
-                            row_count += 1
-
-        for clinical_table in multi_tables:
-            row_count = 0
+        patient_contexts = self._get_patient_contexts()
+        for i in range(0, len(patient_contexts), REFRESH_BATCH_SIZE):
+            self._extract_contexts(patient_contexts[i:i + REFRESH_BATCH_SIZE])
+
+    def _get_patient_contexts(self):
+        # the registry's contexts of each patient
+        content_type = ContentType.objects.get_for_model(Patient)
+        patient_ids = list(self.patients.values_list("id", flat=True))
+        contexts = RDRFContext.objects.filter(registry=self.registry_model,
+                                              content_type=content_type,
+                                              object_id__in=patient_ids)
+        return list(contexts.order_by("object_id", "created_at").values_list("object_id", "id"))
+
+    def _get_rows(self, clinical_table, patient_model, context_model):
+        datasources = [self.column_map[column]
+                       for column in clinical_table.columns]
+        if not clinical_table.is_multisection:
+            yield {ds.column_name: ds.get_value(
+                patient_model, context_model) for ds in datasources}
+        else:
             current_column_names = set(
                 [col.name for col in clinical_table.table.columns])
-            datasources = [self.column_map[column]
-                           for column in clinical_table.columns]
             multisection_extractor = MultiSectionExtractor(
-                self.registry_model, clinical_table, datasources)
-            for patient_model in self.patients:
-                for context_model in patient_model.context_models:
-                    if context_model.registry.id == self.registry_model.id:
-                        if in_context(context_model, clinical_table):
-                            for item_row in multisection_extractor.get_rows(
-                                    patient_model, context_model):
-                                self._clean_row(item_row, current_column_names)
-                                self.reporting_engine.execute(
-                                    clinical_table.table.insert().values(**item_row))
-                                row_count += 1
+                self.registry_model, clinical_table, datasources, self.clinical_data)
+            for item_row in multisection_extractor.get_rows(
+                    patient_model, context_model):
+                self._clean_row(item_row, current_column_names)
+                yield item_row
 
     def _clean_row(self, row, current_column_names):
         bad_keys = set(row.keys()) - current_column_names
@@ -647,7 +829,8 @@ class Generator:
                                form_model,
                                section_model,
                                cde_model,
-                               self.column_map).postgres
+                               self.column_map,
+                               clinical_data=self.clinical_data).postgres
                         for cde_model in section_model.cde_models])
         return columns
 
@@ -663,7 +846,8 @@ class Generator:
                                section_model,
                                cde_model,
                                self.column_map,
-                               code_map).postgres for section_model in form_model.section_models
+                               code_map,
+                               clinical_data=self.clinical_data).postgres for section_model in form_model.section_models
                         for cde_model in section_model.cde_models
                         if not section_model.allow_multiple])
         return columns
@@ -671,15 +855,17 @@ class Generator:
     def _get_table_name(self, name):
         return no_space_lower(name)
 
-    def _create_table(self, table_code, columns):
+    def _create_table(self, table_code, columns, create=True):
         table_name = self._get_table_name(table_code)
         if "!" in table_name:
             table_name = table_name.replace("!", "")
 
-        self._drop_table(table_name)
+        if create:
+            self._drop_table(table_name)
         table = alc.Table(table_name, MetaData(
             self.reporting_engine), *columns, schema=None)
-        table.create()
+        if create:
+            table.create()
         # these cause failures in migration ...
         return table
 
@@ -1,9 +1,14 @@
-from django.http import HttpResponse
-from rdrf.models.definition.models import RegistryForm
-from rdrf.models.definition.models import Section
-from rdrf.models.definition.models import CommonDataElement
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.expressions import RawSQL
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
+from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.models.definition.models import ConsentQuestion
 from rdrf.models.definition.models import ContextFormGroup
 from rdrf.models.definition.models import ClinicalData
+from rdrf.models.definition.models import RDRFContext
 from rdrf.helpers.utils import cde_completed
 from rdrf.helpers.utils import format_date
 from registry.patients.models import Patient
@@ -13,6 +18,9 @@ import csv
 
 logger = logging.getLogger(__name__)
 
+# patients whose contexts, clinical data and consents are loaded together
+BATCH_SIZE = 500
+
 
 class SecurityException(Exception):
     pass
@@ -55,9 +63,16 @@ def get_timestamp(clinical_data):
 
 
 class ReportGenerator:
+    """
+    Resolves the report spec once, then computes the rows a batch of patients
+    at a time from contexts, clinical data, consents and follow up timestamps
+    loaded with a few queries per batch.
+    """
+
     def __init__(self, registry_model, report_name, report_spec, user):
         import json
         self.registry_model = registry_model
+        self.registry_graph = get_registry_graph(registry_model)
         self.report_name = report_name
         self.report_spec = json.loads(report_spec)
         self.user = user
@@ -73,18 +88,15 @@ class ReportGenerator:
         writer.writerows(self.report)
         return stream
 
-    def _get_context(self, patient_model):
-        # get the fixed context associated with the context
-        # form group specified in the report spec.
-        # there should only be one for each patient
-        context_models = patient_model.context_models
-        return self._get_fixed_context(context_models)
-
-    def _get_fixed_context(self, context_models):
-        for context_model in context_models:
-            if context_model.context_form_group:
-                if context_model.context_form_group.pk == self.context_form_group.pk:
-                    return context_model
+    def stream_csv(self):
+        """
+        :return: generator of the csv lines of the report - a bad spec raises
+        here, before anything is sent
+        """
+        self._security_check()
+        columns = self._resolve_columns()
+        writer = csv.writer(_EchoBuffer())
+        return (writer.writerow(row) for row in self._iter_rows(columns))
 
     def _get_context_form_group(self):
         if "context_form_group" in self.report_spec:
@@ -102,32 +114,31 @@ class ReportGenerator:
         return self._run_report()
 
     def _run_report(self):
-        rows = []
-        rows.append(self._get_header())
-        for patient_model in self._get_patients():
-            try:
-                logger.info("getting data for patient %s" % patient_model.pk)
-                # the context needs to be determined by the report spec
-                # as it contains the context_form_group name
-                context_model = self._get_context(patient_model)
-                if not context_model:
-                    logger.info("no context - skipping")
-                    continue
-                logger.info("context id = %s" % context_model.id)
-                data = self._load_patient_data(patient_model, context_model.id)
-                if not data:
-                    logger.info("no data")
-                else:
-                    logger.info("data exists")
-                    row = []
-                    for column in self.report_spec["columns"]:
-                        column_value = "" if not data else self._get_column_value(patient_model, data, column)
-                        row.append(column_value)
-                    rows.append(row)
-            except Exception as ex:
-                logger.error("Completion report error pid %s: %s" % (patient_model.pk,
-                                                                     ex))
-        self.report = rows
+        self.report = list(self._iter_rows(self._resolve_columns()))
+
+    def _resolve_columns(self):
+        return [self._resolve_column(column) for column in self.report_spec["columns"]]
+
+    def _iter_rows(self, columns):
+        yield self._get_header()
+        patient_ids = list(self._get_patients().values_list("pk", flat=True))
+        for start in range(0, len(patient_ids), BATCH_SIZE):
+            patients = Patient.objects.filter(pk__in=patient_ids[start:start + BATCH_SIZE]).order_by("pk")
+            batch = ReportBatch(self, list(patients))
+            for patient_model in batch.patients:
+                try:
+                    context_model = batch.get_context(patient_model)
+                    if not context_model:
+                        logger.info("no context for patient %s - skipping" % patient_model.pk)
+                        continue
+                    data = batch.data[(patient_model.pk, context_model.pk)]
+                    if not data:
+                        logger.info("no data for patient %s" % patient_model.pk)
+                        continue
+                    yield [column(patient_model, data, batch) for column in columns]
+                except Exception as ex:
+                    logger.error("Completion report error pid %s: %s" % (patient_model.pk,
+                                                                         ex))
 
     def _get_header(self):
         def header(col):
@@ -136,109 +147,93 @@ class ReportGenerator:
             return col["name"]
         return [header(col) for col in self.report_spec["columns"]]
 
-    def _get_column_value(self, patient_model, data, column):
+    def _resolve_column(self, column):
+        """
+        :return: function(patient_model, data, batch) returning the column value
+        """
         column_type = column["type"]
         if column_type == ColumnType.DEMOGRAPHICS:
             column_name = column["name"]
-            return self._get_demographics_column(patient_model, column_name)
-        if column_type == ColumnType.COMPLETION:
-            form_name = column["name"]
-            return self._completed(patient_model, form_name, data)
-        if column_type == ColumnType.COMPLETION_PERCENTAGE:
-            form_name = column["name"]
-            return self._completed(patient_model, form_name, data, percentage=True)
+            return lambda patient_model, data, batch: self._get_demographics_column(patient_model, column_name)
+        if column_type in (ColumnType.COMPLETION, ColumnType.COMPLETION_PERCENTAGE):
+            form_model = self._get_form_model(column["name"])
+            completion_cdes = [(section_model, cde_model)
+                               for section_model in self.registry_graph.section_models(form_model)
+                               if not section_model.allow_multiple
+                               for cde_model in self.registry_graph.cde_models(section_model)]
+            percentage = column_type == ColumnType.COMPLETION_PERCENTAGE
+            return lambda patient_model, data, batch: self._completed(patient_model, form_model, completion_cdes,
+                                                                      data, percentage)
         if column_type == ColumnType.CDE:
-            cde_path = column["name"]
-            try:
-                return self._get_cde(patient_model, cde_path, data)
-            except KeyError:
-                return "[Not Entered]"
-        if column_type == ColumnType.CONSENT:
-            consent_section_code, consent_code = column["name"].split("/")
-            return self._get_consent(patient_model,
-                                     consent_section_code,
-                                     consent_code)
-        if column_type == ColumnType.CONSENT_DATE:
+            cde_models = self._get_cde_models(column["name"])
+
+            def cde_value(patient_model, data, batch):
+                try:
+                    return self._get_cde(patient_model, cde_models, data)
+                except KeyError:
+                    return "[Not Entered]"
+            return cde_value
+        if column_type in (ColumnType.CONSENT, ColumnType.CONSENT_DATE):
             consent_section_code, consent_code = column["name"].split("/")
-            return self._get_consent(patient_model,
-                                     consent_section_code,
-                                     consent_code,
-                                     get_date=True)
+            question = self._get_consent_question(consent_section_code, consent_code)
+            get_date = column_type == ColumnType.CONSENT_DATE
+            return lambda patient_model, data, batch: self._get_consent(patient_model, question, batch, get_date)
         if column_type == ColumnType.FOLLOWUP_DATE:
-            context_form_group_name = column["context_form_group"]
-            form_name = column["name"]
-            return self._get_followup_date(patient_model,
-                                           context_form_group_name,
-                                           form_name)
+            cfg = ContextFormGroup.objects.get(registry=self.registry_model,
+                                               name=column["context_form_group"])
+            return lambda patient_model, data, batch: self._get_followup_date(patient_model, cfg, batch)
         else:
             raise ReportParserException("Unknown column type: %s" % column_type)
 
-    def _get_followup_date(self,
-                           patient_model,
-                           context_form_group_name,
-                           form_name):
-        from rdrf.models.definition.models import ContextFormGroup
-        cfg = ContextFormGroup.objects.get(registry=self.registry_model,
-                                           name=context_form_group_name)
-        # find the last/latest context containing the form
-        context_models = [c for c in patient_model.context_models
-                          if c.registry.pk == self.registry_model.pk and c.context_form_group and c.context_form_group.pk == cfg.pk]
-        if not context_models:
-            return ""
-        latest_date = None
-        for context_model in context_models:
-            # get the associated clinical data and check the timestamp
-            try:
-                clinical_data = ClinicalData.objects.get(context_id=context_model.pk,
-                                                         django_model="Patient",
-                                                         collection="cdes",
-                                                         django_id=patient_model.pk)
-                timestamp = get_timestamp(clinical_data)
-                if latest_date is None or timestamp > latest_date:
-                    latest_date = timestamp
-            except ClinicalData.DoesNotExist:
-                pass
-        if latest_date is None:
-            return ""
-        return format_date(latest_date)
-
-    def _get_consent(self,
-                     patient_model,
-                     consent_section_code,
-                     consent_code,
-                     get_date=False):
-        for consent_section in self.registry_model.consent_sections.all():
-            if consent_section.code == consent_section_code:
-                for consent_question in consent_section.questions.all():
-                    if consent_question.code == consent_code:
-                        try:
-                            consent_value = ConsentValue.objects.get(patient=patient_model,
-                                                                     consent_question=consent_question)
-                            if get_date:
-                                first_save = consent_value.first_save
-                                last_update = consent_value.last_update
-                                if not last_update:
-                                    return format_date(first_save)
-                                return format_date(last_update)
-                            return "True" if consent_value else "False"
-                        except ConsentValue.DoesNotExist:
-                            if get_date:
-                                return ""
-                            return "False"
-        if get_date:
-            return ""
-        return "False"
+    def _get_form_model(self, form_name):
+        form_model = self.registry_graph.form(form_name)
+        if form_model is None:
+            raise ReportParserException("Report form %s not found" % form_name)
+        return form_model
 
-    def _get_cde(self, patient_model, cde_path, data):
+    def _get_cde_models(self, cde_path):
         if "/" in cde_path:
             form_name, section_code, cde_code = cde_path.split("/")
-            form_model = RegistryForm.objects.get(name=form_name,
-                                                  registry=self.registry_model)
-            section_model = Section.objects.get(code=section_code)
-            cde_model = CommonDataElement.objects.get(code=cde_code)
-        else:
-            form_model, section_model, cde_model = self._find_cde(cde_path)
-
+            section_model = self.registry_graph.section(section_code)
+            cde_model = self.registry_graph.cde(cde_code)
+            if section_model is None or cde_model is None:
+                raise ReportParserException("Report cde %s not found" % cde_path)
+            return self._get_form_model(form_name), section_model, cde_model
+        return self._find_cde(cde_path)
+
+    def _get_consent_question(self, consent_section_code, consent_code):
+        return ConsentQuestion.objects.filter(section__registry=self.registry_model,
+                                              section__code=consent_section_code,
+                                              code=consent_code).first()
+
+    def _get_followup_date(self, patient_model, cfg, batch):
+        # the last/latest context containing the form
+        timestamps = [batch.timestamps.get(context_model.pk)
+                      for context_model in batch.contexts[patient_model.pk]
+                      if context_model.context_form_group_id == cfg.pk]
+        timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+        if not timestamps:
+            return ""
+        return format_date(max(timestamps))
+
+    def _get_consent(self, patient_model, consent_question, batch, get_date=False):
+        consent_value = None
+        if consent_question is not None:
+            consent_value = batch.consent_values.get((patient_model.pk, consent_question.pk))
+        if consent_value is None:
+            if get_date:
+                return ""
+            return "False"
+        if get_date:
+            first_save = consent_value.first_save
+            last_update = consent_value.last_update
+            if not last_update:
+                return format_date(first_save)
+            return format_date(last_update)
+        return "True"
+
+    def _get_cde(self, patient_model, cde_models, data):
+        form_model, section_model, cde_model = cde_models
         context_id = data["context_id"]
         raw_value = patient_model.get_form_value(self.registry_model.code,
                                                  form_model.name,
@@ -259,9 +254,9 @@ class ReportGenerator:
         return display_value
 
     def _find_cde(self, cde_code):
-        for form_model in self.registry_model.forms:
-            for section_model in form_model.section_models:
-                for cde_model in section_model.cde_models:
+        for form_model in self.registry_graph.forms:
+            for section_model in self.registry_graph.section_models(form_model):
+                for cde_model in self.registry_graph.cde_models(section_model):
                     if cde_model.code == cde_code:
                         return form_model, section_model, cde_model
 
@@ -277,59 +272,120 @@ class ReportGenerator:
                 return transform[raw_value]
             return transform(raw_value)
 
-    def _load_patient_data(self, patient_model, context_id):
-        return patient_model.get_dynamic_data(self.registry_model,
-                                              context_id=context_id)
-
-    def _completed(self, patient_model, form_name, data, percentage=False):
-        form_model = RegistryForm.objects.get(name=form_name,
-                                              registry=self.registry_model)
+    def _completed(self, patient_model, form_model, completion_cdes, data, percentage=False):
         if not percentage:
-            for section_model in form_model.section_models:
-                if not section_model.allow_multiple:
-                    for cde_model in section_model.cde_models:
-                        if not cde_completed(self.registry_model,
-                                             form_model,
-                                             section_model,
-                                             cde_model,
-                                             patient_model,
-                                             data):
-                            return False
-            return True
-        # percentage
-        num_cdes = 0.0
-        num_completed = 0.0
-        for section_model in form_model.section_models:
-            if not section_model.allow_multiple:
-                for cde_model in section_model.cde_models:
-                    num_cdes += 1.0
-                    if cde_completed(self.registry_model,
+            for section_model, cde_model in completion_cdes:
+                if not cde_completed(self.registry_model,
                                      form_model,
                                      section_model,
                                      cde_model,
                                      patient_model,
                                      data):
-                        num_completed += 1.0
+                    return False
+            return True
+        # percentage
+        num_cdes = 0.0
+        num_completed = 0.0
+        for section_model, cde_model in completion_cdes:
+            num_cdes += 1.0
+            if cde_completed(self.registry_model,
+                             form_model,
+                             section_model,
+                             cde_model,
+                             patient_model,
+                             data):
+                num_completed += 1.0
         value = 100.0 * (num_completed / num_cdes)
         return round(value, 0)
 
     def _get_patients(self):
         user_working_groups = self.user.working_groups.all()
-
-        for patient_model in Patient.objects.filter(rdrf_registry__code__in=[self.registry_model.code],
-                                                    working_groups__in=user_working_groups):
-            yield patient_model
+        return Patient.objects.filter(rdrf_registry__code__in=[self.registry_model.code],
+                                      working_groups__in=user_working_groups).distinct().order_by("pk")
 
     def _security_check(self):
         if not self.user.in_registry(self.registry_model):
             raise SecurityException()
 
 
+class ReportBatch:
+    """
+    The contexts, clinical data, consents and follow up timestamps of a batch of patients
+    """
+
+    def __init__(self, report_generator, patients):
+        self.report_generator = report_generator
+        self.registry_model = report_generator.registry_model
+        self.patients = patients
+        self.patient_ids = [patient_model.pk for patient_model in patients]
+        self.contexts = self._load_contexts(self.patient_ids)
+        self.report_contexts = {patient_model.pk: self._report_context(patient_model) for patient_model in patients}
+        self.data = DynamicDataWrapper.load_batch(self.registry_model.code,
+                                                  [(patient_id, context_model.pk)
+                                                   for patient_id, context_model in self.report_contexts.items()
+                                                   if context_model])
+
+    # consents and timestamps are only loaded if the report has columns which need them
+
+    @cached_property
+    def consent_values(self):
+        return self._load_consent_values(self.patient_ids)
+
+    @cached_property
+    def timestamps(self):
+        return self._load_timestamps(self.patient_ids)
+
+    def _load_contexts(self, patient_ids):
+        contexts = defaultdict(list)
+        for context_model in RDRFContext.objects.filter(registry=self.registry_model,
+                                                        content_type=ContentType.objects.get_for_model(Patient),
+                                                        object_id__in=patient_ids).order_by("created_at"):
+            contexts[context_model.object_id].append(context_model)
+        return contexts
+
+    def _report_context(self, patient_model):
+        # the fixed context of the context form group in the report spec -
+        # there should only be one for each patient
+        cfg = self.report_generator.context_form_group
+        for context_model in self.contexts[patient_model.pk]:
+            if cfg is None or context_model.context_form_group_id == cfg.pk:
+                return context_model
+
+    def get_context(self, patient_model):
+        return self.report_contexts.get(patient_model.pk)
+
+    def _load_consent_values(self, patient_ids):
+        return {(consent_value.patient_id, consent_value.consent_question_id): consent_value
+                for consent_value in ConsentValue.objects.filter(patient_id__in=patient_ids,
+                                                                 consent_question__section__registry=self.registry_model)}
+
+    def _load_timestamps(self, patient_ids):
+        # context id -> timestamp of its cdes record
+        from rdrf.helpers.utils import parse_iso_datetime
+        records = (ClinicalData.objects.collection(self.registry_model.code, "cdes")
+                                       .filter(django_model="Patient", django_id__in=patient_ids)
+                                       .annotate(timestamp=RawSQL("%s.data->>'timestamp'" % ClinicalData._meta.db_table, ()))
+                                       .values_list("context_id", "timestamp"))
+        timestamps = {}
+        for context_id, timestamp in records:
+            if not timestamp:
+                continue
+            timestamp = parse_iso_datetime(timestamp)
+            if context_id not in timestamps or timestamp > timestamps[context_id]:
+                timestamps[context_id] = timestamp
+        return timestamps
+
+
+class _EchoBuffer(object):
+    # lets csv.writer hand back each formatted line instead of buffering it
+    def write(self, value):
+        return value
+
+
 def execute(registry_model, report_name, report_spec, user):
     logger.info("running custom action report %s for %s" % (report_name,
                                                             user.username))
     parser = ReportGenerator(registry_model, report_name, report_spec, user)
-    parser.generate_report()
-    response = HttpResponse(content_type='text/csv')
+    response = StreamingHttpResponse(parser.stream_csv(), content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="Completion Report.csv"'
-    return parser.dump_csv(response)
+    return response
@@ -4,37 +4,39 @@ from .main_importers import ZipFileImporter
 from . import definitions
 
 
-def export_registry(registry_code, filename=None, verbose=False, indented_logs=True):
+def export_registry(registry_code, filename=None, verbose=False, indented_logs=True, **kwargs):
     exporter = RegistryExporter()
     zipfile = exporter.export(
         registry_code,
         filename=filename,
         verbose=verbose,
-        indented_logs=indented_logs)
+        indented_logs=indented_logs,
+        **kwargs)
     return zipfile
 
 
-def export_registry_definition(registry_code, filename=None, verbose=False, indented_logs=True):
+def export_registry_definition(registry_code, filename=None, verbose=False, indented_logs=True, **kwargs):
     exporter = RegistryDefExporter()
     zipfile = exporter.export(
         registry_code,
         filename=filename,
         verbose=verbose,
-        indented_logs=indented_logs)
+        indented_logs=indented_logs,
+        **kwargs)
     return zipfile
 
 
-def export_cdes(filename=None, verbose=False, indented_logs=True):
+def export_cdes(filename=None, verbose=False, indented_logs=True, **kwargs):
     filename = filename or 'exported_CDEs.zip'
     exporter = Exporter.create(definitions.CDE_EXPORT_DEFINITION)
-    zipfile = exporter.export(filename=filename, verbose=verbose, indented_logs=indented_logs)
+    zipfile = exporter.export(filename=filename, verbose=verbose, indented_logs=indented_logs, **kwargs)
     return zipfile
 
 
-def export_refdata(filename=None, verbose=False, indented_logs=True):
+def export_refdata(filename=None, verbose=False, indented_logs=True, **kwargs):
     filename = filename or 'exported_reference_data.zip'
     exporter = Exporter.create(definitions.REFDATA_EXPORT_DEFINITION)
-    zipfile = exporter.export(filename=filename, verbose=verbose, indented_logs=indented_logs)
+    zipfile = exporter.export(filename=filename, verbose=verbose, indented_logs=indented_logs, **kwargs)
     return zipfile
 
 
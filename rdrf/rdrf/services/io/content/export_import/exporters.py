@@ -1,7 +1,13 @@
 from collections import defaultdict, OrderedDict
+from itertools import islice
+import gzip
+import json
+import logging
 import os
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.apps import apps
+from django.db.models.query import QuerySet
 
 from .utils import DelegateMixin
 from .utils import app_schema_version
@@ -9,6 +15,17 @@ from .utils import file_checksum
 from .utils import maybe_indent
 from functools import reduce
 
+logger = logging.getLogger(__name__)
+
+# Model files are written as indented json ( read whole by the importer ) or as
+# gzipped json lines - one serialised object per line, written and read in chunks
+JSON = 'json'
+JSONL_GZ = 'jsonl.gz'
+FORMATS = (JSONL_GZ, JSON)
+
+# objects serialised at a time by the json lines format
+CHUNK_SIZE = 1000
+
 
 class DataGroupExporter(DelegateMixin):
     """Exports a group of data like "Reference Data", "CDEs", etc."""
@@ -42,14 +59,18 @@ class DataGroupExporter(DelegateMixin):
             exporter = self.datagroup_exporters.get(dg)(
                 dg, self.exporters_catalogue, child_logger)
             if exporter.export(**child_context):
-                self.meta['data_groups'].append(exporter.get_meta_info())
+                self.meta['data_groups'].append(exporter)
 
+        # with a worker pool the models of every data group are exported in
+        # parallel, their meta info is collected by get_meta_info
+        pool = child_context.pop('pool', None)
         for model_name in self.models:
-            exporter = self.model_exporters.get(
-                apps.get_model(model_name))(
-                model_name, child_logger)
-            if exporter.export(**child_context):
-                self.meta['models'].append(exporter.get_meta_info())
+            exporter_class = self.model_exporters.get(apps.get_model(model_name))
+            if pool is None:
+                result = ExportedModel(export_model(exporter_class, model_name, child_context, child_logger))
+            else:
+                result = pool.apply_async(export_model, (exporter_class, model_name, child_context))
+            self.meta['models'].append(result)
 
         return True
 
@@ -67,12 +88,14 @@ class DataGroupExporter(DelegateMixin):
             apps = set(map(app_label, models))
             app_versions = {app: app_schema_version(app) for app in apps}
 
+        data_groups = [exporter.get_meta_info() for exporter in self.meta['data_groups']]
+        models = [meta for meta in (result.get() for result in self.meta['models']) if meta]
         return OrderedDict(omit_empty((
             ('name', self.name),
             ('dir_name', self.dirname),
             ('app_versions', app_versions),
-            ('data_groups', self.meta['data_groups']),
-            ('models', self.meta['models']),
+            ('data_groups', data_groups),
+            ('models', models),
         )))
 
     def collect_all_models(self, dfn):
@@ -83,6 +106,27 @@ class DataGroupExporter(DelegateMixin):
         return models
 
 
+class ExportedModel(object):
+    """The meta info of a model exported in this process, read like a pool's AsyncResult"""
+
+    def __init__(self, meta):
+        self.meta = meta
+
+    def get(self):
+        return self.meta
+
+
+def export_model(exporter_class, model_name, context, logger=logger):
+    """
+    Exports one model ( in a worker process when exporting in parallel )
+    :return: the model's meta info or None if nothing was exported
+    """
+    exporter = exporter_class(model_name, logger)
+    if exporter.export(**context):
+        return exporter.get_meta_info()
+    return None
+
+
 class ModelExporter(object):
 
     def __init__(self, model_name, logger):
@@ -92,7 +136,8 @@ class ModelExporter(object):
         self.meta_collector = ModelMetaInfo(self, maybe_indent(logger))
         self.exporter_context = {}
         self.export_finished = False
-        self.format = 'json'
+        self.format = JSON
+        self.object_count = None
 
     @property
     def queryset(self):
@@ -109,17 +154,44 @@ class ModelExporter(object):
     def export(self, **kwargs):
         self.exporter_context = kwargs
         self.workdir = self.exporter_context['workdir']
+        self.format = self.exporter_context.get('format', JSON)
         self.filename = '%s.%s' % (self.model._meta.db_table, self.format)
 
-        with open(self.full_filename, 'w') as out:
-            serializers.serialize(self.format, self.queryset,
-                                  use_natural_primary_keys=True,
-                                  use_natural_foreign_keys=True,
-                                  indent=2,
-                                  stream=out)
+        if self.format == JSONL_GZ:
+            self.export_json_lines()
+        else:
+            with open(self.full_filename, 'w') as out:
+                serializers.serialize(self.format, self.queryset,
+                                      use_natural_primary_keys=True,
+                                      use_natural_foreign_keys=True,
+                                      indent=2,
+                                      stream=out)
         self.export_finished = True
         return True
 
+    def iterate_objects(self):
+        objects = self.queryset
+        if isinstance(objects, QuerySet):
+            chunk_size = self.exporter_context.get('chunk_size', CHUNK_SIZE)
+            objects = objects.order_by('pk').iterator(chunk_size=chunk_size)
+        return iter(objects)
+
+    def export_json_lines(self):
+        chunk_size = self.exporter_context.get('chunk_size', CHUNK_SIZE)
+        objects = self.iterate_objects()
+        self.object_count = 0
+        with gzip.open(self.full_filename, 'wt', encoding='utf-8') as out:
+            while True:
+                chunk = list(islice(objects, chunk_size))
+                if not chunk:
+                    break
+                for obj_dict in serializers.serialize('python', chunk,
+                                                      use_natural_primary_keys=True,
+                                                      use_natural_foreign_keys=True):
+                    out.write(json.dumps(obj_dict, cls=DjangoJSONEncoder))
+                    out.write('\n')
+                self.object_count += len(chunk)
+
     def get_meta_info(self):
         if not self.export_finished:
             raise ValueError(
@@ -151,11 +223,16 @@ class ModelMetaInfo(BaseMetaInfo):
         d = {
             'model_name': self.model_name,
             'model_class': self.full_modelname,
+            'format': self.format,
         }
         d.update(BaseMetaInfo.collect(self))
         return d
 
     def count_objects_in_file(self):
+        if self.object_count is not None:
+            # counted as the objects were written
+            return self.object_count
+
         def count_generator_items(gen):
             return reduce(lambda count, _: count + 1, gen, 0)
 
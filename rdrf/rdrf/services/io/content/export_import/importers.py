@@ -1,9 +1,14 @@
 from functools import wraps
+from itertools import islice
+import gzip
+import json
 import logging
 import os
 from django.core import serializers
 from django.apps import apps
+from django.db.models import signals
 
+from .exporters import CHUNK_SIZE, JSON, JSONL_GZ
 from .utils import file_checksum, maybe_indent
 from .exceptions import ImportError
 
@@ -115,6 +120,10 @@ class ModelImporter(object):
 
         self.check_no_data_in_table(model_name)
 
+        if model_meta.get('format', JSON) == JSONL_GZ:
+            self.import_json_lines(model_name, file_name, object_count, simulate)
+            return
+
         with open(file_name) as f:
             if simulate:
                 # We can't deserialize objects when simulating, because FK
@@ -130,6 +139,36 @@ class ModelImporter(object):
                 actual_object_count += 1
             self.check_object_count(model_name, object_count, actual_object_count)
 
+    def import_json_lines(self, model_name, file_name, object_count, simulate):
+        model = apps.get_model(model_name)
+        bulk = can_bulk_create(model)
+        actual_object_count = 0
+        with gzip.open(file_name, 'rt', encoding='utf-8') as f:
+            while True:
+                lines = list(islice(f, CHUNK_SIZE))
+                if not lines:
+                    break
+                actual_object_count += len(lines)
+                if simulate:
+                    continue
+                objects = list(serializers.deserialize('python', [json.loads(line) for line in lines]))
+                if bulk and not any(obj.m2m_data for obj in objects):
+                    model._base_manager.bulk_create([obj.object for obj in objects])
+                else:
+                    for obj in objects:
+                        obj.save()
+        self.check_object_count(model_name, object_count, actual_object_count)
+
+
+def can_bulk_create(model):
+    """
+    Objects are saved one at a time if saving them has side effects: signal
+    receivers or the parent rows of multi table inheritance
+    """
+    if model._meta.parents:
+        return False
+    return not (signals.pre_save.has_listeners(model) or signals.post_save.has_listeners(model))
+
 
 def get_meta_value(meta, key, path=None):
     if '.' not in key:
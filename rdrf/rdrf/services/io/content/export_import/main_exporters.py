@@ -2,12 +2,16 @@ from collections import OrderedDict
 from datetime import datetime
 import json
 import logging
+import multiprocessing
 import os
 import shutil
 import tempfile
 
+from django.db import connections
+
 from rdrf.models.definition.models import Registry
 from .definitions import REGISTRY_DEF_EXPORT_DEFINITION, REGISTRY_WITH_DATA_EXPORT_DEFINITION
+from .exporters import JSONL_GZ
 from .utils import IndentedLogger
 
 logger = logging.getLogger(__name__)
@@ -33,7 +37,11 @@ class TopLevelExporter(object):
     def zip_file(self):
         return self._zip_file or 'exported_data.zip'
 
-    def export(self, filename=None, verbose=False, indented_logs=True):
+    def export(self, filename=None, verbose=False, indented_logs=True, workers=1, format=JSONL_GZ):
+        """
+        :param workers: processes models are exported in, in parallel if more than 1
+        :param format: format of the model files ( see exporters.FORMATS )
+        """
         if filename is not None:
             self._zip_file = filename
         logger = logging.getLogger(__name__)
@@ -44,19 +52,34 @@ class TopLevelExporter(object):
             child_logger = IndentedLogger(logger)
 
         self.create_working_dir()
-        self.meta = []
 
         self.export_context.update({
             'workdir': self.workdir,
+            'format': format,
         })
 
-        # TODO this code is the same as first section in exporters.DataGroupExporters.export
-        datagroup_exporters = self.dfns.exporters_catalogue.datagroups
-        for dg in self.dfns.datagroups:
-            exporter = datagroup_exporters.get(dg)(
-                dg, self.dfns.exporters_catalogue, logger=child_logger)
-            if exporter.export(**self.export_context):
-                self.meta.append(exporter.get_meta_info(top_level=True))
+        pool = None
+        if workers > 1:
+            # the forked workers open their own database connections
+            connections.close_all()
+            pool = multiprocessing.get_context('fork').Pool(workers)
+            self.export_context['pool'] = pool
+
+        try:
+            # TODO this code is the same as first section in exporters.DataGroupExporters.export
+            datagroup_exporters = self.dfns.exporters_catalogue.datagroups
+            exporters = []
+            for dg in self.dfns.datagroups:
+                exporter = datagroup_exporters.get(dg)(
+                    dg, self.dfns.exporters_catalogue, logger=child_logger)
+                if exporter.export(**self.export_context):
+                    exporters.append(exporter)
+            self.meta = [exporter.get_meta_info(top_level=True) for exporter in exporters]
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                del self.export_context['pool']
         self.exported_at = datetime.now()
 
         self.write_out_meta_info()
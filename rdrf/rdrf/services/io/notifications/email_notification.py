@@ -17,7 +17,8 @@ class RdrfEmail(object):
 
     _DEFAULT_LANGUAGE = "en"
 
-    def __init__(self, reg_code=None, description=None, email_notification=None, language=None):
+    def __init__(self, reg_code=None, description=None, email_notification=None, language=None,
+                 connection=None):
         self.email_from = None
         self.recipients = []
         self.email_templates = []
@@ -26,6 +27,7 @@ class RdrfEmail(object):
         self.reg_code = reg_code
         self.description = description
         self.language = language  # used to only send to subset of languages by EmailNotificationHistory resend
+        self.connection = connection  # mail connection shared by a batch of emails
 
         if email_notification:
             self.email_notification = email_notification
@@ -56,7 +58,8 @@ class RdrfEmail(object):
                     email_body,
                     self.email_notification.email_from,
                     [recipient],
-                    html_message=email_body)
+                    html_message=email_body,
+                    connection=self.connection)
                 if language not in notification_record_saved:
                     self._save_notification_record(language)
                     notification_record_saved.append(language)
@@ -153,10 +156,13 @@ class RdrfEmail(object):
                 else:
                     _template_data[key] = value
 
+        user = self.template_data.get("user")
         enh = EmailNotificationHistory(
             language=language,
             email_notification=self.email_notification,
-            template_data=json.dumps(_template_data)
+            template_data=json.dumps(_template_data),
+            registry_code=self.reg_code,
+            user_id=user.id if isinstance(user, CustomUser) else None
         )
         enh.save()
 
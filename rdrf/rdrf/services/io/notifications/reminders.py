@@ -1,11 +1,51 @@
 from rdrf.services.io.notifications.email_notification import process_notification
-from rdrf.services.io.notifications.email_notification import EmailNotificationHistory
-import json
+from rdrf.services.io.notifications.email_notification import EmailNotificationHistory, RdrfEmail
+from rdrf.models.definition.models import EmailNotification
+from django.core.mail import get_connection
+from django.utils.functional import cached_property
 from datetime import datetime
+from itertools import islice
 import logging
 
 logger = logging.getLogger(__name__)
 
+# users whose reminders are worked out at a time
+BATCH_SIZE = 1000
+
+
+def can_send(reminder_dates, now):
+    """
+    :param reminder_dates: date stamps of the reminders sent since the last login, newest first
+    """
+    # These are the rules for MTM - should we push into config?
+    num_sent = len(reminder_dates)
+    if num_sent >= 2:
+        return False
+    elif num_sent == 1:
+        delta = now - reminder_dates[-1]
+        return delta.days >= 14
+    else:
+        return True
+
+
+def get_reminder_dates(registry_model, users):
+    """
+    :return: user id -> date stamps of the reminders sent to the user since their last login, newest first
+    """
+    last_logins = {user.id: user.last_login for user in users}
+    history = EmailNotificationHistory.objects.filter(email_notification__description='reminder',
+                                                      registry_code=registry_model.code,
+                                                      user_id__in=list(last_logins))
+    if None not in last_logins.values():
+        history = history.filter(date_stamp__gte=min(last_logins.values()))
+
+    reminder_dates = {user_id: [] for user_id in last_logins}
+    for user_id, date_stamp in history.order_by("-date_stamp").values_list("user_id", "date_stamp"):
+        last_login = last_logins[user_id]
+        if last_login is None or date_stamp >= last_login:
+            reminder_dates[user_id].append(date_stamp)
+    return reminder_dates
+
 
 class ReminderProcessor:
     def __init__(self, user, registry_model, process_func=process_notification):
@@ -17,37 +57,11 @@ class ReminderProcessor:
         self.process_func = process_func  # exposed to allow testing
 
     def _can_send(self):
-        # These are the rules for MTM - should we push into config?
-        now = datetime.now()
-        existing_reminders = self._get_reminders()
-        num_sent = len(existing_reminders)
-        if num_sent >= 2:
-            return False
-        elif num_sent == 1:
-            last_reminder = existing_reminders[-1]
-            delta = now - last_reminder.date_stamp
-            return delta.days >= 14
-        else:
-            return True
+        return can_send(self._get_reminders(), datetime.now())
 
     def _get_reminders(self):
         # own reminders since last login date
-        history = EmailNotificationHistory.objects.filter(
-            email_notification__description='reminder',
-            date_stamp__gte=self.user.last_login)
-        history = history.order_by("-date_stamp")
-        return [enh for enh in history if self._is_own(enh)]
-
-    def _is_own(self, email_notification_model):
-        template_data = json.loads(email_notification_model.template_data)
-        if not template_data:
-            return False
-        try:
-            user_id = template_data["user"]["id"]
-            registry_id = template_data["registry"]["id"]
-            return registry_id == self.registry_id and user_id == self.user_id
-        except KeyError:
-            return False
+        return get_reminder_dates(self.registry_model, [self.user])[self.user_id]
 
     def process(self):
         if self._can_send():
@@ -58,3 +72,61 @@ class ReminderProcessor:
                               "reminder",
                               template_data)
             return True
+
+
+class ReminderEngine(object):
+    """
+    Sends the reminders of all the users of a registry. Whether users can be sent
+    a reminder is worked out a batch of users at a time and the emails go out
+    over one mail connection ( call close when done. )
+    """
+
+    def __init__(self, registry_model, process_func=None, batch_size=BATCH_SIZE):
+        self.registry_model = registry_model
+        self.process_func = process_func  # exposed to allow testing
+        self.batch_size = batch_size
+        self.connection = None
+
+    @cached_property
+    def email_notifications(self):
+        email_notifications = EmailNotification.objects.filter(registry=self.registry_model,
+                                                               description="reminder")
+        for email_notification in email_notifications:
+            if email_notification.disabled:
+                logger.warning("Can not process notification - Email disabled")
+        return [email_notification for email_notification in email_notifications
+                if not email_notification.disabled]
+
+    def check(self, users):
+        """
+        :return: yields (user, whether a reminder can be sent) for each of the users
+        """
+        now = datetime.now()
+        users = iter(users)
+        batch = list(islice(users, self.batch_size))
+        while batch:
+            reminder_dates = get_reminder_dates(self.registry_model, batch)
+            for user in batch:
+                yield user, can_send(reminder_dates[user.id], now)
+            batch = list(islice(users, self.batch_size))
+
+    def send(self, user):
+        template_data = {"user": user,
+                         "registry": self.registry_model}
+        if self.process_func:
+            self.process_func(self.registry_model.code, "reminder", template_data)
+            return True
+
+        if self.connection is None:
+            self.connection = get_connection()
+            self.connection.open()
+        for email_notification in self.email_notifications:
+            email = RdrfEmail(email_notification=email_notification, connection=self.connection)
+            email.template_data = template_data
+            email.send()
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
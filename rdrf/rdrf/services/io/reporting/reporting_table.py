@@ -353,6 +353,7 @@ class ReportingTableGenerator(object):
         else:
             generate_func = database_utils.generate_results
 
+        # rows are inserted a batch at a time as the query results stream in
         values = []
         for row in generate_func(self.reverse_map,
                                  self.col_map,
@@ -361,8 +362,12 @@ class ReportingTableGenerator(object):
             new_row.update(row)
             values.append(new_row)
             row_num += 1
+            if len(values) >= database_utils.fetch_size:
+                self.engine.execute(self.table.insert(), values)
+                values = []
 
-        self.engine.execute(self.table.insert(), values)
+        if values:
+            self.engine.execute(self.table.insert(), values)
 
         if errors > 0:
             logger.warning("query errors: %s" % errors)
@@ -394,16 +399,32 @@ class ReportingTableGenerator(object):
         return self.TYPE_MAP.get(datatype, alc.String)
 
     def dump_csv(self, stream):
+        for line in self.stream_csv():
+            stream.write(line)
+        return stream
+
+    def stream_csv(self):
+        """
+        Yields the report table as csv lines, reading it through a server side cursor
+        """
         import csv
-        writer = csv.writer(stream)
+        writer = csv.writer(_EchoBuffer())
         select_query = alc.sql.select([self.table])
-        db_connection = self.engine.connect()
-        result = db_connection.execute(select_query)
-        writer.writerow([self.column_labeller.get_label(key)
-                         for key in list(result.keys())])
-        writer.writerows(result)
-        db_connection.close()
-        return stream
+        db_connection = self.engine.connect().execution_options(stream_results=True)
+        try:
+            result = db_connection.execute(select_query)
+            yield writer.writerow([self.column_labeller.get_label(key)
+                                   for key in list(result.keys())])
+            for row in result:
+                yield writer.writerow(row)
+        finally:
+            db_connection.close()
+
+
+class _EchoBuffer(object):
+    # lets csv.writer hand back each formatted line instead of buffering it
+    def write(self, value):
+        return value
 
 
 class MongoFieldSelector(object):
@@ -1,52 +1,48 @@
 import openpyxl as xl
+from openpyxl.cell import WriteOnlyCell
 import logging
 import json
 import functools
+from collections import defaultdict
+from django.db.models import Count, Max
 from rdrf.helpers.utils import get_cde_value
-from rdrf.helpers.utils import cached
-from rdrf.db.dynamic_data import DynamicDataWrapper
 from rdrf.models.definition.models import CommonDataElement, ClinicalData
+from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.history import materialise
 from rdrf.db.generalised_field_expressions import GeneralisedFieldExpressionParser
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 
-class Cache:
-    LIMIT_SNAPSHOT = 2000
-    LIMIT_CURRENT = 2000
+class PatientBatch:
+    """
+    The current record and history snapshots of a batch of patients,
+    loaded with one query per collection.
+    """
 
-    def __init__(self):
-        self.snapshots = {}
-        self.current = {}
+    def __init__(self, registry_model, patients, with_snapshots=False):
+        self.patients = patients
+        patient_ids = [patient.id for patient in patients]
+        self.snapshots = defaultdict(list)
 
-    def _get_data(self, patient, name, cached_data, limit, retriever):
-        if patient.id in cached_data:
-            return cached_data[patient.id]
-        else:
-            if len(cached_data) == self.LIMIT_CURRENT:
-                k = list(cached_data.keys())[0]
-                del cached_data[k]
+        # no context - the first record of each patient, as DynamicDataWrapper.load_dynamic_data returns
+        self.current = DynamicDataWrapper.load_batch(registry_model.code,
+                                                     [(patient_id, None) for patient_id in patient_ids])
 
-            patient_data = retriever(patient)
-            cached_data[patient.id] = patient_data
-            return patient_data
+        if with_snapshots:
+            # fixme: date filtering was never implemented, but it could
+            # be added if the storage format of history timestamps is fixed.
+            history = ClinicalData.objects.collection(registry_model.code, "history")
+            snapshots = history.filter(django_model="Patient", django_id__in=patient_ids)
+            for snapshot in materialise(snapshots.find(record_type="snapshot").data()):
+                self.snapshots[snapshot["django_id"]].append(snapshot)
 
-    def get_current(self, patient, current_retriever):
-        return self._get_data(
-            patient,
-            "current",
-            self.current,
-            self.LIMIT_CURRENT,
-            current_retriever)
+    def get_current(self, patient):
+        return self.current.get((patient.id, None))
 
-    def get_snapshots(self, patient, snapshots_retriever):
-        return self._get_data(
-            patient,
-            "snapshots",
-            self.snapshots,
-            self.LIMIT_SNAPSHOT,
-            snapshots_retriever)
+    def get_snapshots(self, patient):
+        return self.snapshots.get(patient.id, [])
 
 
 def attempt(func):
@@ -68,21 +64,30 @@ def default_time_window():
 
 
 class SpreadSheetReport:
-    def __init__(self, query_model, humaniser):
+    """
+    Rows are written in order with Worksheet.append and patients are loaded
+    batch_size at a time. In streaming mode the workbook is write only so
+    openpyxl spools rows to disk instead of keeping every sheet in memory.
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, query_model, humaniser, streaming=False, batch_size=BATCH_SIZE):
         self.query_model = query_model
         self.humaniser = humaniser
         self.registry_model = query_model.registry
         self.projection_list = json.loads(query_model.projection)
         self.longitudinal_column_map = self._build_longitudinal_column_map()
-        self.work_book = xl.Workbook()
+        self.streaming = streaming
+        self.batch_size = batch_size
+        self.work_book = xl.Workbook(write_only=streaming)
         self.current_sheet = None
         self.current_row = 1
         self.current_col = 1
+        self.row_cells = []
         self.time_window = default_time_window()
         self.patient_fields = self._get_patient_fields()
         self.cde_model_map = {}
-        self.cache = Cache()
-        self._universal_column_map = {}
+        self._human_cache = {}
 
         self.gfe_func_map = {}
         self.parser = GeneralisedFieldExpressionParser(self.registry_model)
@@ -124,24 +129,27 @@ class SpreadSheetReport:
         self.current_col += 1
 
     def _next_row(self):
+        # rows are only ever appended so this works for write only sheets too
+        self.current_sheet.append(self.row_cells)
+        self.row_cells = []
         self.current_row += 1
         self.current_col = 1
 
     def _reset(self):
         self.current_col = 1
         self.current_row = 1
+        self.row_cells = []
 
     # Writing
 
     def _write_cell(self, value):
         # write value at current position
-        cell = self.current_sheet.cell(
-            row=self.current_row, column=self.current_col)
         try:
-            cell.value = value
+            cell = WriteOnlyCell(self.current_sheet, value=value)
         except Exception as ex:
             logger.error("error writing value %s to cell: %s" % (value, ex))
-            cell.value = "?ERROR?"
+            cell = WriteOnlyCell(self.current_sheet, value="?ERROR?")
+        self.row_cells.append(cell)
         self._next_cell()
 
     def _generate(self):
@@ -170,10 +178,10 @@ class SpreadSheetReport:
         self._write_header_row(columns)
         self._next_row()
 
-        for patient in self._get_patients():
-            patient_record = self.cache.get_current(patient, self._get_patient_record)
-            self._write_row(patient, patient_record, columns)
-            self._next_row()
+        for batch in self._get_patient_batches():
+            for patient in batch.patients:
+                self._write_row(patient, batch.get_current(patient), columns)
+                self._next_row()
 
     def _write_row(self, patient, patient_record, columns):
         for column in columns:
@@ -208,14 +216,17 @@ class SpreadSheetReport:
 
             return "?ERROR?"
 
-    @cached
     def _human(self, form_model, section_model, cde_model, raw_cde_value):
-        if not isinstance(raw_cde_value, type([])):
-            return self.humaniser.display_value2(
-                form_model, section_model, cde_model, raw_cde_value)
-        else:
-            return ",".join([str(self.humaniser.display_value2(
-                form_model, section_model, cde_model, x)) for x in raw_cde_value])
+        key = (form_model.name, section_model.code, cde_model.code, str(raw_cde_value))
+        if key not in self._human_cache:
+            if not isinstance(raw_cde_value, type([])):
+                value = self.humaniser.display_value2(
+                    form_model, section_model, cde_model, raw_cde_value)
+            else:
+                value = ",".join([str(self.humaniser.display_value2(
+                    form_model, section_model, cde_model, x)) for x in raw_cde_value])
+            self._human_cache[key] = value
+        return self._human_cache[key]
 
     def _get_value_retriever(self, column):
         if column in self.gfe_func_map:
@@ -226,44 +237,22 @@ class SpreadSheetReport:
             return value_retriever
 
     def _write_universal_columns(self, patient, patient_record, universal_columns):
-        patient_id = patient.pk
-        if patient_id in self._universal_column_map:
-            for column in universal_columns:
-                self._write_cell(self._universal_column_map[patient_id][column])
-        else:
-            self._universal_column_map[patient_id] = {}
-            for column in universal_columns:
-                value_retriever = self._get_value_retriever(column)
-                value = value_retriever(patient, patient_record)
-                self._write_cell(value)
-                self._universal_column_map[patient_id][column] = value
+        for column in universal_columns:
+            value_retriever = self._get_value_retriever(column)
+            self._write_cell(value_retriever(patient, patient_record))
 
     def _create_longitudinal_section_sheet(self, universal_columns, form_model, section_model):
         sheet_name = self.registry_model.code.upper() + section_model.code
         sheet_name = sheet_name[:30]  # 31 max char sheet name size ...
         self._create_sheet(sheet_name)
-        # this just writes out bit at the beginning
-        self._write_header_universal_columns(universal_columns)
-        first_longitudinal_date_col = self.current_col
-        self._next_row()
-        max_snapshots = 0
         cde_codes = self.longitudinal_column_map.get(
             (form_model.name, section_model.code), [])
 
         self._add_cde_models(cde_codes)
 
-        for patient in self._get_patients():
-            patient_record = self.cache.get_current(patient, self._get_patient_record)
-            self._write_universal_columns(patient, patient_record, universal_columns)
-            num_snapshots = self._write_longitudinal_row(
-                patient, patient_record, form_model, section_model, cde_codes)
-            if num_snapshots > max_snapshots:
-                max_snapshots = num_snapshots
-            self._next_row()
-
-        # write longitudinal header row now we know max width
-        self.current_col = first_longitudinal_date_col
-        self.current_row = 1
+        # the header is written first so we need the widest row up front
+        max_snapshots = self._get_max_snapshots()
+        self._write_header_universal_columns(universal_columns)
         column_prefix = "%s/%s" % (form_model.name.upper(),
                                    section_model.code)
         date_column_name = "DATE_%s" % column_prefix
@@ -278,6 +267,15 @@ class SpreadSheetReport:
                 self._write_cell(date_column_name)
                 for cde_code in cde_codes:
                     self._write_cell(cde_code)
+        self._next_row()
+
+        for batch in self._get_patient_batches(with_snapshots=True):
+            for patient in batch.patients:
+                patient_record = batch.get_current(patient)
+                self._write_universal_columns(patient, patient_record, universal_columns)
+                self._write_longitudinal_row(
+                    patient, patient_record, batch.get_snapshots(patient), form_model, section_model, cde_codes)
+                self._next_row()
 
     def _create_sheet(self, title):
         sheet = self.work_book.create_sheet()
@@ -299,9 +297,24 @@ class SpreadSheetReport:
         from registry.patients.models import Patient
         return Patient.objects.filter(rdrf_registry__in=[self.registry_model]).order_by("id")
 
-    def _get_patient_record(self, patient, collection="cdes"):
-        wrapper = DynamicDataWrapper(patient)
-        return wrapper.load_dynamic_data(self.registry_model.code, collection, flattened=False)
+    def _get_patient_batches(self, with_snapshots=False):
+        patients = []
+        for patient in self._get_patients().iterator():
+            patients.append(patient)
+            if len(patients) == self.batch_size:
+                yield PatientBatch(self.registry_model, patients, with_snapshots)
+                patients = []
+        if patients:
+            yield PatientBatch(self.registry_model, patients, with_snapshots)
+
+    def _get_max_snapshots(self):
+        history = ClinicalData.objects.collection(self.registry_model.code, "history")
+        # clinical data can be in another database so no subquery here
+        patient_ids = list(self._get_patients().values_list("id", flat=True))
+        snapshots = history.filter(django_model="Patient",
+                                   django_id__in=patient_ids).find(record_type="snapshot")
+        counts = snapshots.order_by().values("django_id").annotate(num_snapshots=Count("id"))
+        return counts.aggregate(max_snapshots=Max("num_snapshots"))["max_snapshots"] or 0
 
     def _write_header_universal_columns(self, universal_columns):
         for column_name in universal_columns:
@@ -311,14 +324,14 @@ class SpreadSheetReport:
             self,
             patient,
             patient_record,
+            snapshots,
             form_model,
             section_model,
             cde_codes):
         num_blocks = 0  # a "block" is all cdes in one snapshot or the current set of cdes
         # we will write the current set of cdes last
 
-        # for snapshot in self._get_snapshots(patient):
-        for snapshot in self.cache.get_snapshots(patient, self._get_snapshots):
+        for snapshot in snapshots:
             num_blocks += 1
             timestamp = self._get_timestamp_from_snapshot(snapshot)
             values = []
@@ -383,18 +396,3 @@ class SpreadSheetReport:
                                                                               getattr(patient_model, settings.LOG_PATIENT_FIELDNAME),
                                                                               ex))
             return "??ERROR??"
-
-    def _get_snapshots(self, patient):
-        history = ClinicalData.objects.collection(self.registry_model.code, "history")
-        snapshots = history.find(patient, record_type="snapshot")
-
-        # # fixme: date filtering was never implemented, but it could
-        # # be added if the storage format of history timestamps is fixed.
-        # if self.time_window:
-        #     after, before = self.time_window
-        #     if after is not None:
-        #         snapshots = snapshots.filter(data__timestamp__gte=after.isoformat())
-        #     if before is not None:
-        #         snapshots = snapshots.filter(data__timestamp__lte=before.isoformat())
-
-        return list(snapshots.data())
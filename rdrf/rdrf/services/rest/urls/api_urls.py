@@ -17,6 +17,7 @@ router.register(r'registries/(?P<registry_code>\w+)/indices',
 router.register(r'registries/(?P<registry_code>\w+)/clinicians',
                 api_views.ListClinicians, base_name='clinician')
 router.register(r'calculatedcdes', api_views.CalculatedCdeValue, base_name='calculatedcde')
+router.register(r'calculatedcdes/batch', api_views.CalculatedCdeValues, base_name='calculatedcdebatch')
 
 urlpatterns = [
     re_path(r'registries/(?P<code>\w+)/$', api_views.RegistryDetail.as_view(), name='registry-detail'),
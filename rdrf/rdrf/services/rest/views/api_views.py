@@ -13,6 +13,8 @@ from rest_framework.views import APIView
 from registry.genetic.models import Gene, Laboratory
 from registry.patients.models import Patient, Registry, Doctor, NextOfKinRelationship
 from registry.groups.models import CustomUser, WorkingGroup
+from rdrf.forms.fields.calculation_engine import CALCULATIONS, CalculationCycleError, UnknownCalculationError
+from rdrf.forms.fields.calculation_engine import calculation_function, evaluate_calculations
 from rdrf.services.rest.serializers import PatientSerializer, RegistrySerializer, WorkingGroupSerializer, CustomUserSerializer, DoctorSerializer, NextOfKinRelationshipSerializer
 from datetime import datetime
 
@@ -297,6 +299,13 @@ class LookupIndex(APIView):
             list(map(to_dict, [p for p in Patient.objects.filter(query) if p.is_index])))
 
 
+def _calculation_patient_values(data):
+    return {'date_of_birth': datetime.strptime(data["patient_date_of_birth"], '%Y-%m-%d').date(),
+            'patient_id': data["patient_id"],
+            'registry_code': data["registry_code"],
+            'sex': str(data["patient_sex"])}
+
+
 class CalculatedCdeValue(APIView):
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
@@ -306,15 +315,38 @@ class CalculatedCdeValue(APIView):
     def post(self, request, format=None):
         # curl -H 'Content-Type: application/json' -X POST -u admin:admin http://localhost:8000/api/v1/calculatedcdes/ -d '{"cde_code":"DDAgeAtDiagnosis", "form_values":{"DateOfDiagnosis":"2019-05-01"},"patient_sex":1, "patient_date_of_birth":"2000-05-17"}'
 
-        patient_values = {'date_of_birth': datetime.strptime(request.data["patient_date_of_birth"], '%Y-%m-%d').date(),
-                          'patient_id': request.data["patient_id"],
-                          'registry_code': request.data["registry_code"],
-                          'sex': str(request.data["patient_sex"])}
+        patient_values = _calculation_patient_values(request.data)
         form_values = request.data["form_values"]
         logger.debug("form_values = %s" % form_values)
-        mod = __import__('rdrf.forms.fields.calculated_functions', fromlist=['object'])
-        func = getattr(mod, request.data["cde_code"])
-        if func:
-            return Response(func(patient_values, form_values))
-        else:
+        try:
+            func = calculation_function(request.data["cde_code"])
+        except UnknownCalculationError:
             raise Exception(f"Trying to call unknown calculated function {request.data['cde_code']}()")
+        return Response(func(patient_values, form_values))
+
+
+class CalculatedCdeValues(APIView):
+    """
+    Evaluates all the calculated cdes of a form in one request.
+    Calculated cdes are evaluated in dependency order so a calculated cde
+    which is an input of another one is calculated first.
+    """
+    permission_classes = (IsAuthenticatedOrReadOnly,)
+
+    def get(self, request, format=None):
+        return Response("Use the POST method")
+
+    def post(self, request, format=None):
+        # curl -H 'Content-Type: application/json' -X POST -u admin:admin http://localhost:8000/api/v1/calculatedcdes/batch/ -d '{"cde_codes":["CDEfhDutchLipidClinicNetwork", "CDE00024"], "form_values":{...},"patient_sex":1, "patient_date_of_birth":"2000-05-17", "patient_id": 1, "registry_code": "fh"}'
+        cde_codes = request.data.get("cde_codes") or []
+        unknown = [cde_code for cde_code in cde_codes if cde_code not in CALCULATIONS]
+        if unknown:
+            return Response({"stat": "fail", "message": "Unknown calculated cdes: %s" % ", ".join(unknown)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            values, errors = evaluate_calculations(cde_codes,
+                                                   _calculation_patient_values(request.data),
+                                                   request.data["form_values"])
+        except CalculationCycleError as ex:
+            return Response({"stat": "fail", "message": str(ex)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"values": values, "errors": errors})
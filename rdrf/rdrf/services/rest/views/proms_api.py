@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rdrf.models.definition.models import Registry, RegistryForm, Section
-from rdrf.models.definition.models import CommonDataElement
+from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.forms.fields.calculation_engine import update_registry_calculations
+from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.helpers.utils import mongo_key
+from rdrf.models.definition.models import Registry, ClinicalData
 from rdrf.models.proms.models import Survey
 from rdrf.models.proms.models import SurveyAssignment
 from rdrf.models.proms.models import SurveyRequest
@@ -12,10 +17,14 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.shortcuts import render
 from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
 from rdrf.services.rest.serializers import SurveyAssignmentSerializer
 from rdrf.services.rest.auth import PromsAuthentication
 from rest_framework.permissions import AllowAny
+import datetime
 import requests
 import json
 
@@ -23,6 +32,10 @@ import json
 import logging
 logger = logging.getLogger(__name__)
 
+# completed surveys downloaded ( and saved in one transaction ) at a time
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
 
 def multicde(cde_model):
     datatype = cde_model.datatype.lower().strip()
@@ -90,22 +103,64 @@ class PromsDelete(APIView):
 
 
 class PromsDownload(APIView):
+    """
+    Completed surveys of a registry, oldest answer first. If page_size is posted
+    the surveys are returned a page at a time: {"results": [...], "next": cursor}
+    where the cursor is posted back to get the next page ( next is null on the last page. )
+    """
     authentication_classes = (PromsAuthentication,)
     permission_classes = (AllowAny,)
 
     @method_decorator(csrf_exempt)
     def post(self, request, format=None):
         registry_code = request.POST.get("registry_code", "")
+        page_size = request.POST.get("page_size")
         completed_survey_assignments = self.get_queryset(registry_code)
-        completed_surveys = SurveyAssignmentSerializer(completed_survey_assignments, many=True)
-        response = Response(completed_surveys.data)
-        logger.info(f"downloaded {len(completed_survey_assignments)} completed surveys that were downloaded for {registry_code} registry")
-        return response
+        if not page_size:
+            completed_surveys = SurveyAssignmentSerializer(completed_survey_assignments, many=True)
+            response = Response(completed_surveys.data)
+            logger.info(f"downloaded {len(completed_survey_assignments)} completed surveys that were downloaded for {registry_code} registry")
+            return response
+
+        try:
+            page_size = min(int(page_size), MAX_PAGE_SIZE)
+            completed_survey_assignments = self.after_cursor(completed_survey_assignments,
+                                                             request.POST.get("cursor"))
+        except ValueError:
+            return Response("bad page_size or cursor", status=status.HTTP_400_BAD_REQUEST)
+
+        page = list(completed_survey_assignments[:page_size + 1])
+        next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            next_cursor = make_cursor(page[-1])
+        completed_surveys = SurveyAssignmentSerializer(page, many=True)
+        logger.info(f"downloaded a page of {len(page)} completed surveys for {registry_code} registry")
+        return Response({"results": completed_surveys.data, "next": next_cursor})
 
     def get_queryset(self, registry_code):
         # we order the survey by updated date so the last answered survey will overwrite previous answered survey
         # (in case there are multiple answers for the same survey/patient)
-        return SurveyAssignment.objects.filter(state="completed", registry__code=registry_code).order_by('updated')
+        return SurveyAssignment.objects.filter(state="completed", registry__code=registry_code).order_by('updated', 'id')
+
+    def after_cursor(self, queryset, cursor):
+        if not cursor:
+            return queryset
+        updated, pk = parse_cursor(cursor)
+        return queryset.filter(Q(updated__gt=updated) | Q(updated=updated, id__gt=pk))
+
+
+def make_cursor(survey_assignment):
+    return "%s|%s" % (survey_assignment.updated.isoformat(), survey_assignment.pk)
+
+
+def parse_cursor(cursor):
+    # the position of the last survey assignment of the previous page
+    updated, _, pk = cursor.rpartition("|")
+    updated = parse_datetime(updated)
+    if updated is None:
+        raise ValueError("bad cursor %s" % cursor)
+    return updated, int(pk)
 
 
 class PromsProcessor:
@@ -113,66 +168,132 @@ class PromsProcessor:
     def __init__(self, registry_model):
         self.registry_model = registry_model
         self.proms_url = registry_model.proms_system_url
-
-    def download_proms(self):
+        self.registry_graph = get_registry_graph(registry_model)
+
+    def download_proms(self, page_size=PAGE_SIZE):
+        """
+        Downloads the completed surveys a page at a time. Each page is written to the
+        clinical data in one transaction and then deleted on the PROMS site, so a pull
+        which fails part way can simply be run again.
+        """
         from django.conf import settings
 
         if not self.proms_url:
             raise Exception("Registry %s does not have an associated proms system" % self.registry_model)
 
-        api = "/api/proms/v1/promsdownload"
+        post_data = {'proms_secret_token': settings.PROMS_SECRET_TOKEN, 'registry_code': self.registry_model.code}
+        cursor = None
+        while True:
+            surveys, cursor = self._download_page(post_data, page_size, cursor)
+            survey_ids, records = self.process_surveys(surveys)
+
+            # The page is saved, we can now delete its surveys from the PROMS site.
+            if survey_ids:
+                delete_post_data = {**post_data, 'survey_ids': survey_ids}
+                self.delete_registry_proms(delete_post_data)
 
+            # Fix calculation for the records written.
+            if records:
+                self._update_calculations(records)
+
+            if not cursor:
+                break
+
+    def _download_page(self, post_data, page_size, cursor):
+        api = "/api/proms/v1/promsdownload"
         api_url = self.proms_url + api
-        post_data = {'proms_secret_token': settings.PROMS_SECRET_TOKEN, 'registry_code': self.registry_model.code}
-        response = requests.post(api_url, data=post_data)
+        page_data = {**post_data, 'page_size': page_size}
+        if cursor:
+            page_data['cursor'] = cursor
+        response = requests.post(api_url, data=page_data)
 
         if response.status_code != 200:
             logger.warning(f"Error retrieving proms")
             raise Exception("Error retrieving proms")
-        else:
-            data = response.json()
-            survey_ids = []
-            patient_ids = set()
-            for survey_response in data:
-                patient_token = survey_response["patient_token"]
-                survey_name = survey_response["survey_name"]
-                survey_data = json.loads(survey_response["response"])
 
-                # Sanity check: the survey registry must the same as the current registry
-                if survey_response['registry_code'] != self.registry_model.code:
-                    raise Exception(f"survey response registry code '{survey_response['registry_code']}' "
-                                    f"not equal to pull_proms registry code '{self.registry_model.code}'")
-
-                try:
-                    survey_request = SurveyRequest.objects.get(patient_token=patient_token,
-                                                               survey_name=survey_name,
-                                                               state=SurveyRequestStates.REQUESTED,
-                                                               registry__code=survey_response['registry_code'])
-                except SurveyRequest.DoesNotExist:
+        data = response.json()
+        if isinstance(data, list):
+            # the proms system doesn't page - everything came at once
+            return data, None
+        return data["results"], data["next"]
+
+    def process_surveys(self, surveys):
+        """
+        Pokes a page of downloaded surveys into the clinical data in one transaction:
+        the values of each record are saved once, however many surveys they came from.
+        :return: ids of the surveys processed, (patient, context) of the records written
+        """
+        for survey_response in surveys:
+            # Sanity check: the survey registry must the same as the current registry
+            if survey_response['registry_code'] != self.registry_model.code:
+                raise Exception(f"survey response registry code '{survey_response['registry_code']}' "
+                                f"not equal to pull_proms registry code '{self.registry_model.code}'")
+
+        survey_requests = self._get_survey_requests(surveys)
+        survey_ids = []
+        # (patient, context) -> {delimited key: value} of every survey in the record
+        record_values = OrderedDict()
+        clinical_db = router.db_for_write(ClinicalData)
+        with transaction.atomic(), transaction.atomic(using=clinical_db):
+            for survey_response in surveys:
+                matches = survey_requests.get((survey_response["patient_token"],
+                                               survey_response["survey_name"]), [])
+                if not matches:
                     logger.error("could not find survey request")
                     continue
-
-                except SurveyRequest.MultipleObjectsReturned:
+                if len(matches) > 1:
                     logger.error("too many survey requests")
                     continue
+                survey_request = matches[0]
 
-                # Remember the patient ids so we can later update the calculated field for this patient.
-                patient_ids.add(survey_request.patient.id)
-
-                self._update_proms_fields(survey_request, survey_data)
+                survey_data = json.loads(survey_response["response"])
+                context_model, form_values = self._update_proms_fields(survey_request, survey_data)
+                # surveys come oldest first so later answers overwrite earlier ones
+                record_values.setdefault((survey_request.patient, context_model), OrderedDict()).update(form_values)
 
-                # Store the survey id so we can delete it on the PROMS site once all surveys are downloaded.
+                # Store the survey id so we can delete it on the PROMS site once the page is saved.
                 survey_ids.append(survey_response["id"])
 
-            # All went well, we can now delete the downloaded surveys from the PROMS site.
-            if len(survey_ids) > 0:
-                delete_post_data = {**post_data, 'survey_ids': survey_ids}
-                self.delete_registry_proms(delete_post_data)
-
-            # Fix calculation for this registry.
-            if patient_ids:
-                from django.core.management import call_command
-                call_command('update_calculated_fields', registry_code=self.registry_model.code, patient_id=patient_ids)
+            # the records of the page are loaded with one query
+            batch = DynamicDataWrapper.load_batch(self.registry_model.code, list(record_values))
+            for (patient_model, context_model), form_values in record_values.items():
+                mongo_data = batch.flattened((patient_model.pk, context_model.pk))
+                self._save_form_values(patient_model, context_model, form_values, mongo_data)
+
+        return survey_ids, list(record_values)
+
+    def _get_survey_requests(self, surveys):
+        # (patient token, survey name) -> requested SurveyRequests ( more than one can't be used )
+        patient_tokens = {survey_response["patient_token"] for survey_response in surveys}
+        survey_requests = (SurveyRequest.objects.filter(registry=self.registry_model,
+                                                        state=SurveyRequestStates.REQUESTED,
+                                                        patient_token__in=patient_tokens)
+                           .select_related("patient", "survey", "survey__context_form_group", "survey__form")
+                           .prefetch_related("survey__survey_questions__cde"))
+        matches = {}
+        for survey_request in survey_requests:
+            matches.setdefault((survey_request.patient_token, survey_request.survey_name), []).append(survey_request)
+        return matches
+
+    def _save_form_values(self, patient_model, context_model, form_values, mongo_data):
+        # one save of the ( flattened ) record instead of a patient_model.set_form_value per cde
+        registry_code = self.registry_model.code
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_model.pk)
+        mongo_data = mongo_data or {}
+        t = datetime.datetime.now()
+        for (form_name, section_code, cde_code), value in form_values.items():
+            mongo_data[mongo_key(form_name, section_code, cde_code)] = value
+            mongo_data["%s_timestamp" % form_name] = t
+        wrapper.save_dynamic_data(registry_code, "cdes", mongo_data)
+        FormProgress(self.registry_model).save_for_patient(patient_model, context_model)
+
+    def _update_calculations(self, records):
+        patient_ids = sorted({patient_model.pk for patient_model, _ in records})
+        context_ids = sorted({context_model.pk for _, context_model in records})
+        num_records = sum(update_registry_calculations(self.registry_model,
+                                                       patient_ids=patient_ids,
+                                                       context_ids=context_ids))
+        logger.info("Recalculated %s proms records of %s registry" % (num_records, self.registry_model.code))
 
     def delete_registry_proms(self, post_data):
         api_delete = "/api/proms/v1/promsdelete"
@@ -184,8 +305,8 @@ class PromsProcessor:
 
     def _update_proms_fields(self, survey_request, survey_data):
         from rdrf.models.definition.models import RDRFContext
-        # pokes downloaded proms into correct fields inside
-        # clinical system
+        # works out where downloaded proms go inside the clinical system - consents are set
+        # straight away, the cde values are returned with the context of the record to save them to
         context_model = None
         patient_model = survey_request.patient
         metadata = self.registry_model.metadata
@@ -243,10 +364,11 @@ class PromsProcessor:
         for question in survey_request.survey.survey_questions.all():
             cde_paths = {**cde_paths, question.cde.code: question.cde_path}
 
+        # (form name, section code, cde code) -> value, saved with the rest of the record
+        form_values = OrderedDict()
         for cde_code, value in survey_data.items():
-            try:
-                cde_model = CommonDataElement.objects.get(code=cde_code)
-            except CommonDataElement.DoesNotExist:
+            cde_model = self.registry_graph.cde(cde_code)
+            if cde_model is None:
                 logger.error("could not find cde %s" % cde_code)
                 continue
 
@@ -262,8 +384,11 @@ class PromsProcessor:
                     # Find the cde code in the survey questions and check existance of cde_path
                     if cde_code in cde_paths.keys() and cde_paths[cde_code]:
                         form_name, section_code = list(filter(None, cde_paths[cde_code].split("/")))
-                        form_model = RegistryForm.objects.get(name=form_name, registry__code=self.registry_model.code)
-                        section_model = Section.objects.get(code=section_code)
+                        form_model = self.registry_graph.form(form_name)
+                        section_model = self.registry_graph.section(section_code)
+                        if form_model is None or section_model is None:
+                            raise Exception("cde path %s is not in registry %s" % (cde_paths[cde_code],
+                                                                                   self.registry_model.code))
                     else:
                         # override target_form_model if cde_path exists
                         form_model, section_model = self._locate_cde(cde_model, context_model, target_form_model)
@@ -276,28 +401,13 @@ class PromsProcessor:
 
                 continue
 
-            try:
-                if not self.registry_model.has_feature("contexts"):
-                    context_arg = None
-                else:
-                    context_arg = context_model
-
-                if not is_consent:
-                    patient_model.set_form_value(self.registry_model.code,
-                                                 form_model.name,
-                                                 section_model.code,
-                                                 cde_model.code,
-                                                 value,
-                                                 context_arg)
-            except Exception as ex:
-                logger.error("Error updating proms field %s->%s: %s" % (cde_code,
-                                                                        value,
-                                                                        ex))
-                continue
+            if not is_consent:
+                form_values[(form_model.name, section_model.code, cde_model.code)] = value
 
         survey_request.state = SurveyRequestStates.RECEIVED
         survey_request.response = json.dumps(survey_data)
         survey_request.save()
+        return context_model, form_values
 
     def _update_consentvalue(self, patient_model, consent_code, answer):
         from rdrf.models.definition.models import ConsentQuestion
@@ -314,8 +424,8 @@ class PromsProcessor:
             form_models = self.registry_model.forms
 
         for form_model in form_models:
-            for section_model in form_model.section_models:
+            for section_model in self.registry_graph.section_models(form_model):
                 if not section_model.allow_multiple:
-                    for cde_model in section_model.cde_models:
+                    for cde_model in self.registry_graph.cde_models(section_model):
                         if cde_model.code == target_cde_model.code:
                             return form_model, section_model
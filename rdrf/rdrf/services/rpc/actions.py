@@ -1,3 +1,7 @@
+import time
+
+from rdrf.helpers.profiling import record_function
+
 from . import rpc_commands
 
 
@@ -17,7 +21,10 @@ class ActionExecutor(object):
             try:
                 # always pass request (conventionally) as first argument
                 args = [self.request] + rpc_args
+                start = time.perf_counter()
                 result = rpc_function(*args)
+                # the rpc view serves every command, so profile them by name
+                record_function("rpc %s" % rpc_command, time.perf_counter() - start)
                 client_response['result'] = result
                 client_response['status'] = 'success'
             except Exception as ex:
@@ -155,7 +155,9 @@ MESSAGE_TAGS = {
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
 MIDDLEWARE = (
+    'registry.common.middleware.ProfilingMiddleware',
     'useraudit.middleware.RequestToThreadLocalMiddleware',
+    'registry.common.middleware.RequestCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
     'iprestrict.middleware.IPRestrictMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -674,3 +676,21 @@ if SESSION_SECURITY_ENABLE:
 # Enable user password change
 ENABLE_PWD_CHANGE = env.get("enable_pwd_change", True)
 REGISTRATION_ENABLED = env.get("registration_enabled", True)
+
+# Rows fetched per round trip by the explorer's server side cursors
+EXPLORER_FETCH_SIZE = env.get("explorer_fetch_size", 2000)
+
+# History snapshots are stored in full ( "snapshots" ) or as deltas against the
+# previous snapshot with a full checkpoint every HISTORY_CHECKPOINT_INTERVAL ( "deltas" )
+# See rdrf.db.history
+HISTORY_STORAGE = env.get("history_storage", "snapshots")
+HISTORY_CHECKPOINT_INTERVAL = env.get("history_checkpoint_interval", 20)
+
+# Per request query, template and timed function profiling aggregated per url
+# name, shown on the performance page. See rdrf.helpers.profiling
+PROFILING_ENABLED = env.get("profiling_enabled", False)
+
+# Form progress and field values are brought up to date when a form is saved
+# ( "sync" ) or queued when the save commits and run by the run_post_save_jobs
+# command ( "queue" ). See rdrf.db.post_save
+POST_SAVE_JOBS = env.get("post_save_jobs", "sync")
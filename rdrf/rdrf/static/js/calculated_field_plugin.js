@@ -37,62 +37,96 @@ function _arrayWithoutHoles(arr) {
   var wsurl = "";
  
 
-  var update_function = function update_function(calculated_cdes) {
-    calculated_cdes.forEach(function(cde_code) {
-      // Retrieve all values of input
-      var calculated_cde_inputs_json_values = {};
-      calculated_cde_inputs[cde_code].forEach(function(required_input_cde) {
-        var cde_value = $("[id$=__".concat(required_input_cde, "]")).val(); // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
+  var input_value = function input_value(input_cde) {
+    var cde_value = $("[id$=__".concat(input_cde, "]")).val(); // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
 
-        if (moment(cde_value, "D-M-YYYY", true).isValid()) {
-          cde_value = moment(cde_value, "D-M-YYYY", true).format("YYYY-MM-DD");
-        } // check if it is a number and convert it in a number
+    if (moment(cde_value, "D-M-YYYY", true).isValid()) {
+      cde_value = moment(cde_value, "D-M-YYYY", true).format("YYYY-MM-DD");
+    } // check if it is a number and convert it in a number
 
-        if (
-          $("[id$=__".concat(required_input_cde, "]")).attr("type") === "number"
-        ) {
-          cde_value = parseFloat(cde_value);
-        }
+    if ($("[id$=__".concat(input_cde, "]")).attr("type") === "number") {
+      cde_value = parseFloat(cde_value);
+    }
+
+    return cde_value;
+  };
+
+  var with_dependents = function with_dependents(calculated_cdes) {
+    // calculated cdes which read other calculated cdes are recalculated in the same request
+    var cde_codes = [];
+    var pending = calculated_cdes.slice();
+
+    while (pending.length > 0) {
+      var cde_code = pending.shift();
+
+      if (cde_codes.indexOf(cde_code) === -1) {
+        cde_codes.push(cde_code);
+        pending = pending.concat(required_cde_inputs[cde_code] || []);
+      }
+    }
+
+    return cde_codes;
+  };
 
-        calculated_cde_inputs_json_values[required_input_cde] = cde_value;
+  var update_function = function update_function(calculated_cdes) {
+    // One request evaluates all the calculated cdes - the server orders them
+    var cde_codes = with_dependents(calculated_cdes);
+    var form_values = {};
+    cde_codes.forEach(function(cde_code) {
+      calculated_cde_inputs[cde_code].forEach(function(required_input_cde) {
+        form_values[required_input_cde] = input_value(required_input_cde);
       });
-      var body = {
-        cde_code: cde_code,
-        patient_date_of_birth: patient_date_of_birth,
-        patient_sex: patient_sex,
-	patient_id: patient_id,
-	registry_code: registry_code,
-        form_values: calculated_cde_inputs_json_values
-      };
-      fetch(wsurl, {
-        method: "post",
-        headers: {
-          "Content-Type": "application/json",
-          "X-CSRFToken": $("[name=csrfmiddlewaretoken]").val()
-        },
-        body: JSON.stringify(body)
+    });
+    var body = {
+      cde_codes: cde_codes,
+      patient_date_of_birth: patient_date_of_birth,
+      patient_sex: patient_sex,
+      patient_id: patient_id,
+      registry_code: registry_code,
+      form_values: form_values
+    };
+    fetch(wsurl, {
+      method: "post",
+      headers: {
+        "Content-Type": "application/json",
+        "X-CSRFToken": $("[name=csrfmiddlewaretoken]").val()
+      },
+      body: JSON.stringify(body)
+    })
+      .then(function(response) {
+        if (!response.ok) {
+          throw new Error(response.statusText);
+        }
+
+        return response.json();
       })
-        .then(function(response) {
-          if (!response.ok) {
-            throw new Error(response.statusText);
-          }
-
-          return response.json();
-        })
-        .then(function(result) {
-          if (result.stat === "fail") {
-            throw new Error(result.message);
-          }
-
-          $("[id$=__".concat(cde_code, "]")).val(result);
-          $("[id$=__".concat(cde_code, "]")).trigger("change");
-        })
-        .catch(function(errormsg) {
-          console.log(errormsg);
+      .then(function(result) {
+        if (result.stat === "fail") {
+          throw new Error(result.message);
+        }
+
+        Object.keys(result.values).forEach(function(cde_code) {
+          $("[id$=__".concat(cde_code, "]")).val(result.values[cde_code]);
+          // dependents are already calculated so only other listeners react
+          $("[id$=__".concat(cde_code, "]")).trigger("change", [true]);
         });
-    });
+        Object.keys(result.errors).forEach(function(cde_code) {
+          console.log(cde_code + ": " + result.errors[cde_code]);
+        });
+      })
+      .catch(function(errormsg) {
+        console.log(errormsg);
+      });
   };
 
+  // the calculated cdes registered while the page loads are calculated together
+  var pending_observers = [];
+  var update_pending = _.debounce(function() {
+    var observers = pending_observers;
+    pending_observers = [];
+    update_function(observers);
+  }, 0);
+
   $.fn.add_calculation = function(options) {
     patient_date_of_birth = options.patient_date_of_birth;
     patient_id = options.patient_id;
@@ -111,15 +145,18 @@ function _arrayWithoutHoles(arr) {
 
     try {
       // call on initial page load
-      update_function([options.observer]); //call it to ensure if calculation changes on server
+      pending_observers.push(options.observer);
+      update_pending(); //call it to ensure if calculation changes on server
       //update the onchange
 
       Object.keys(required_cde_inputs).forEach(function(cde_input) {
         $("[id$=__".concat(cde_input, "]")).off("change");
         $("[id$=__".concat(cde_input, "]")).on(
           "change keyup",
-          _.debounce(function(e) {
-            update_function(required_cde_inputs[cde_input]);
+          _.debounce(function(e, calculated) {
+            if (!calculated) {
+              update_function(required_cde_inputs[cde_input]);
+            }
           }, 250)
         );
       });
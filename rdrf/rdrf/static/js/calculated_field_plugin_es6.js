@@ -4,67 +4,98 @@
         let calculated_cde_inputs = {}
         let patient_date_of_birth = '';
         let patient_sex = '';
-        let patient_id = '',
+        let patient_id = '';
         let registry_code = '';
         let wsurl = '';
 
-        const update_function = function (calculated_cdes) {
-
-            calculated_cdes.forEach(cde_code => {
-                // Retrieve all values of input
-                let calculated_cde_inputs_json_values = {};
-                calculated_cde_inputs[cde_code].forEach((required_input_cde) => {
+        const input_value = function (input_cde) {
+            let cde_value = $(`[id$=__${input_cde}]`).val();
 
-                    let cde_value = $(`[id$=__${required_input_cde}]`).val();
-
-                    // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
-                    if (moment(cde_value, "D-M-YYYY",true).isValid()) {
-                        cde_value = moment(cde_value, "D-M-YYYY",true).format('YYYY-MM-DD');
-                    }
+            // check if it is a date like dd-mm-yyyy and convert it in yyyy-mm-dd
+            if (moment(cde_value, "D-M-YYYY",true).isValid()) {
+                cde_value = moment(cde_value, "D-M-YYYY",true).format('YYYY-MM-DD');
+            }
 
-                    // check if it is a number and convert it in a number
-                    if ($(`[id$=__${required_input_cde}]`).attr('type') === 'number') {
-                        cde_value = parseFloat(cde_value);
-                    }
+            // check if it is a number and convert it in a number
+            if ($(`[id$=__${input_cde}]`).attr('type') === 'number') {
+                cde_value = parseFloat(cde_value);
+            }
+            return cde_value;
+        }
 
+        const with_dependents = function (calculated_cdes) {
+            // calculated cdes which read other calculated cdes are recalculated in the same request
+            let cde_codes = [];
+            let pending = [...calculated_cdes];
+            while (pending.length > 0) {
+                const cde_code = pending.shift();
+                if (!cde_codes.includes(cde_code)) {
+                    cde_codes.push(cde_code);
+                    pending = [...pending, ...(required_cde_inputs[cde_code] || [])];
+                }
+            }
+            return cde_codes;
+        }
 
-                    calculated_cde_inputs_json_values[required_input_cde] = cde_value;
+        const update_function = function (calculated_cdes) {
+            // One request evaluates all the calculated cdes - the server orders them
+            const cde_codes = with_dependents(calculated_cdes);
+            let form_values = {};
+            cde_codes.forEach(cde_code => {
+                calculated_cde_inputs[cde_code].forEach((required_input_cde) => {
+                    form_values[required_input_cde] = input_value(required_input_cde);
                 });
+            });
 
-                const body = {
-                    'cde_code': cde_code,
-                    'patient_date_of_birth': patient_date_of_birth,
-                    'patient_sex': patient_sex,
-                    'form_values': calculated_cde_inputs_json_values
-                };
-
-                fetch(wsurl, {
-                    method: 'post',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-CSRFToken': $("[name=csrfmiddlewaretoken]").val()
-                    },
-                    body: JSON.stringify(body)
+            const body = {
+                'cde_codes': cde_codes,
+                'patient_date_of_birth': patient_date_of_birth,
+                'patient_sex': patient_sex,
+                'patient_id': patient_id,
+                'registry_code': registry_code,
+                'form_values': form_values
+            };
+
+            fetch(wsurl, {
+                method: 'post',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': $("[name=csrfmiddlewaretoken]").val()
+                },
+                body: JSON.stringify(body)
+            })
+                .then(function (response) {
+                    if (!response.ok) {
+                        throw new Error(response.statusText);
+                    }
+                    return response.json()
                 })
-                    .then(function (response) {
-                        if (!response.ok) {
-                            throw new Error(response.statusText);
-                        }
-                        return response.json()
-                    })
-                    .then(function (result) {
-                        if (result.stat === "fail") {
-                            throw new Error(result.message);
-                        }
-                        $("[id$=__".concat(cde_code, "]")).val(result);
-                        $("[id$=__".concat(cde_code, "]")).trigger("change");
-                    })
-                    .catch(function (errormsg) {
-                        console.log(errormsg);
+                .then(function (result) {
+                    if (result.stat === "fail") {
+                        throw new Error(result.message);
+                    }
+                    Object.keys(result.values).forEach(cde_code => {
+                        $(`[id$=__${cde_code}]`).val(result.values[cde_code]);
+                        // dependents are already calculated so only other listeners react
+                        $(`[id$=__${cde_code}]`).trigger("change", [true]);
                     });
-            });
+                    Object.keys(result.errors).forEach(cde_code => {
+                        console.log(`${cde_code}: ${result.errors[cde_code]}`);
+                    });
+                })
+                .catch(function (errormsg) {
+                    console.log(errormsg);
+                });
         }
 
+        // the calculated cdes registered while the page loads are calculated together
+        let pending_observers = [];
+        const update_pending = _.debounce(() => {
+            const observers = pending_observers;
+            pending_observers = [];
+            update_function(observers);
+        }, 0);
+
         $.fn.add_calculation = function (options) {
 
             patient_date_of_birth = options.patient_date_of_birth;
@@ -82,12 +113,17 @@
 
             try {
                 // call on initial page load
-                update_function([options.observer]); //call it to ensure if calculation changes on server
+                pending_observers.push(options.observer);
+                update_pending(); //call it to ensure if calculation changes on server
 
                 //update the onchange
                 Object.keys(required_cde_inputs).forEach(function (cde_input) {
                     $(`[id$=__${cde_input}]`).off("change");
-                    $(`[id$=__${cde_input}]`).on('change keyup', _.debounce((e) => {update_function(required_cde_inputs[cde_input])}, 250))
+                    $(`[id$=__${cde_input}]`).on('change keyup', _.debounce((e, calculated) => {
+                        if (!calculated) {
+                            update_function(required_cde_inputs[cde_input]);
+                        }
+                    }, 250))
                 });
 
             } catch (err) {
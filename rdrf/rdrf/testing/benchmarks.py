@@ -0,0 +1,294 @@
+"""
+End to end performance benchmarks.
+
+Each benchmark times one unit of work against a registry - a form GET or
+POST, a page of the patient listing, form progress, a longitudinal
+spreadsheet, the reporting tables, the explorer queries - several times,
+counting the queries each run makes ( see rdrf.helpers.profiling ). Run them
+against a registry filled by generate_registry_data; the run_benchmarks
+command writes the results as json so runs on different commits can be
+compared.
+"""
+from collections import OrderedDict
+from itertools import cycle
+from tempfile import NamedTemporaryFile
+import datetime
+import json
+import statistics
+import subprocess
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.test import Client
+from django.urls import reverse
+
+from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.helpers.profiling import profile_request
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.helpers.utils import mongo_key
+from rdrf.models.definition.models import ClinicalData, RDRFContext
+from registry.patients.models import Patient
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# name -> function(BenchmarkContext) returning the function to time, or None to skip
+BENCHMARKS = OrderedDict()
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchmarkContext(object):
+
+    def __init__(self, registry_model, user, sample_size=20, reporting_db="reporting"):
+        self.registry_model = registry_model
+        self.graph = get_registry_graph(registry_model)
+        self.user = user
+        self.reporting_db = reporting_db
+        self.sample = self._get_sample(sample_size)
+        self.client = Client(SERVER_NAME=self._host())
+        self.client.force_login(user)
+
+    def _host(self):
+        hosts = [host.lstrip(".") for host in settings.ALLOWED_HOSTS if host != "*"]
+        return hosts[0] if hosts else "localhost"
+
+    def _get_sample(self, sample_size):
+        """
+        :return: (patient, context, form models) of the first contexts which have forms
+        """
+        contexts = list(RDRFContext.objects.filter(registry=self.registry_model,
+                                                   content_type=ContentType.objects.get_for_model(Patient))
+                                           .select_related("context_form_group")
+                                           .order_by("pk")[:sample_size])
+        patients = Patient.objects.in_bulk(set(context.object_id for context in contexts))
+        sample = []
+        for context in contexts:
+            cfg = context.context_form_group
+            form_models = [form_model for form_model in (cfg.forms if cfg else self.graph.forms)
+                           if self.graph.section_models(form_model)]
+            if form_models and context.object_id in patients:
+                sample.append((patients[context.object_id], context, form_models))
+        if not sample:
+            raise BenchmarkError("Registry %s has no patients with forms - see generate_registry_data" %
+                                 self.registry_model.code)
+        return sample
+
+    def form_urls(self):
+        return [reverse("registry_form", args=[self.registry_model.code, form_model.pk, patient.pk, context.pk])
+                for patient, context, form_models in self.sample
+                for form_model in form_models]
+
+    def form_post_data(self, patient, context, form_model):
+        record = (ClinicalData.objects.collection(self.registry_model.code, "cdes")
+                                      .filter(django_model="Patient", django_id=patient.pk, context_id=context.pk)
+                                      .data().first()) or {}
+        form_dict = next((f for f in record.get("forms", []) if f.get("name") == form_model.name), {})
+        section_dicts = {section_dict["code"]: section_dict for section_dict in form_dict.get("sections", [])}
+        data = {}
+        for section_model in self.graph.section_models(form_model):
+            cdes = section_dicts.get(section_model.code, {}).get("cdes", [])
+            if section_model.allow_multiple:
+                prefix = "formset_%s" % section_model.code
+                data["%s-TOTAL_FORMS" % prefix] = len(cdes)
+                data["%s-INITIAL_FORMS" % prefix] = len(cdes)
+                for index, item in enumerate(cdes):
+                    for cde_dict in item:
+                        field_key = mongo_key(form_model.name, section_model.code, cde_dict["code"])
+                        key = "%s-%s-%s" % (prefix, index, field_key)
+                        self._add_value(data, key, cde_dict["value"])
+            else:
+                for cde_dict in cdes:
+                    self._add_value(data, mongo_key(form_model.name, section_model.code, cde_dict["code"]),
+                                    cde_dict["value"])
+        return data
+
+    def _add_value(self, data, key, value):
+        if value is None or value is False:
+            return
+        data[key] = "on" if value is True else value
+
+
+def _check_response(response):
+    if response.status_code >= 400:
+        raise BenchmarkError("%s response" % response.status_code)
+
+
+@benchmark("form_get")
+def form_get(context):
+    urls = cycle(context.form_urls())
+    return lambda: _check_response(context.client.get(next(urls)))
+
+
+@benchmark("form_post")
+def form_post(context):
+    posts = cycle([(reverse("registry_form", args=[context.registry_model.code, form_model.pk, patient.pk, rdrf_context.pk]),
+                    context.form_post_data(patient, rdrf_context, form_model))
+                   for patient, rdrf_context, form_models in context.sample
+                   for form_model in form_models])
+
+    def post():
+        url, data = next(posts)
+        _check_response(context.client.post(url, data))
+    return post
+
+
+@benchmark("patient_listing")
+def patient_listing(context):
+    url = "%s?registry_code=%s" % (reverse("patientslisting"), context.registry_model.code)
+    page_size = 20
+    pages = cycle(range(5))
+
+    def listing_page():
+        data = {"draw": 1,
+                "start": next(pages) * page_size,
+                "length": page_size,
+                "search[value]": "",
+                "columns[0][data]": "full_name",
+                "order[0][column]": 0,
+                "order[0][dir]": "asc"}
+        _check_response(context.client.post(url, data))
+    return listing_page
+
+
+@benchmark("form_progress")
+def form_progress(context):
+    def progress():
+        form_progress = FormProgress(context.registry_model)
+        for patient, rdrf_context, form_models in context.sample:
+            for form_model in form_models:
+                form_progress.get_form_progress(form_model, patient, rdrf_context)
+    return progress
+
+
+@benchmark("spreadsheet_report")
+def spreadsheet_report(context):
+    from explorer.models import Query
+    from explorer.views import Humaniser
+    from rdrf.services.io.reporting.spreadsheet_report import SpreadSheetReport
+
+    projection = [{"formName": form_model.name, "sectionCode": section_model.code,
+                   "cdeCode": cde_model.code, "longitudinal": True}
+                  for form_model in context.graph.forms
+                  for section_model in context.graph.section_models(form_model)
+                  if not section_model.allow_multiple
+                  for cde_model in context.graph.cde_models(section_model)]
+    config = {"static_sheets": [{"name": "patients",
+                                 "columns": ["id", "family_name", "given_names", "date_of_birth", "sex"]}],
+              "universal_columns": ["id"]}
+    query_model = Query(title="benchmark", registry=context.registry_model, mongo_search_type="M",
+                        projection=json.dumps(projection), sql_query=json.dumps(config))
+
+    def report():
+        with NamedTemporaryFile(suffix=".xlsx") as output:
+            SpreadSheetReport(query_model, Humaniser(context.registry_model), streaming=True).run(output.name)
+    return report
+
+
+@benchmark("reporting_generator")
+def reporting_generator(context):
+    from rdrf.reports.generator import Generator
+    return lambda: Generator(context.registry_model, db=context.reporting_db).create_tables()
+
+
+@benchmark("explorer_queries")
+def explorer_queries(context):
+    from explorer.models import Query
+    from explorer.utils import DatabaseUtils
+    from explorer.views import Humaniser, MultisectionHandler
+    from rdrf.services.io.reporting.reporting_table import ReportingTableGenerator
+
+    query_models = list(Query.objects.filter(registry=context.registry_model, mongo_search_type__in=["C", "L"]))
+    if not query_models:
+        return None
+
+    def run_queries():
+        for query_model in query_models:
+            rtg = ReportingTableGenerator(context.user,
+                                          context.registry_model,
+                                          MultisectionHandler({}),
+                                          Humaniser(context.registry_model),
+                                          max_items=query_model.max_items)
+            rtg.set_table_name(query_model)
+            DatabaseUtils(query_model).dump_results_into_reportingdb(reporting_table_generator=rtg)
+    return run_queries
+
+
+def run_benchmark(name, context, runs=5):
+    """
+    :return: a dict of the timings of a benchmark ( milliseconds ) and its queries per run
+    """
+    result = OrderedDict([("name", name)])
+    try:
+        func = BENCHMARKS[name](context)
+        if func is None:
+            result["skipped"] = True
+            return result
+        timings = []
+        queries = []
+        for _ in range(runs):
+            with profile_request() as profile:
+                start = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(profile.queries))
+    except Exception as ex:
+        logger.exception("Benchmark %s failed" % name)
+        result["error"] = str(ex)
+        return result
+
+    result["runs"] = runs
+    result["min_ms"] = round(min(timings), 1)
+    result["median_ms"] = round(statistics.median(timings), 1)
+    result["mean_ms"] = round(statistics.mean(timings), 1)
+    result["max_ms"] = round(max(timings), 1)
+    result["mean_queries"] = round(statistics.mean(queries), 1)
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(registry_model, user, names=None, runs=5, sample_size=20, reporting_db="reporting"):
+    """
+    :return: the results document - registry, commit, time and the result of each benchmark
+    """
+    context = BenchmarkContext(registry_model, user, sample_size=sample_size, reporting_db=reporting_db)
+    return OrderedDict([
+        ("registry", registry_model.code),
+        ("patients", Patient.objects.filter(rdrf_registry=registry_model).count()),
+        ("commit", current_commit()),
+        ("created", datetime.datetime.now().isoformat()),
+        ("results", [run_benchmark(name, context, runs) for name in (names or BENCHMARKS)]),
+    ])
+
+
+def compare_results(baseline, results, threshold=1.2):
+    """
+    :return: (name, baseline median, median, ratio, regressed) of each benchmark both documents timed
+    """
+    baseline_medians = {r["name"]: r["median_ms"] for r in baseline["results"] if "median_ms" in r}
+    comparison = []
+    for result in results["results"]:
+        old = baseline_medians.get(result["name"])
+        if old is None or "median_ms" not in result:
+            continue
+        ratio = result["median_ms"] / old if old else None
+        comparison.append((result["name"], old, result["median_ms"], ratio,
+                           ratio is not None and ratio > threshold))
+    return comparison
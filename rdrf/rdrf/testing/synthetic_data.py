@@ -0,0 +1,251 @@
+"""
+Synthetic registry data for performance testing.
+
+SyntheticDataGenerator fills a registry ( usually imported from a definition
+yaml ) with random patients, their contexts, a cdes record per context with
+random values for every cde of the context's forms, a history of earlier
+versions of each record and form progress. Everything is written with bulk
+inserts in batches so registries of realistic size can be made quickly.
+Values respect the datatype, permitted values and min / max of each cde;
+calculated cdes are calculated as a form save would.
+"""
+from collections import OrderedDict
+import copy
+import datetime
+import random
+import string
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+
+from rdrf.forms.fields.calculation_engine import CalculationEngine
+from rdrf.forms.progress.bulk_progress import BulkProgressCalculator
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.models.definition.models import ClinicalData, ContextFormGroup, RDRFContext
+from registry.groups.models import WorkingGroup
+from registry.patients.models import Patient
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# username recorded in the history snapshots of generated records
+SYNTHETIC_USER = "Synthetic data generator"
+
+FAMILY_NAMES = ["Smith", "Nguyen", "Jones", "Williams", "Brown", "Wilson", "Taylor", "Johnson",
+                "White", "Martin", "Anderson", "Thompson", "Lee", "Walker", "Harris", "Ryan"]
+GIVEN_NAMES = ["Olivia", "Jack", "Charlotte", "William", "Mia", "Noah", "Amelia", "Thomas",
+               "Isla", "James", "Grace", "Oliver", "Ava", "Lucas", "Chloe", "Ethan"]
+
+
+class SyntheticDataGenerator(object):
+
+    def __init__(self, registry_model, contexts=1, forms=None, multisection_items=2,
+                 history=3, fill_ratio=0.9, batch_size=200, seed=None):
+        """
+        :param contexts: contexts per patient ( for registries with contexts )
+        :param forms: maximum forms filled per context, all if None
+        :param multisection_items: items per multisection
+        :param history: earlier versions of each record kept in history
+        :param fill_ratio: chance of a cde having a value
+        """
+        self.registry_model = registry_model
+        self.graph = get_registry_graph(registry_model)
+        self.contexts = max(contexts, 1)
+        self.forms = forms
+        self.multisection_items = multisection_items
+        self.history = history
+        self.fill_ratio = fill_ratio
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.calculation_engine = CalculationEngine(registry_model)
+        self.progress_calculator = BulkProgressCalculator(registry_model, batch_size)
+        self.content_type = ContentType.objects.get_for_model(Patient)
+        self.working_groups = self._get_working_groups()
+        self.context_form_groups = self._get_context_form_groups()
+        # ids of the patients generated so far
+        self.patient_ids = []
+
+    def _get_working_groups(self):
+        working_groups = list(WorkingGroup.objects.filter(registry=self.registry_model))
+        if not working_groups:
+            working_groups = [WorkingGroup.objects.create(name="%s Synthetic Working Group" % self.registry_model.code,
+                                                          registry=self.registry_model)]
+        return working_groups
+
+    def _get_context_form_groups(self):
+        """
+        :return: the form group ( or None ) of each context of a patient
+        """
+        cfgs = list(ContextFormGroup.objects.filter(registry=self.registry_model).order_by("-is_default", "pk"))
+        if not cfgs:
+            num_contexts = self.contexts if self.registry_model.has_feature("contexts") else 1
+            return [None] * num_contexts
+        fixed = [cfg for cfg in cfgs if cfg.context_type == "F"]
+        multiple = [cfg for cfg in cfgs if cfg.context_type == "M"]
+        context_form_groups = list(fixed)
+        while multiple and len(context_form_groups) < self.contexts:
+            context_form_groups.append(multiple[(len(context_form_groups) - len(fixed)) % len(multiple)])
+        return context_form_groups or cfgs[:1]
+
+    def _context_forms(self, context_form_group):
+        form_models = context_form_group.forms if context_form_group else self.graph.forms
+        form_models = [form_model for form_model in form_models if self.graph.section_models(form_model)]
+        if self.forms is not None and len(form_models) > self.forms:
+            form_models = sorted(self.random.sample(form_models, self.forms), key=lambda f: f.position)
+        return form_models
+
+    # values
+
+    def cde_value(self, cde_model):
+        datatype = cde_model.datatype.strip().lower()
+        if datatype in ("calculated", "file") or self.random.random() > self.fill_ratio:
+            return None
+        if cde_model.pv_group_id:
+            codes = [pv.code for pv in self.graph.permitted_values(cde_model.pv_group_id)] or [None]
+            if cde_model.allow_multiple:
+                return self.random.sample(codes, self.random.randint(1, len(codes)))
+            return self.random.choice(codes)
+        if datatype == "integer":
+            return self.random.randint(*self._limits(cde_model, 0, 100))
+        if datatype == "float":
+            return round(self.random.uniform(*self._limits(cde_model, 0, 100)), 2)
+        if datatype == "boolean":
+            return self.random.random() < 0.5
+        if datatype == "date":
+            return self._random_date(datetime.date(1950, 1, 1)).isoformat()
+        return self._random_text(min(cde_model.max_length or 40, 40))
+
+    def _limits(self, cde_model, low, high):
+        low = int(cde_model.min_value) if cde_model.min_value is not None else low
+        high = int(cde_model.max_value) if cde_model.max_value is not None else max(high, low)
+        return low, high
+
+    def _random_date(self, start, end=None):
+        end = end or datetime.date.today()
+        return start + datetime.timedelta(days=self.random.randint(0, max((end - start).days, 0)))
+
+    def _random_text(self, max_length):
+        length = self.random.randint(1, max(max_length, 1))
+        return "".join(self.random.choice(string.ascii_letters + " ") for _ in range(length)).strip() or "x"
+
+    def section_dict(self, section_model):
+        cde_models = self.graph.cde_models(section_model)
+        if section_model.allow_multiple:
+            cdes = [[{"code": cde_model.code, "value": self.cde_value(cde_model)} for cde_model in cde_models]
+                    for _ in range(self.multisection_items)]
+        else:
+            cdes = [{"code": cde_model.code, "value": self.cde_value(cde_model)} for cde_model in cde_models]
+        return {"code": section_model.code, "allow_multiple": section_model.allow_multiple, "cdes": cdes}
+
+    def form_dict(self, form_model):
+        return {"name": form_model.name,
+                "sections": [self.section_dict(section_model)
+                             for section_model in self.graph.section_models(form_model)]}
+
+    # records
+
+    def record_versions(self, patient_model, context_id, form_models, last_saved):
+        """
+        :return: the versions of a cdes record, oldest first, as successive form saves would leave it
+        """
+        # every form is filled in, then some are saved again
+        saves = list(form_models) + [self.random.choice(form_models) for _ in range(self.history)]
+        timestamps = [last_saved]
+        for _ in saves[1:]:
+            timestamps.append(timestamps[-1] - datetime.timedelta(days=self.random.randint(1, 60)))
+
+        data = {"context_id": context_id, "forms": []}
+        versions = []
+        for form_model, timestamp in zip(saves, reversed(timestamps)):
+            timestamp = timestamp.isoformat()
+            form_dicts = OrderedDict((form_dict["name"], form_dict) for form_dict in data["forms"])
+            form_dicts[form_model.name] = self.form_dict(form_model)
+            data = dict(data, forms=list(form_dicts.values()))
+            data["%s_timestamp" % form_model.name] = timestamp
+            data["timestamp"] = timestamp
+            self.calculation_engine.calculate(patient_model, data)
+            versions.append((form_model.name, timestamp, copy.deepcopy(data)))
+        return versions
+
+    def generate(self, num_patients):
+        """
+        :return: generator of the number of patients created as each batch completes
+        """
+        created = 0
+        while created < num_patients:
+            size = min(self.batch_size, num_patients - created)
+            with transaction.atomic(), transaction.atomic(using=router.db_for_write(ClinicalData)):
+                self._generate_batch(size)
+            created += size
+            yield size
+
+    def _generate_batch(self, size):
+        patients = Patient.objects.bulk_create([self._patient() for _ in range(size)])
+        self.patient_ids.extend(patient.pk for patient in patients)
+        Patient.rdrf_registry.through.objects.bulk_create(
+            [Patient.rdrf_registry.through(patient_id=patient.pk, registry_id=self.registry_model.pk)
+             for patient in patients])
+        Patient.working_groups.through.objects.bulk_create(
+            [Patient.working_groups.through(patient_id=patient.pk, workinggroup_id=self.random.choice(self.working_groups).pk)
+             for patient in patients])
+
+        contexts = []
+        for patient in patients:
+            for cfg in self.context_form_groups:
+                contexts.append((patient, cfg, RDRFContext(registry=self.registry_model,
+                                                           content_type=self.content_type,
+                                                           object_id=patient.pk,
+                                                           context_form_group=cfg,
+                                                           display_name=cfg.name if cfg else "default")))
+        RDRFContext.objects.bulk_create([context for _, _, context in contexts])
+
+        records = []
+        snapshots = []
+        progress = []
+        now = datetime.datetime.now()
+        for patient, cfg, context in contexts:
+            form_models = self._context_forms(cfg)
+            if not form_models:
+                continue
+            last_saved = now - datetime.timedelta(days=self.random.randint(0, 730))
+            versions = self.record_versions(patient, context.pk, form_models, last_saved)
+            data = versions[-1][2]
+            records.append(ClinicalData.create(patient, registry_code=self.registry_model.code,
+                                               collection="cdes", context_id=context.pk, data=data))
+            for form_name, timestamp, version in versions:
+                snapshot = {"context_id": context.pk,
+                            "registry_code": self.registry_model.code,
+                            "record_type": "snapshot",
+                            "username": SYNTHETIC_USER,
+                            "timestamp": timestamp,
+                            "form_user": SYNTHETIC_USER,
+                            "form_name": form_name,
+                            "record": version}
+                snapshots.append(ClinicalData.create(patient, registry_code=self.registry_model.code,
+                                                     collection="history", context_id=context.pk, data=snapshot))
+            progress.append((patient.pk, context.pk, data))
+
+        ClinicalData.objects.bulk_create(records, batch_size=self.batch_size)
+        ClinicalData.objects.bulk_create(snapshots, batch_size=self.batch_size)
+        self.progress_calculator.update_records(progress)
+
+    def _patient(self):
+        sex = self.random.choice(["1", "2"])
+        return Patient(family_name=self.random.choice(FAMILY_NAMES),
+                       given_names=self.random.choice(GIVEN_NAMES),
+                       date_of_birth=self._random_date(datetime.date(1930, 1, 1)),
+                       sex=sex,
+                       consent=True,
+                       active=True)
+
+    def finish(self):
+        # history written in full is re-encoded as the settings ask - only the
+        # generated patients', the registry may have history of its own
+        if settings.HISTORY_STORAGE == "deltas":
+            from rdrf.db.history import compact_history
+            for i in range(0, len(self.patient_ids), self.batch_size):
+                for _ in compact_history(self.registry_model.code,
+                                         patient_ids=self.patient_ids[i:i + self.batch_size]):
+                    pass
@@ -114,6 +114,24 @@ class CalculatedFunctionsTestCase(TestCase):
         self.assertEqual(calculated_functions.LDLCholesterolAdjTreatment(
             self.patient_values, self.form_values), '21.74')
 
+    def test_evaluate_calculations(self):
+        from rdrf.forms.fields.calculation_engine import evaluate_calculations
+        # CDE00024 reads LDLCholesterolAdjTreatment so it must be calculated last
+        self.form_values = {'CDE00003': 'fh2_y',
+                            'CDE00004': 'fh2_y',
+                            'CDE00013': 10.0,
+                            'CDE00019': 10.0,
+                            'CDEfhDutchLipidClinicNetwork': '24',
+                            'CDEIndexOrRelative': 'fh_is_index',
+                            'DateOfAssessment': '2019-05-10',
+                            'FHFamHistArcusCornealis': 'fh2_y',
+                            'FHFamHistTendonXanthoma': 'fh2_y',
+                            'PlasmaLipidTreatment': 'FAEzetimibe/atorvastatin20'}
+        values, errors = evaluate_calculations(["CDE00024", "LDLCholesterolAdjTreatment"],
+                                               self.patient_values, self.form_values)
+        self.assertEqual(list(values.items()), [("LDLCholesterolAdjTreatment", "21.74"), ("CDE00024", "Definite")])
+        self.assertEqual(errors, {})
+
     def test_cdebmi(self):
         self.form_values = {'CDEHeight': "",
                             'CDEWeight': ""}
@@ -425,6 +443,25 @@ class TestFormPermissions(RDRFTestCase):
         f.save()
         assert not genetic_user.can_view(f), "A form set to be viewed "
 
+    def test_request_cache_invalidated_by_group_changes(self):
+        from rdrf.helpers.request_cache import start_request_cache, end_request_cache
+        fh = Registry.objects.get(code='fh')
+        user = CustomUser.objects.get(username='genetic')
+        user.registry.add(fh)
+        clinical_group, _ = Group.objects.get_or_create(name="Clinical Staff")
+        f = fh.forms[0]
+        f.groups_allowed.set([clinical_group])
+        start_request_cache()
+        try:
+            self.assertFalse(user.can_view(f))
+            self.assertFalse(user.in_group("clinical"))
+            user.groups.add(clinical_group)
+            self.assertTrue(user.in_group("clinical"))
+            self.assertTrue(user.can_view(f))
+            self.assertEqual(fh.has_feature("no_such_feature"), False)
+        finally:
+            end_request_cache()
+
 
 class ExporterTestCase(RDRFTestCase):
 
@@ -524,6 +561,26 @@ class ExporterTestCase(RDRFTestCase):
         return values
 
 
+class JsonLinesExportTestCase(TestCase):
+
+    def test_export_and_import_json_lines(self):
+        import tempfile
+        from registry.genetic.models import Gene
+        from rdrf.services.io.content.export_import.exporters import JSONL_GZ, ModelExporter, export_model
+        from rdrf.services.io.content.export_import.importers import ModelImporter
+        for symbol in ("A", "B", "C"):
+            Gene.objects.create(symbol=symbol, hgnc_id=symbol, name=symbol, status="", chromosome="",
+                                accession_numbers="", refseq_id="")
+        workdir = tempfile.mkdtemp()
+        meta = export_model(ModelExporter, "genetic.Gene", {"workdir": workdir, "format": JSONL_GZ, "chunk_size": 2})
+        self.assertEqual(meta["format"], JSONL_GZ)
+        self.assertEqual(meta["object_count"], 3)
+
+        Gene.objects.all().delete()
+        ModelImporter().do_import(meta, workdir, logger=logger)
+        self.assertEqual(sorted(Gene.objects.values_list("symbol", flat=True)), ["A", "B", "C"])
+
+
 class ImporterTestCase(TestCase):
 
     def _get_yaml_file(self):
@@ -788,6 +845,739 @@ class LongitudinalTestCase(FormTestCase):
                           "Each  snapshot should record dict contain a forms field")
 
 
+class SpreadSheetReportTestCase(FormTestCase):
+
+    def _save_name(self, patient, context_model, name):
+        ff = FormFiller(self.simple_form)
+        ff.sectionA.CDEName = name
+        request = self._create_request(self.simple_form, ff.data)
+        view = FormView()
+        view.request = request
+        view.post(request, self.registry.code, self.simple_form.pk, patient.pk, context_model.pk)
+
+    def test_streaming_report(self):
+        import openpyxl
+        from tempfile import NamedTemporaryFile
+        from explorer.models import Query
+        from explorer.views import Humaniser
+        from rdrf.services.io.reporting.spreadsheet_report import SpreadSheetReport
+
+        fred = self.patient
+        self._save_name(fred, self.default_context, "Fred")
+        self._save_name(fred, self.default_context, "Wilma")
+        barney = self.create_patient()
+        self._save_name(barney, self.default_context, "Barney")
+        # no clinical data
+        dino = self.create_patient()
+
+        projection = [{"formName": self.simple_form.name, "sectionCode": self.sectionA.code,
+                       "cdeCode": "CDEName", "longitudinal": True}]
+        config = {"static_sheets": [{"name": "patients", "columns": ["id"]}],
+                  "universal_columns": ["id"]}
+        query_model = Query(title="streaming", registry=self.registry, mongo_search_type="M",
+                            projection=json.dumps(projection), sql_query=json.dumps(config))
+
+        # two batches of patients
+        report = SpreadSheetReport(query_model, Humaniser(self.registry), streaming=True, batch_size=2)
+        with NamedTemporaryFile(suffix=".xlsx") as output:
+            report.run(output.name)
+            work_book = openpyxl.load_workbook(output.name)
+
+        self.assertEqual(work_book.sheetnames, ["FHpatients", "FHsectionA"])
+        rows = list(work_book["FHpatients"].values)
+        self.assertEqual(rows, [("id",), (fred.pk,), (barney.pk,), (dino.pk,)])
+
+        # a block of columns per snapshot then the current timestamp
+        rows = list(work_book["FHsectionA"].values)
+        self.assertEqual(rows[0][:5], ("id", "DATE_SIMPLE/sectionA", "CDEName", "DATE_SIMPLE/sectionA", "CDEName"))
+        names = {row[0]: [value for value in row[2::2] if value is not None] for row in rows[1:]}
+        self.assertEqual(names, {fred.pk: ["Fred", "Wilma"], barney.pk: ["Barney"], dino.pk: []})
+
+
+class ClinicalDataBatchTestCase(FormTestCase):
+
+    def test_load_batch(self):
+        from rdrf.db.dynamic_data import DynamicDataWrapper
+        super(ClinicalDataBatchTestCase, self).test_simple_form()
+        context_id = self.patient.default_context(self.registry).id
+        collection = ClinicalData.objects.collection(self.registry.code, "cdes")
+        record = collection.find(self.patient, context_id).data().first()
+
+        key = (self.patient.pk, context_id)
+        batch = DynamicDataWrapper.load_batch(self.registry.code, [(self.patient, context_id),
+                                                                   (self.patient.pk, None),
+                                                                   (self.patient.pk, context_id + 1000)])
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch[key], record)
+        self.assertEqual(batch[(self.patient.pk, None)], record)
+        self.assertIsNone(batch[(self.patient.pk, context_id + 1000)])
+        name_key = self._create_form_key(self.simple_form, self.sectionA, "CDEName")
+        self.assertEqual(batch.flattened(key)[name_key], "Fred")
+
+        projected = DynamicDataWrapper.load_batch(self.registry.code, [key], form_names=["multi"])
+        self.assertEqual(projected[key]["forms"], [])
+        self.assertEqual(projected[key]["context_id"], record["context_id"])
+
+
+class CdeLookupTestCase(FormTestCase):
+
+    def test_cde_values(self):
+        super(CdeLookupTestCase, self).test_simple_form()
+        context_id = self.patient.default_context(self.registry).id
+        collection = ClinicalData.objects.collection(self.registry.code, "cdes")
+        self.assertEqual(collection.find(self.patient).cde_values("simple", "sectionA", "CDEName"),
+                         [(self.patient.pk, context_id, {"code": "CDEName", "value": "Fred"})])
+        self.assertIsNone(collection.find(self.patient).cde_value("simple", "sectionA", "CDEHeight"))
+        self.assertIsNone(collection.find(self.patient).cde_value("multi", "sectionC", "CDEName", True))
+        self.assertEqual(self.patient.get_form_value(self.registry.code, "simple", "sectionB", "CDEHeight",
+                                                     context_id=context_id), 1.73)
+        with self.assertRaises(KeyError):
+            self.patient.get_form_value(self.registry.code, "multi", "sectionC", "CDEName",
+                                        multisection=True, context_id=context_id)
+
+    def test_cde_searches(self):
+        super(CdeLookupTestCase, self).test_simple_form()
+        collection = ClinicalData.objects.collection(self.registry.code, "cdes")
+        self.assertEqual(collection.cde_contains("simple", "sectionA", "CDEName", "Fred").count(), 1)
+        self.assertEqual(collection.cde_contains("simple", "sectionA", "CDEName", "Barney").count(), 0)
+        self.assertEqual(collection.cde_equals("simple", "sectionA", "CDEAge", 20).count(), 1)
+        self.assertEqual(collection.cde_equals("simple", "sectionA", "CDEAge", 21).count(), 0)
+        self.assertEqual(list(collection.with_cde_value("simple", "sectionA", "CDEName")
+                                        .values_list("cde_value", flat=True)), ["Fred"])
+
+    def test_contexts_ordered_by_naming_cde(self):
+        from rdrf.db import clinical_indexes
+        from rdrf.models.definition.models import ContextFormGroup, RDRFContext
+        context_form_group = ContextFormGroup.objects.create(registry=self.registry, context_type="M", name="Visit",
+                                                             naming_scheme="C", ordering="N",
+                                                             naming_cde_to_use="simple/sectionA/CDEName")
+        self.assertEqual(clinical_indexes.declared_cde_paths(self.registry), ["simple/sectionA/CDEName"])
+        context_names = {}
+        for name in ["Barney", None, "Fred"]:
+            context_model = RDRFContext.objects.create(registry=self.registry, context_form_group=context_form_group,
+                                                       content_object=self.patient, display_name="Visit")
+            context_names[context_model.pk] = name
+            if name is not None:
+                cdes = [{"code": "CDEName", "value": name}]
+                sections = [{"code": "sectionA", "allow_multiple": False, "cdes": cdes}]
+                ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                                    context_id=context_model.pk,
+                                    data={"context_id": context_model.pk,
+                                          "forms": [{"name": "simple", "sections": sections}]}).save()
+        contexts = self.patient.get_multiple_contexts(context_form_group)
+        self.assertEqual([context_names[context_model.pk] for context_model in contexts], ["Fred", "Barney", None])
+
+    def test_currency_and_genetic_data_flags(self):
+        super(CdeLookupTestCase, self).test_simple_form()
+        self.assertEqual(self.patient.clinical_data_currency()[self.registry.code], True)
+        self.assertEqual(self.patient.genetic_data_map[self.registry.code], False)
+
+
+class PatientStatusReportTestCase(FormTestCase):
+
+    def test_report_rows(self):
+        from rdrf.services.io.actions.patient_status_report import ReportGenerator
+        context_id = self.default_context.pk
+        cdes = [{"code": "CDEName", "value": "Fred"}, {"code": "CDEAge", "value": None}]
+        ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                            context_id=context_id,
+                            data={"context_id": context_id,
+                                  "forms": [{"name": "simple",
+                                             "sections": [{"code": "sectionA", "allow_multiple": False,
+                                                           "cdes": cdes}]}]}).save()
+        spec = json.dumps({"columns": [{"type": "demographics", "name": "id", "label": "ID"},
+                                       {"type": "%", "name": "simple"},
+                                       {"type": "cde", "name": "simple/sectionA/CDEName"},
+                                       {"type": "consent", "name": "none/none"}]})
+        report_generator = ReportGenerator(self.registry, "status", spec, self.user)
+        report_generator.generate_report()
+        self.assertEqual(report_generator.report,
+                         [["ID", "simple", "simple/sectionA/CDEName", "none/none"],
+                          [self.patient.pk, 20.0, "Fred", "False"]])
+        self.assertEqual(len(list(report_generator.stream_csv())), 2)
+
+    def test_bad_spec_raises_before_streaming(self):
+        from rdrf.services.io.actions.patient_status_report import ReportGenerator, ReportParserException
+        spec = json.dumps({"columns": [{"type": "completion", "name": "nosuchform"}]})
+        report_generator = ReportGenerator(self.registry, "status", spec, self.user)
+        self.assertRaises(ReportParserException, report_generator.stream_csv)
+
+
+class ReportingRefreshTestCase(FormTestCase):
+
+    def tearDown(self):
+        from rdrf.reports.generator import REFRESH_TABLE_NAME
+        generator = self._generator()
+        for table_name in self._table_names(generator):
+            generator._drop_table(table_name)
+        generator._drop_table(REFRESH_TABLE_NAME)
+        super(ReportingRefreshTestCase, self).tearDown()
+
+    def _generator(self):
+        from rdrf.reports.generator import Generator
+        # the reporting tables are written to the test database
+        return Generator(self.registry, db="default")
+
+    def _table_names(self, generator):
+        generator._create_clinical_tables(create=False)
+        return [clinical_table.table.name for clinical_table in generator.clinical_tables]
+
+    def _save_name(self, patient_model, name, last_updated=None):
+        context_id = patient_model.default_context(self.registry).pk
+        cdes = [{"code": "CDEName", "value": name}]
+        forms = [{"name": "simple", "sections": [{"code": "sectionA", "allow_multiple": False, "cdes": cdes}]}]
+        record = ClinicalData.objects.collection(self.registry.code, "cdes").find(patient_model, context_id).first()
+        if record is None:
+            record = ClinicalData.create(patient_model, registry_code=self.registry.code, collection="cdes",
+                                         context_id=context_id, data={"context_id": context_id})
+        record.data["forms"] = forms
+        record.save()
+        if last_updated is not None:
+            # as if saved by a transaction which committed late
+            ClinicalData.objects.filter(pk=record.pk).update(last_updated=last_updated)
+        return record
+
+    def _names(self):
+        # (patient id, CDEName) of the rows of the simple form table
+        generator = self._generator()
+        generator._create_clinical_tables(create=False)
+        table = [t.table for t in generator.clinical_tables if t.form_model.name == "simple"][0]
+        rows = generator.reporting_engine.execute(table.select().order_by(table.c.patient_id))
+        return [(row["patient_id"], row["sectiona_cdename"]) for row in rows]
+
+    def test_refresh_matches_full_build(self):
+        deleted_patient = self.create_patient()
+        self._save_name(self.patient, "Fred")
+        self._save_name(deleted_patient, "Barney")
+        self._generator().create_tables()
+        self.assertEqual(self._names(), [(self.patient.pk, "Fred"), (deleted_patient.pk, "Barney")])
+
+        self._save_name(self.patient, "Wilma")
+        deleted_patient.delete()
+        # contexts without clinical data get rows too
+        new_patient = self.create_patient()
+        call_command("generate_reporting_tables", self.registry.code, db="default", refresh=True)
+        self.assertEqual(self._names(), [(self.patient.pk, "Wilma"), (new_patient.pk, None)])
+
+        ClinicalData.objects.collection(self.registry.code, "cdes").find(self.patient).delete()
+        self._generator().refresh()
+        refreshed = self._names()
+        self.assertEqual(refreshed, [(self.patient.pk, None), (new_patient.pk, None)])
+        self._generator().create_tables()
+        self.assertEqual(self._names(), refreshed)
+
+    def test_refresh_looks_back_before_watermark(self):
+        from rdrf.reports.generator import REFRESH_WATERMARK_MARGIN
+        self._save_name(self.patient, "Fred")
+        generator = self._generator()
+        generator.create_tables()
+        watermark = generator._get_refresh_state()["clinical_data_updated"]
+
+        self._save_name(self.patient, "Barney", last_updated=watermark - REFRESH_WATERMARK_MARGIN / 2)
+        generator = self._generator()
+        generator.refresh()
+        self.assertEqual(self._names(), [(self.patient.pk, "Barney")])
+
+        # changes older than the look back window have been extracted already
+        watermark = generator._get_refresh_state()["clinical_data_updated"]
+        self._save_name(self.patient, "Wilma", last_updated=watermark - REFRESH_WATERMARK_MARGIN * 2)
+        self._generator().refresh()
+        self.assertEqual(self._names(), [(self.patient.pk, "Barney")])
+
+
+class ExplorerStreamingTestCase(FormTestCase):
+
+    def setUp(self):
+        super(ExplorerStreamingTestCase, self).setUp()
+        from explorer.models import Query
+        self.patients = [self.patient] + [self.create_patient() for i in range(4)]
+        self.query_model = Query.objects.create(title="streaming", registry=self.registry, mongo_search_type="C",
+                                                projection="[]", criteria="{}",
+                                                sql_query="SELECT id FROM patients_patient ORDER BY id")
+        self.table_generator = None
+
+    def tearDown(self):
+        if self.table_generator is not None:
+            self.table_generator.drop_table()
+        super(ExplorerStreamingTestCase, self).tearDown()
+
+    def test_row_chunks(self):
+        from explorer.utils import DatabaseUtils
+        database_utils = DatabaseUtils(self.query_model, fetch_size=2)
+        database_utils.cursor = database_utils.create_cursor(server_side=True)
+        chunks = list(database_utils._row_chunks())
+        self.assertEqual([len(rows) for rows in chunks], [2, 2, 1])
+        self.assertEqual([row[0] for rows in chunks for row in rows], [patient.pk for patient in self.patients])
+
+    def test_stream_csv(self):
+        from explorer.utils import DatabaseUtils
+        from explorer.views import Humaniser, MultisectionHandler
+        from rdrf.services.io.reporting.reporting_table import ReportingTableGenerator
+        database_utils = DatabaseUtils(self.query_model, fetch_size=2)
+        self.table_generator = ReportingTableGenerator(self.user, self.registry, MultisectionHandler({}),
+                                                       Humaniser(self.registry), max_items=self.query_model.max_items)
+        self.table_generator.set_table_name(self.query_model)
+        database_utils.dump_results_into_reportingdb(reporting_table_generator=self.table_generator)
+
+        lines = list(self.table_generator.stream_csv())
+        self.assertEqual(lines[0].strip().split(","), ["ID", "CONTEXT_ID", "TIMESTAMP", "SNAPSHOT"])
+        self.assertEqual(sorted(int(line.split(",")[0]) for line in lines[1:]),
+                         [patient.pk for patient in self.patients])
+
+
+class RulesEngineTestCase(FormTestCase):
+
+    def test_compiled_rules(self):
+        from rdrf.workflows.rules_engine import compile_rules, evaluate_patients
+        super(RulesEngineTestCase, self).test_simple_form()
+        context_id = self.patient.default_context(self.registry).id
+        rules = [[["and", ["=", ["get", "simple/sectionA/CDEName"], "Barney"], ["get", "CDENotThere"]],
+                  ["workflow", "never"]],
+                 [["between", ["get", "CDEAge"], 18, 21], ["workflow", "adult"]]]
+        compiled = compile_rules(rules, self.registry)
+        self.assertIs(compiled, compile_rules(rules, self.registry))
+        self.assertEqual(compiled.form_names, ["simple"])
+
+        values = compiled.load_values([(self.patient, context_id)])[(self.patient.pk, context_id)]
+        self.assertEqual(values, {"simple/sectionA/CDEName": "Fred", "CDEAge": 20})
+        self.assertEqual(compiled.match(values), ["workflow", "adult"])
+        self.assertEqual(list(evaluate_patients(rules, self.registry, [self.patient])),
+                         [(self.patient, None, ["workflow", "adult"])])
+
+        # unresolvable cdes only fail when their condition is evaluated
+        with self.assertRaises(ValueError):
+            compiled.match({"simple/sectionA/CDEName": "Barney"})
+
+
+class HistoryDeltaTestCase(TestCase):
+
+    def _record(self, name, age, timestamp):
+        cdes = [{"code": "CDEName", "value": name}, {"code": "CDEAge", "value": age}]
+        sections = [{"code": "sectionA", "allow_multiple": False, "cdes": cdes}]
+        return {"django_id": 1, "context_id": 2, "timestamp": timestamp,
+                "forms": [{"name": "simple", "sections": sections},
+                          {"name": "other", "sections": []}]}
+
+    def test_materialise(self):
+        from rdrf.db.history import diff_records, materialise, cde_series
+        records = [self._record("Fred", 20, "t1"), self._record("Fred", 21, "t2"), self._record("Barney", 21, "t3")]
+        delta = diff_records(records[0], records[1])
+        self.assertEqual(list(delta["forms"]), ["simple"])
+        self.assertEqual(delta["keys"], {"timestamp": "t2"})
+
+        meta = {"registry_code": "fh", "django_model": "Patient", "django_id": 1, "context_id": 2,
+                "record_type": "snapshot"}
+        snapshots = [dict(meta, record=records[0]),
+                     dict(meta, delta=delta, base=1, sequence=1),
+                     dict(meta, delta=diff_records(records[1], records[2]), base=1, sequence=2)]
+        self.assertEqual([snapshot["record"] for snapshot in materialise(snapshots)], records)
+        self.assertEqual([value for _, value in cde_series(snapshots, "simple", "sectionA", "CDEAge")],
+                         [20, 21, 21])
+
+    def _save_snapshots(self, registry_code, django_id, records, encode=False):
+        from rdrf.db.history import delta_encode
+        meta = {"registry_code": registry_code, "django_model": "Patient", "django_id": django_id,
+                "context_id": 2, "record_type": "snapshot"}
+        for record in records:
+            history_model = ClinicalData(registry_code=registry_code, collection="history", django_model="Patient",
+                                         django_id=django_id, context_id=2, data=dict(meta, record=deepcopy(record)))
+            if encode:
+                delta_encode(history_model)
+            history_model.save()
+        return ClinicalData.objects.collection(registry_code, "history").filter(django_id=django_id)
+
+    def _kinds(self, history):
+        from rdrf.db.history import is_delta
+        return ["delta" if is_delta(data) else "full" for data in history.data()]
+
+    def test_delta_encode_checkpoints(self):
+        from django.test import override_settings
+        from rdrf.db.history import materialise, snapshot_record
+        records = [self._record("Fred", age, "t%s" % age) for age in range(7)]
+        with override_settings(HISTORY_CHECKPOINT_INTERVAL=3):
+            history = self._save_snapshots("fh", 1, records, encode=True)
+        self.assertEqual(self._kinds(history), ["full", "delta", "delta", "full", "delta", "delta", "full"])
+        self.assertEqual([data.get("sequence") for data in history.data()], [None, 1, 2, None, 1, 2, None])
+        self.assertEqual([snapshot["record"] for snapshot in materialise(history.data())], records)
+        self.assertEqual([snapshot_record(history_model) for history_model in history], records)
+
+    def test_compact_history(self):
+        from io import StringIO
+        from rdrf.db.history import compact_chain, materialise
+        Registry.objects.create(code="history_test")
+        records = [self._record("Fred", age, "t%s" % age) for age in range(5)]
+        history = self._save_snapshots("history_test", 1, records)
+        other_records = [self._record("Barney", 30, "t0"), self._record("Barney", 31, "t1")]
+        other_history = self._save_snapshots("history_test", 3, other_records)
+
+        def run_command(**options):
+            out = StringIO()
+            call_command("compact_history", registry_code="history_test", stdout=out, **options)
+            return out.getvalue()
+
+        self.assertIn("re-encoded 3 history snapshots", run_command(checkpoint_interval=2))
+        self.assertEqual(self._kinds(history), ["full", "delta", "full", "delta", "full"])
+        self.assertEqual(self._kinds(other_history), ["full", "delta"])
+        self.assertEqual([snapshot["record"] for snapshot in materialise(history.data())], records)
+        self.assertEqual([snapshot["record"] for snapshot in materialise(other_history.data())], other_records)
+
+        # compacting again changes nothing
+        self.assertIn("re-encoded 0 history snapshots", run_command(checkpoint_interval=2))
+        self.assertEqual(compact_chain(list(history), 2), 0)
+
+        run_command(expand=True)
+        self.assertEqual(self._kinds(history), ["full"] * 5)
+        self.assertEqual([data["record"] for data in history.data()], records)
+
+
+class SyntheticDataTestCase(FormTestCase):
+
+    def test_generate(self):
+        from rdrf.testing.synthetic_data import SyntheticDataGenerator
+        existing = list(Patient.objects.values_list("id", flat=True))
+        generator = SyntheticDataGenerator(self.registry, history=2, batch_size=2, seed=1)
+        self.assertEqual(sum(generator.generate(3)), 3)
+        patients = Patient.objects.filter(rdrf_registry=self.registry).exclude(id__in=existing)
+        self.assertEqual(patients.count(), 3)
+        records = ClinicalData.objects.collection(self.registry.code, "cdes").filter(
+            django_id__in=list(patients.values_list("id", flat=True)))
+        self.assertEqual(records.count(), 3)
+        record = records.first().data
+        self.assertEqual(set(f["name"] for f in record["forms"]), set(f.name for f in self.registry.forms))
+        history = ClinicalData.objects.collection(self.registry.code, "history").filter(
+            django_id=record["django_id"], context_id=record["context_id"])
+        self.assertEqual(history.count(), len(record["forms"]) + 2)
+
+    def test_finish_compacts_generated_history(self):
+        from django.test import override_settings
+        from rdrf.db.history import is_delta
+        from rdrf.testing.synthetic_data import SyntheticDataGenerator
+        history = ClinicalData.objects.collection(self.registry.code, "history")
+        for age in (20, 21):
+            ff = FormFiller(self.simple_form)
+            ff.sectionA.CDEAge = age
+            request = self._create_request(self.simple_form, ff.data)
+            view = FormView()
+            view.request = request
+            view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.default_context.pk)
+        existing = list(history.filter(django_id=self.patient.pk).data())
+        self.assertEqual(len(existing), 2)
+
+        generator = SyntheticDataGenerator(self.registry, history=2, batch_size=2, seed=1)
+        with override_settings(HISTORY_STORAGE="deltas"):
+            self.assertEqual(sum(generator.generate(3)), 3)
+            generator.finish()
+        self.assertEqual(len(generator.patient_ids), 3)
+        generated = list(history.filter(django_id__in=generator.patient_ids).data())
+        self.assertTrue(any(is_delta(data) for data in generated))
+        # history the generator didn't write is left alone
+        self.assertEqual(list(history.filter(django_id=self.patient.pk).data()), existing)
+
+
+class ProfilingTestCase(TestCase):
+
+    def test_profile_aggregated_per_url_name(self):
+        from rdrf.helpers.profiling import profile_request, record_profile, profile_summary, reset_profiles
+        from rdrf.helpers.utils import timed
+
+        @timed
+        def hot_path():
+            list(Registry.objects.filter(code="none"))
+
+        reset_profiles()
+        with profile_request() as profile:
+            hot_path()
+            hot_path()
+        self.assertEqual(len(profile.queries), 2)
+        self.assertEqual(profile.duplicate_queries, 1)
+        record_profile("test_url", profile)
+        stats = profile_summary()[0]
+        self.assertEqual(stats["url_name"], "test_url")
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(stats["max_queries"], 2)
+        self.assertEqual(stats["functions"][0]["calls"], 2)
+        self.assertEqual(stats["repeated_queries"][0]["max_per_request"], 2)
+        reset_profiles()
+
+
+class PostSaveJobTestCase(FormTestCase):
+
+    def test_jobs_coalesce_and_run(self):
+        from rdrf.db.post_save import claim_jobs, finish_jobs, form_save_jobs, queue_jobs, run_jobs
+        from rdrf.models.definition.post_save_models import PostSaveJob
+        form_model = self.registry.forms[0]
+        ClinicalData.create(self.patient, registry_code=self.registry.code, collection="cdes",
+                            context_id=self.default_context.pk,
+                            data={"context_id": self.default_context.pk, "forms": []}).save()
+
+        jobs = form_save_jobs(self.registry, self.patient.pk, self.default_context.pk, form_model)
+        self.assertEqual(queue_jobs(jobs), 2)
+        again = form_save_jobs(self.registry, self.patient.pk, self.default_context.pk, form_model)
+        self.assertEqual(queue_jobs(again), 0)
+
+        claimed = claim_jobs()
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(claim_jobs(), [])
+        # saved again while running - the progress job has to run again
+        queue_jobs(form_save_jobs(self.registry, self.patient.pk, self.default_context.pk, form_model)[:1])
+        self.assertEqual(run_jobs(claimed), [])
+        finish_jobs(claimed, [])
+        self.assertEqual(list(PostSaveJob.objects.values_list("kind", flat=True)), [PostSaveJob.PROGRESS])
+        progress = ClinicalData.objects.collection(self.registry.code, "progress").filter(
+            django_id=self.patient.pk, context_id=self.default_context.pk)
+        self.assertEqual(progress.count(), 1)
+
+        # a failed job stays queued until it has been tried MAX_ATTEMPTS times
+        for attempt in range(3):
+            claimed = claim_jobs()
+            self.assertEqual(len(claimed), 1)
+            finish_jobs(claimed, claimed)
+        self.assertFalse(PostSaveJob.objects.exists())
+
+
+class BulkProgressTestCase(FormTestCase):
+
+    def setUp(self):
+        super(BulkProgressTestCase, self).setUp()
+        self.simple_form.complete_form_cdes.set(CommonDataElement.objects.filter(code__in=["CDEName", "CDEAge"]))
+        self.patients = [self.patient]
+        self._save_form(self.patient, self.default_context, name="Fred", age=20)
+        patient = self.create_patient()
+        self._save_form(patient, self.default_context, name="Barney")
+        self.patients.append(patient)
+        # a patient without clinical data
+        self.patients.append(self.create_patient())
+
+    def _save_form(self, patient, context_model, **values):
+        ff = FormFiller(self.simple_form)
+        if "name" in values:
+            ff.sectionA.CDEName = values["name"]
+        if "age" in values:
+            ff.sectionA.CDEAge = values["age"]
+        request = self._create_request(self.simple_form, ff.data)
+        view = FormView()
+        view.request = request
+        view.post(request, self.registry.code, self.simple_form.pk, patient.pk, context_model.pk)
+
+    def _progress(self):
+        from rdrf.models.definition.progress_models import PatientFormProgress
+        records = ClinicalData.objects.collection(self.registry.code, "progress").filter(
+            django_id__in=[patient.pk for patient in self.patients])
+        rows = PatientFormProgress.objects.filter(registry=self.registry).values_list(
+            "patient_id", "context_id", "form_name", "required", "filled", "percentage", "current", "has_data")
+        return ({(record.django_id, record.context_id): record.data for record in records},
+                sorted(rows))
+
+    def _count_queries(self, func, *args):
+        from contextlib import ExitStack
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+            func(*args)
+        return sum(len(queries) for queries in captured)
+
+    def test_bulk_progress_matches_form_progress(self):
+        from rdrf.forms.progress.bulk_progress import update_registry_progress
+        from rdrf.forms.progress.form_progress import FormProgress
+        from rdrf.models.definition.progress_models import PatientFormProgress
+
+        ClinicalData.objects.collection(self.registry.code, "progress").delete()
+        PatientFormProgress.objects.all().delete()
+        self.assertEqual(sum(update_registry_progress(self.registry, chunk_size=1)), 2)
+        bulk_records, bulk_rows = self._progress()
+        self.assertEqual(len(bulk_records), 2)
+        percentages = dict((patient_id, percentage)
+                           for patient_id, _, form_name, _, _, percentage, _, _ in bulk_rows
+                           if form_name == self.simple_form.name)
+        self.assertEqual(percentages, {self.patients[0].pk: 100, self.patients[1].pk: 50})
+
+        # the same as saving each patient's progress on its own
+        form_progress = FormProgress(self.registry)
+        for patient in self.patients[:2]:
+            context_model = patient.context_models[0]
+            progress_data = form_progress.save_for_patient(patient, context_model)
+            self.assertEqual(bulk_records[(patient.pk, context_model.pk)],
+                             dict(progress_data, context_id=context_model.pk))
+        self.assertEqual(self._progress(), (bulk_records, bulk_rows))
+
+    def test_bulk_progress_queries_bounded(self):
+        from rdrf.forms.progress.bulk_progress import BulkProgressCalculator
+        for i in range(3):
+            patient = self.create_patient()
+            self._save_form(patient, self.default_context, name="Wilma", age=30 + i)
+            self.patients.append(patient)
+        records = list(ClinicalData.objects.collection(self.registry.code, "cdes")
+                                           .filter(django_model="Patient")
+                                           .order_by("pk")
+                                           .values_list("django_id", "context_id", "data"))
+        self.assertEqual(len(records), 5)
+
+        # both calls update some progress records and create others
+        progress = ClinicalData.objects.collection(self.registry.code, "progress")
+        progress.filter(django_id__in=[self.patients[0].pk, self.patients[-1].pk]).delete()
+        calculator = BulkProgressCalculator(self.registry)
+        num_queries = self._count_queries(calculator.update_records, records[:2])
+        progress.filter(django_id__in=[patient.pk for patient in self.patients[-2:]]).delete()
+        self.assertEqual(self._count_queries(calculator.update_records, records), num_queries)
+
+    def test_backfill_from_progress_collection(self):
+        from importlib import import_module
+        from django.apps import apps
+        from rdrf.models.definition.progress_models import PatientFormProgress
+        migration = import_module("rdrf.migrations.0129_patientformprogress_backfill")
+
+        _, rows = self._progress()
+        self.assertTrue(rows)
+        PatientFormProgress.objects.filter(patient=self.patients[1]).delete()
+        migration.backfill_patient_form_progress(apps, None)
+        self.assertEqual(self._progress()[1], rows)
+
+        # records which already have rows are left alone
+        migration.backfill_patient_form_progress(apps, None)
+        self.assertEqual(self._progress()[1], rows)
+
+    def test_listing_annotations(self):
+        from rdrf.forms.progress.form_progress import FormProgress
+        from rdrf.models.definition.progress_models import PatientFormProgress
+        from rdrf.views.patients_listing import (ColumnDiagnosisCurrency, ColumnDiagnosisProgress,
+                                                 ColumnGeneticDataMap)
+        form_progress = FormProgress(self.registry)
+        fred, barney, no_data = [patient.pk for patient in self.patients]
+        patients = Patient.objects.filter(pk__in=[fred, barney, no_data])
+
+        progress_column = ColumnDiagnosisProgress("Diagnosis Entry Progress", "patients.can_see_diagnosis_progress")
+        self.assertIsNone(progress_column.annotation(True, form_progress))
+        field = progress_column.annotation_field
+        annotated = patients.annotate(**{field: progress_column.annotation(False, form_progress)})
+        self.assertEqual(list(annotated.order_by(field).values_list("pk", field)),
+                         [(no_data, 0), (barney, 50), (fred, 100)])
+        filtered = annotated.filter(**{field + "__gte": 50}).order_by("-" + field)
+        self.assertEqual(list(filtered.values_list("pk", flat=True)), [fred, barney])
+        self.assertEqual(progress_column.get_sort_fields(), [field])
+
+        currency_column = ColumnDiagnosisCurrency("Updated < 365 days", "patients.can_see_diagnosis_currency")
+        field = currency_column.annotation_field
+        annotated = patients.annotate(**{field: currency_column.annotation(False, form_progress)})
+        self.assertEqual(set(annotated.filter(**{field: True}).values_list("pk", flat=True)), {fred, barney})
+
+        # nothing was saved on the genetic forms
+        genetic_column = ColumnGeneticDataMap("Genetic Data", "patients.can_see_genetic_data_map")
+        field = genetic_column.annotation_field
+        annotated = patients.annotate(**{field: genetic_column.annotation(False, form_progress)})
+        self.assertFalse(annotated.filter(**{field: True}).exists())
+        has_data = patients.annotate(has_data=PatientFormProgress.objects.group_has_data(self.registry,
+                                                                                         [self.simple_form.name]))
+        self.assertEqual(set(has_data.filter(has_data=True).values_list("pk", flat=True)), {fred, barney})
+
+
+class RegistryGraphTestCase(FormTestCase):
+
+    def test_graph_matches_definition(self):
+        from rdrf.helpers.registry_graph import get_registry_graph
+        graph = get_registry_graph(self.registry)
+        self.assertEqual(graph.form_by_id(self.simple_form.pk).name, "simple")
+        self.assertEqual([s.code for s in graph.section_models(self.simple_form)],
+                         ["sectionA", "sectionB"])
+        self.assertEqual([c.code for c in graph.cde_models(self.sectionA)],
+                         ["CDEName", "CDEAge"])
+        self.assertTrue(graph.is_multisection("sectionC"))
+        key = self._create_form_key(self.simple_form, self.sectionA, "CDEAge")
+        form_model, section_model, cde_model = graph.models_from_mongo_key(key)
+        self.assertEqual((form_model.name, section_model.code, cde_model.code),
+                         ("simple", "sectionA", "CDEAge"))
+
+    def test_graph_rebuilt_on_definition_change(self):
+        from rdrf.helpers.registry_graph import get_registry_graph
+        graph = get_registry_graph(self.registry)
+        self.assertIs(graph, get_registry_graph(self.registry.code))
+        self.sectionA.elements = "CDEName"
+        self.sectionA.save()
+        new_graph = get_registry_graph(self.registry)
+        self.assertGreater(new_graph.version, graph.version)
+        self.assertEqual([c.code for c in new_graph.cde_models(self.sectionA)], ["CDEName"])
+
+    def test_graph_version_read_once_per_scope(self):
+        from rdrf.helpers.registry_graph import get_registry_graph
+        from rdrf.helpers.request_cache import request_cache_scope
+        graph = get_registry_graph(self.registry)
+        # outside a request each call checks the definition version
+        with self.assertNumQueries(1):
+            self.assertIs(get_registry_graph(self.registry), graph)
+        with request_cache_scope():
+            with self.assertNumQueries(1):
+                self.assertIs(get_registry_graph(self.registry), graph)
+                self.assertIs(get_registry_graph(self.registry.code), graph)
+            # changes made by the scope itself are still seen
+            self.sectionA.elements = "CDEName"
+            self.sectionA.save()
+            self.assertGreater(get_registry_graph(self.registry).version, graph.version)
+
+    def test_section_form_class_cached_per_policy_outcome(self):
+        from django.contrib.auth.models import Group
+        from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section
+        from rdrf.models.definition.models import CdePolicy
+        self.user.groups.add(Group.objects.create(name="form class test group"))
+        groups = self.user.groups.all()
+        form_class = create_form_class_for_section(self.registry, self.simple_form, self.sectionA,
+                                                   user_groups=groups, patient_model=self.patient)
+        self.assertIs(form_class, create_form_class_for_section(self.registry, self.simple_form, self.sectionA,
+                                                                user_groups=groups, patient_model=self.patient))
+
+        policy = CdePolicy.objects.create(registry=self.registry, cde=CommonDataElement.objects.get(code="CDEAge"))
+        policy.groups_allowed.add(Group.objects.create(name="policy test group"))
+        restricted = create_form_class_for_section(self.registry, self.simple_form, self.sectionA,
+                                                   user_groups=groups, patient_model=self.patient)
+        self.assertEqual(list(restricted.base_fields),
+                         [self._create_form_key(self.simple_form, self.sectionA, "CDEName")])
+        self.assertEqual(len(create_form_class_for_section(self.registry, self.simple_form,
+                                                           self.sectionA).base_fields), 2)
+
+    def test_design_mode_labels_stay_lazy(self):
+        from django.test import override_settings
+        from django.utils import translation
+        from django.utils.functional import Promise
+        from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section
+        with override_settings(DESIGN_MODE=True):
+            form_class = create_form_class_for_section(self.registry, self.simple_form, self.sectionA,
+                                                       is_superuser=True)
+        field = form_class.base_fields[self._create_form_key(self.simple_form, self.sectionA, "CDEName")]
+        # translated when the form is rendered, not when the cached field was built
+        self.assertIsInstance(field.label, Promise)
+        with translation.override("en"):
+            label = str(field.label)
+        self.assertIn("<a target='_blank'", label)
+        self.assertIn(CommonDataElement.objects.get(code="CDEName").name, label)
+
+
+class PermittedValuesCacheTestCase(TestCase):
+
+    def test_group_cached_until_changed(self):
+        from rdrf.helpers.permitted_values import get_permitted_values
+        group = CDEPermittedValueGroup.objects.create(code="cache_test_yn")
+        CDEPermittedValue.objects.create(pv_group=group, code="Y", value="Yes", position=1)
+        CDEPermittedValue.objects.create(pv_group=group, code="N", value="No", questionnaire_value="Nope", position=2)
+        self.assertEqual(group.members(), ["Y", "N"])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_permitted_values(group.code).display_value("N"), "No")
+            self.assertEqual(get_permitted_values(group.code).choices(questionnaire=True),
+                             [("Y", "Yes"), ("N", "Nope")])
+            self.assertIsNone(get_permitted_values(group.code).display_value(["Y", "N"]))
+        CDEPermittedValue.objects.create(pv_group=group, code="U", value="Unknown", position=3)
+        self.assertEqual(group.members(get_code=False), ["Yes", "No", "Unknown"])
+
+
+class PromsDownloadCursorTestCase(TestCase):
+
+    def test_cursor_round_trip(self):
+        from types import SimpleNamespace
+        from rdrf.services.rest.views.proms_api import make_cursor, parse_cursor
+        updated = datetime(2019, 3, 4, 5, 6, 7, 890)
+        survey_assignment = SimpleNamespace(pk=42, updated=updated)
+        self.assertEqual(parse_cursor(make_cursor(survey_assignment)), (updated, 42))
+        self.assertRaises(ValueError, parse_cursor, "not a cursor")
+
+
 class DeCamelcaseTestCase(TestCase):
 
     _EXPECTED_VALUE = "Your Condition"
@@ -1510,6 +2300,8 @@ class RemindersTestCase(TestCase):
                                         "registry": {"id": self.registry.id,
                                                      "app": "rdrf",
                                                      "model": "Registry"}})
+        enh.registry_code = self.registry.code
+        enh.user_id = self.user.id
 
         enh.save()
         enh.date_stamp = date_stamp
@@ -1620,6 +2412,26 @@ class RemindersTestCase(TestCase):
         print(lines)
         assert "not sent" in lines, "Expected reminder NOT to be sent if two or more already sent"
 
+    def test_reminder_dates_of_many_users(self):
+        from rdrf.services.io.notifications.reminders import can_send, get_reminder_dates
+        now = datetime.now()
+        self._setup_notification()
+        self._setup_user("reminded", now - timedelta(days=365))
+        reminded = self.user
+        self._create_dummy_history(now - timedelta(days=30))
+        self.user = None
+        self._setup_user("not_reminded", now - timedelta(days=365))
+        # sent before the last login so doesn't count
+        self._create_dummy_history(now - timedelta(days=400))
+
+        with self.assertNumQueries(1):
+            reminder_dates = get_reminder_dates(self.registry, [reminded, self.user])
+        self.assertEqual(len(reminder_dates[reminded.id]), 1)
+        self.assertEqual(reminder_dates[self.user.id], [])
+        self.assertTrue(can_send(reminder_dates[reminded.id], now))
+        self.assertFalse(can_send(reminder_dates[reminded.id], now - timedelta(days=20)))
+        self.assertFalse(can_send([now, now], now))
+
 
 class ClinicalDataTestCase(RDRFTestCase):
     def create_clinicaldata(self, patient_id, registry_code):
@@ -1718,6 +2530,68 @@ class ClinicalDataTestCase(RDRFTestCase):
         self.assertEqual(patient_model2.id, clinicaldata_model2.django_id)
 
 
+class FieldValuesTestCase(FormTestCase):
+
+    def setUp(self):
+        super(FieldValuesTestCase, self).setUp()
+        self.context_model = self.patient.context_models[0]
+        ff = FormFiller(self.simple_form)
+        ff.sectionA.CDEName = "Fred"
+        ff.sectionA.CDEAge = 20
+        request = self._create_request(self.simple_form, ff.data)
+        view = FormView()
+        view.request = request
+        view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.context_model.pk)
+
+    def _stale_value(self, patient_model, context_model, index=3):
+        # a value at a path the clinical data doesn't have
+        from explorer.models import FieldValue
+        return FieldValue.build(self.registry, patient_model.pk, context_model.pk, self.multi_form,
+                                self.sectionC, CommonDataElement.objects.get(code="CDEName"), index, "Old")
+
+    def _values(self, context_model):
+        from explorer.models import FieldValue
+        return dict(FieldValue.objects.filter(registry=self.registry, context=context_model)
+                                      .values_list("column_name", "raw_value"))
+
+    def test_create_field_values_remove_existing(self):
+        from explorer.utils import create_field_values
+        stale = self._stale_value(self.patient, self.context_model)
+        stale.save()
+
+        create_field_values(self.registry, self.patient, self.context_model)
+        values = self._values(self.context_model)
+        self.assertIn(stale.column_name, values)
+        self.assertIn("Fred", values.values())
+
+        create_field_values(self.registry, self.patient, self.context_model, remove_existing=True)
+        values = self._values(self.context_model)
+        self.assertNotIn(stale.column_name, values)
+        self.assertIn("Fred", values.values())
+
+    def test_create_registry_field_values(self):
+        from explorer.models import FieldValue
+        from explorer.utils import create_registry_field_values
+
+        # a patient without clinical data
+        other_patient = self.create_patient()
+        other_context = self.default_context
+        self._stale_value(self.patient, self.context_model).save()
+        self._stale_value(other_patient, other_context).save()
+        created = FieldValue.objects.filter(registry=self.registry, context=self.context_model).count() - 1
+
+        self.assertEqual(sum(create_registry_field_values(self.registry, batch_size=1, remove_existing=False)),
+                         created)
+        self.assertEqual(len(self._values(self.context_model)), created + 1)
+        self.assertEqual(len(self._values(other_context)), 1)
+
+        self.assertEqual(sum(create_registry_field_values(self.registry, batch_size=1)), created)
+        values = self._values(self.context_model)
+        self.assertEqual(len(values), created)
+        self.assertIn("Fred", values.values())
+        self.assertEqual(self._values(other_context), {})
+
+
 class UpdateCalculatedFieldsTestCase(FormTestCase):
 
     def setUp(self):
@@ -1733,10 +2607,10 @@ class UpdateCalculatedFieldsTestCase(FormTestCase):
                                     return cde["value"]
         self.form_value = form_value
 
-        from rdrf.management.commands.update_calculated_fields import context_ids_for_patient_and_form
-        context_ids = context_ids_for_patient_and_form(self.patient, self.simple_form.name, self.registry)
-        self.context_id = context_ids[0]
+        self.context_id = self.patient.context_models[0].id
+        self._save_simple_form(self.patient, self.context_id)
 
+    def _save_simple_form(self, patient, context_id):
         ff = FormFiller(self.simple_form)
         ff.sectionA.CDEName = "Fred"
         ff.sectionA.CDEAge = 20
@@ -1752,34 +2626,107 @@ class UpdateCalculatedFieldsTestCase(FormTestCase):
             request,
             self.registry.code,
             self.simple_form.pk,
-            self.patient.pk,
-            self.context_id)
+            patient.pk,
+            context_id)
 
-    def test_save_new_calculation(self):
-        # Check the CDE value is correctly setup.
+    def _record(self, patient, context_id):
         collection = ClinicalData.objects.collection(self.registry.code, "cdes")
-        db_record = collection.find(self.patient, self.context_id).data().first()
-        assert self.form_value(
-            self.simple_form.name,
-            self.sectionA.code,
-            "CDEAge",
-            db_record) == 20
-
-        # Change the CDE value and save it.
-        changed_calculated_cdes = {"CDEAge": {"old_value": 20, "new_value": 21, "section_code": "sectionA"}}
-        from rdrf.management.commands.update_calculated_fields import save_new_calculation
-        save_new_calculation(changed_calculated_cdes, self.context_id,
-                             self.simple_form.name, self.patient, self.registry)
+        return collection.find(patient, context_id).data().first()
 
-        # Check that the CDE value has been updated.
-        db_record = collection.find(self.patient, self.context_id).data().first()
-
-        cdeage_value = self.form_value(
-            self.simple_form.name,
-            self.sectionA.code,
-            "CDEAge",
-            db_record)
-        self.assertEqual(cdeage_value, 21)
+    def test_save_new_calculation(self):
+        from explorer.models import FieldValue
+        from rdrf.forms.fields.calculation_engine import CALCULATION_USER, CalculationEngine
+
+        cde_bmi = CommonDataElement.objects.get(code="CDEBMI")
+        history = ClinicalData.objects.collection(self.registry.code, "history").filter(
+            django_id=self.patient.pk, context_id=self.context_id)
+        num_snapshots = history.count()
+
+        engine = CalculationEngine(self.registry, patient_ids=[self.patient.pk])
+        chunks = engine.chunks()
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(engine.update_chunk(*chunks[0]), 1)
+
+        db_record = self._record(self.patient, self.context_id)
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionB.code, "CDEBMI", db_record), "25.96")
+        # the other values of the form are kept
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionA.code, "CDEName", db_record), "Fred")
+
+        # one snapshot of the recalculated form
+        self.assertEqual(history.count(), num_snapshots + 1)
+        snapshot = history.order_by("-pk").first()
+        self.assertEqual(snapshot.data["username"], CALCULATION_USER)
+        self.assertEqual(snapshot.data["form_name"], self.simple_form.name)
+
+        # the reporting field values follow the record
+        self.assertEqual(FieldValue.get_value(self.registry, self.patient, self.patient.context_models[0],
+                                              self.simple_form, self.sectionB, cde_bmi), "25.96")
+
+        # nothing left to recalculate
+        self.assertEqual(engine.update_chunk(*chunks[0]), 0)
+
+    def test_calculation_order(self):
+        from unittest.mock import patch
+        from rdrf.forms.fields import calculation_engine
+        from rdrf.forms.fields.calculation_engine import (CalculationCycleError, calculation_order,
+                                                          evaluate_calculations)
+
+        calculations = {"total": (lambda patient, context: context["double"] + 1, ("double", "unrelated")),
+                        "double": (lambda patient, context: context["base"] * 2, ("base",)),
+                        "base": (lambda patient, context: 5, ())}
+        with patch.dict(calculation_engine.CALCULATIONS, calculations):
+            self.assertEqual(calculation_order(["total", "double", "base"]), ["base", "double", "total"])
+            # unrelated cdes keep their order
+            self.assertEqual(calculation_order(["CDEBMI", "total", "double"]), ["CDEBMI", "double", "total"])
+
+            values, errors = evaluate_calculations(["total", "double", "base"], {}, {"base": 1})
+            self.assertEqual(list(values.items()), [("base", 5), ("double", 10), ("total", 11)])
+            self.assertEqual(errors, {})
+
+        cycle = {"first": (lambda patient, context: None, ("second",)),
+                 "second": (lambda patient, context: None, ("first",))}
+        with patch.dict(calculation_engine.CALCULATIONS, cycle):
+            with self.assertRaises(CalculationCycleError):
+                calculation_order(["first", "second"])
+
+    def test_chained_calculations_in_one_pass(self):
+        from unittest.mock import patch
+        from rdrf.forms.fields import calculation_engine
+        from rdrf.forms.fields.calculation_engine import CalculationEngine
+
+        # CDEAge comes before CDEBMI on the form but is calculated from it
+        calculations = {"CDEAge": (lambda patient, context: str(float(context["CDEBMI"]) * 2), ("CDEBMI",))}
+        with patch.dict(calculation_engine.CALCULATIONS, calculations):
+            engine = CalculationEngine(self.registry, cde_codes=["CDEAge", "CDEBMI"], patient_ids=[self.patient.pk])
+            self.assertEqual([cde_model.code for _, cde_model, _ in engine.calculations[self.simple_form.name]],
+                             ["CDEBMI", "CDEAge"])
+            self.assertEqual(engine.update_chunk(*engine.chunks()[0]), 1)
+
+        db_record = self._record(self.patient, self.context_id)
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionB.code, "CDEBMI", db_record), "25.96")
+        self.assertEqual(self.form_value(self.simple_form.name, self.sectionA.code, "CDEAge", db_record), "51.92")
+
+    def test_chunked_save(self):
+        from rdrf.forms.fields.calculation_engine import CalculationEngine, update_registry_calculations
+
+        patients = [self.patient]
+        for i in range(2):
+            patient = self.create_patient()
+            self._save_simple_form(patient, self.default_context.pk)
+            patients.append(patient)
+        patient_ids = [patient.pk for patient in patients]
+
+        engine = CalculationEngine(self.registry, patient_ids=patient_ids, chunk_size=2)
+        chunks = engine.chunks()
+        self.assertEqual(len(chunks), 2)
+        # chunks don't overlap
+        self.assertLess(chunks[0][1], chunks[1][0])
+
+        self.assertEqual(list(update_registry_calculations(self.registry, patient_ids=patient_ids, chunk_size=2)),
+                         [2, 1])
+        for patient in patients:
+            db_record = self._record(patient, patient.context_models[0].id)
+            self.assertEqual(self.form_value(self.simple_form.name, self.sectionB.code, "CDEBMI", db_record), "25.96")
 
     def test_update_calculated_fields_command(self):
 
@@ -28,6 +28,7 @@ from registration.backends.default.views import ActivationView
 from rdrf.views.family_linkage import FamilyLinkageView
 from rdrf.views.email_notification_view import ResendEmail
 from rdrf.views.permission_matrix import PermissionMatrixView
+from rdrf.views.performance_view import PerformanceView, PerformanceDataView
 from rdrf.views.lookup_views import UsernameLookup
 from rdrf.views.lookup_views import RecaptchaValidator
 from rdrf.views.context_views import RDRFContextCreateView, RDRFContextEditView
@@ -129,6 +130,8 @@ proms_patterns = [
     re_path(r'^import/?', import_registry_view.ImportRegistryView.as_view(),
             name='import_registry'),
     re_path(r'^router/', login_router.RouterView.as_view(), name="login_router"),
+    re_path(r'^performance/?$', PerformanceView.as_view(), name="performance"),
+    re_path(r'^performance/data/?$', PerformanceDataView.as_view(), name="performance_data"),
 
     re_path(r"^(?P<registry_code>\w+)/?$",
             registry_view.RegistryView.as_view(), name='registry'),
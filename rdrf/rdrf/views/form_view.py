@@ -15,12 +15,13 @@ from rdrf.models.definition.models import Section, CommonDataElement, ClinicalDa
 from registry.patients.models import Patient, ParentGuardian
 from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section
 from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.helpers.registry_graph import get_registry_graph
 from django.http import Http404
 from rdrf.forms.file_upload import wrap_fs_data_for_form
 from rdrf.forms.file_upload import wrap_file_cdes
 from rdrf.db import filestorage
 from rdrf.helpers.utils import de_camelcase, location_name, is_multisection, make_index_map
-from rdrf.helpers.utils import parse_iso_date
+from rdrf.helpers.utils import parse_iso_date, timed
 from rdrf.views.decorators.patient_decorators import patient_questionnaire_access
 from rdrf.forms.navigation.wizard import NavigationWizard, NavigationFormType
 from rdrf.models.definition.models import RDRFContext
@@ -31,7 +32,7 @@ from rdrf.helpers.utils import anonymous_not_allowed
 
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.db.contexts_api import RDRFContextError
-from explorer.utils import create_field_values
+from rdrf.db.post_save import schedule_form_save_jobs
 
 
 from django.shortcuts import redirect
@@ -226,6 +227,7 @@ class FormView(View):
         # when set to True in integration testing, switches off unsupported messaging middleware
         self.template = None
         self.registry = None
+        self.registry_graph = None
         self.dynamic_data = {}
         self.registry_form = None
         self.form_id = None
@@ -243,6 +245,18 @@ class FormView(View):
         except Registry.DoesNotExist:
             raise Http404("Registry %s does not exist" % registry_code)
 
+    def _get_registry_graph(self):
+        # the compiled registry definition is fetched once per request
+        if self.registry_graph is None or self.registry_graph.registry_model.code != self.registry.code:
+            self.registry_graph = get_registry_graph(self.registry)
+        return self.registry_graph
+
+    def _get_section_model(self, section_code):
+        section_model = self._get_registry_graph().section(section_code)
+        if section_model is None:
+            section_model = Section.objects.get(code=section_code)
+        return section_model
+
     def _get_dynamic_data(self, registry_code=None, rdrf_context_id=None,
                           model_class=Patient, id=None):
         obj = model_class.objects.get(pk=id)
@@ -532,7 +546,7 @@ class FormView(View):
         section_field_ids_map = {}
 
         for section_index, s in enumerate(sections):
-            section_model = Section.objects.get(code=s)
+            section_model = self._get_section_model(s)
             form_class = create_form_class_for_section(
                 registry,
                 form_obj,
@@ -541,7 +555,8 @@ class FormView(View):
                 injected_model_id=self.patient_id,
                 is_superuser=self.user.is_superuser,
                 user_groups=self.user.groups.all(),
-                patient_model=patient)
+                patient_model=patient,
+                registry_graph=self._get_registry_graph())
             section_elements = section_model.get_elements()
             section_element_map[s] = section_elements
             section_field_ids_map[s] = self._get_field_ids(form_class)
@@ -638,8 +653,6 @@ class FormView(View):
                 form_instance = section_info.recreate_form_instance()
                 form_section[section_info.section_code] = form_instance
 
-            progress_dict = dyn_patient.save_form_progress(
-                registry_code, context_model=self.rdrf_context)
             # Save one snapshot after all sections have being persisted
             dyn_patient.save_snapshot(
                 registry_code,
@@ -647,34 +660,11 @@ class FormView(View):
                 form_name=form_obj.name,
                 form_user=self.request.user.username)
 
-            # save report friendly field values
-            try:
-                if self.rdrf_context:
-                    create_field_values(registry,
-                                        patient,
-                                        self.rdrf_context,
-                                        remove_existing=True,
-                                        form_model=form_obj)
-            except Exception as ex:
-                logger.warning("error creating field values: %s" % ex)
-                raise
-
             if self.CREATE_MODE and dyn_patient.rdrf_context_id != "add":
                 # we've created the context on the fly so no redirect to the edit view on
                 # the new context
                 newly_created_context = RDRFContext.objects.get(id=dyn_patient.rdrf_context_id)
-                dyn_patient.save_form_progress(
-                    registry_code, context_model=newly_created_context)
-
-                try:
-                    create_field_values(registry,
-                                        patient,
-                                        newly_created_context,
-                                        remove_existing=True,
-                                        form_model=form_obj)
-                # TODO: the following line is smelly - it is eating all exceptions.
-                except Exception as ex:
-                    logger.warning("Error creating field values for new context: %s" % ex)
+                schedule_form_save_jobs(registry, patient, newly_created_context, form_obj)
 
                 return HttpResponseRedirect(
                     reverse(
@@ -688,6 +678,12 @@ class FormView(View):
             if dyn_patient.rdrf_context_id == "add":
                 raise Exception("Content not created")
 
+            # form progress and report friendly field values
+            if self.rdrf_context:
+                schedule_form_save_jobs(registry, patient, self.rdrf_context, form_obj)
+            progress_dict = FormProgress(registry).calculate_progress(
+                patient, dyn_patient.load_dynamic_data(registry_code, "cdes", flattened=False))
+
             if registry.has_feature("rulesengine"):
                 rules_block = registry.metadata.get("rules", {})
                 form_rules = rules_block.get(form_obj.name, [])
@@ -812,7 +808,7 @@ class FormView(View):
         ids = {}
         for s in section_parts:
             try:
-                sec = Section.objects.get(code=s.strip())
+                sec = self._get_section_model(s.strip())
                 display_names[s] = sec.display_name
                 ids[s] = sec.id
                 sections.append(s)
@@ -821,7 +817,10 @@ class FormView(View):
         return sections, display_names, ids
 
     def get_registry_form(self, form_id):
-        return RegistryForm.objects.get(id=form_id)
+        form_model = None
+        if self.registry is not None:
+            form_model = self._get_registry_graph().form_by_id(form_id)
+        return form_model or RegistryForm.objects.get(id=form_id)
 
     def _get_form_class_for_section(self, registry, registry_form, section):
         return create_form_class_for_section(
@@ -831,7 +830,8 @@ class FormView(View):
             injected_model="Patient",
             injected_model_id=self.patient_id,
             is_superuser=self.request.user.is_superuser,
-            user_groups=self.request.user.groups.all())
+            user_groups=self.request.user.groups.all(),
+            registry_graph=self._get_registry_graph())
 
     def _get_formlinks(self, user, context_model=None):
         container_model = self.registry
@@ -851,6 +851,7 @@ class FormView(View):
         else:
             return []
 
+    @timed
     def _build_context(self, **kwargs):
         """
         :param kwargs: extra key value pairs to be passed into the built context
@@ -873,7 +874,7 @@ class FormView(View):
                 self.dynamic_data['questionnaire_context'] = 'au'
 
         for s in sections:
-            section_model = Section.objects.get(code=s)
+            section_model = self._get_section_model(s)
             form_class = self._get_form_class_for_section(
                 self.registry, self.registry_form, section_model)
             section_elements = section_model.get_elements()
@@ -988,12 +989,12 @@ class FormView(View):
         """
         json_dict = {}
         from rdrf.helpers.utils import id_on_page
+        registry_graph = self._get_registry_graph()
         for section in registry_form.get_sections():
             metadata = {}
-            section_model = Section.objects.filter(code=section).first()
+            section_model = registry_graph.section(section) or Section.objects.filter(code=section).first()
             if section_model:
-                for cde_code in section_model.get_elements():
-                    cde = CommonDataElement.objects.filter(code=cde_code).first()
+                for cde in registry_graph.cde_models(section_model):
                     if cde:
                         cde_code_on_page = id_on_page(registry_form, section_model, cde)
                         if cde.datatype.lower() == "date":
@@ -1210,14 +1211,15 @@ class QuestionnaireView(FormView):
         section_field_ids_map = {}
 
         for section in sections:
-            section_model = Section.objects.get(code=section)
+            section_model = self._get_section_model(section)
             section_elements = section_model.get_elements()
             section_element_map[section] = section_elements
             form_class = create_form_class_for_section(
                 registry,
                 questionnaire_form,
                 section_model,
-                questionnaire_context=self.questionnaire_context)
+                questionnaire_context=self.questionnaire_context,
+                registry_graph=self._get_registry_graph())
             section_field_ids_map[section] = self._get_field_ids(form_class)
 
             if not section_model.allow_multiple:
@@ -1439,7 +1441,8 @@ class QuestionnaireView(FormView):
 
     def _get_form_class_for_section(self, registry, registry_form, section):
         return create_form_class_for_section(
-            registry, registry_form, section, questionnaire_context=self.questionnaire_context)
+            registry, registry_form, section, questionnaire_context=self.questionnaire_context,
+            registry_graph=self._get_registry_graph())
 
 
 class QuestionnaireHandlingView(View):
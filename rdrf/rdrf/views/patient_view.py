@@ -7,7 +7,7 @@ from django.urls import reverse
 from django.http import HttpResponseRedirect
 
 from rdrf.models.definition.models import Registry
-from rdrf.models.definition.models import CdePolicy
+from rdrf.helpers.registry_graph import get_registry_graph
 from rdrf.helpers.utils import consent_status_for_patient
 from rdrf.helpers.utils import anonymous_not_allowed
 
@@ -1078,12 +1078,10 @@ class PatientEditView(View):
             self, user, form_class, registry_model, patient=None):
         additional_fields = OrderedDict()
         field_pairs = self._get_registry_specific_fields(user, registry_model)
+        registry_graph = get_registry_graph(registry_model)
 
         for cde, field_object in field_pairs:
-            try:
-                cde_policy = CdePolicy.objects.get(registry=registry_model, cde=cde)
-            except CdePolicy.DoesNotExist:
-                cde_policy = None
+            cde_policy = registry_graph.cde_policy(cde.code)
 
             if cde_policy is None:
                 additional_fields[cde.code] = field_object
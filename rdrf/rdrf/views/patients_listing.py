@@ -11,11 +11,12 @@ from django.shortcuts import render
 from django.db.models import Q
 from django.core.paginator import Paginator, InvalidPage
 from rdrf.models.definition.models import Registry
+from rdrf.models.definition.progress_models import PatientFormProgress
 from rdrf.forms.progress.form_progress import FormProgress
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.forms.components import FormGroupButton
 from registry.patients.models import Patient
-from rdrf.helpers.utils import MinType
+from rdrf.helpers.utils import MinType, timed
 from rdrf.helpers.utils import consent_check
 from django.utils.translation import ugettext as _
 
@@ -207,9 +208,11 @@ class PatientsListingView(View):
         sort_field = request.POST.get(column_name, None)
         return sort_field, sort_direction
 
+    @timed
     def run_query(self):
         self.get_initial_queryset()
         self.filter_by_user_group()
+        self.apply_annotations()
         self.apply_ordering()
         self.record_total = self.patients.count()
         self.apply_search_filter()
@@ -231,7 +234,8 @@ class PatientsListingView(View):
     def apply_custom_ordering(self, qs):
         key_func = [col.sort_key(self.supports_contexts, self.form_progress, self.rdrf_context_manager)
                     for col in self.columns
-                    if col.field == self.sort_field and col.sort_key and not col.sort_fields]
+                    if col.field == self.sort_field and col.sort_key and not col.get_sort_fields(self.supports_contexts)]
+        key_func = [k for k in key_func if k is not None]
 
         if key_func:
             # we have to retrieve all rows - otherwise , queryset has already been
@@ -250,6 +254,7 @@ class PatientsListingView(View):
         else:
             return qs
 
+    @timed
     def get_rows_in_page(self):
         results = self.apply_custom_ordering(self.patients)
 
@@ -328,12 +333,23 @@ class PatientsListingView(View):
             self.patients = self.patients.filter(
                 rdrf_registry__in=self.registry_queryset)
 
+    def apply_annotations(self):
+        # progress columns are read from the precomputed PatientFormProgress table
+        # so that they can be sorted and paged in the database
+        annotations = {}
+        for col in self.columns:
+            annotation = col.annotation(self.supports_contexts, self.form_progress)
+            if annotation is not None:
+                annotations[col.annotation_field] = annotation
+        if annotations:
+            self.patients = self.patients.annotate(**annotations)
+
     def apply_ordering(self):
         if self.sort_field and self.sort_direction:
             def sdir(field):
                 return "-" + field if self.sort_direction == "desc" else field
 
-            sort_fields = chain(*[map(sdir, col.sort_fields)
+            sort_fields = chain(*[map(sdir, col.get_sort_fields(self.supports_contexts))
                                   for col in self.columns
                                   if col.field == self.sort_field])
 
@@ -351,6 +367,8 @@ class PatientsListingView(View):
 class Column(object):
     field = "id"
     sort_fields = ["id"]
+    # name of the queryset annotation holding the value of the column, if any
+    annotation_field = None
     bottom = MinType()
 
     def __init__(self, label, perm):
@@ -366,6 +384,13 @@ class Column(object):
     def get_sort_value_for_none(self):
         return self.bottom
 
+    def get_sort_fields(self, supports_contexts=False):
+        return self.sort_fields
+
+    def annotation(self, supports_contexts=False, form_progress=None):
+        # an expression annotated onto the patients queryset as self.annotation_field
+        return None
+
     def sort_key(self, supports_contexts=False,
                  form_progress=None, context_manager=None):
 
@@ -443,6 +468,9 @@ class ColumnNonContexts(Column):
         if supports_contexts:
             # if registry supports contexts, should use the context browser
             return None
+        if self.annotation_field and hasattr(patient, self.annotation_field):
+            # annotated by the listing query
+            return getattr(patient, self.annotation_field)
         return self.cell_non_contexts(patient, form_progress, context_manager)
 
     def fmt(self, val):
@@ -450,6 +478,9 @@ class ColumnNonContexts(Column):
 
     def sort_key(self, supports_contexts=False,
                  form_progress=None, context_manager=None):
+        if supports_contexts:
+            # nothing to sort on
+            return None
 
         def sk(patient):
             value = self.cell(patient, supports_contexts, form_progress, context_manager)
@@ -479,8 +510,36 @@ class ColumnWorkingGroups(Column):
     sort_fields = ["working_groups__name"]
 
 
-class ColumnDiagnosisProgress(ColumnNonContexts):
+class ColumnProgressGroup(ColumnNonContexts):
+    progress_group = None
+
+    @property
+    def annotation_field(self):
+        # Patient already has attributes named like some of the fields
+        return "listing_%s" % self.field
+
+    def get_sort_fields(self, supports_contexts=False):
+        return [] if supports_contexts else [self.annotation_field]
+
+    def group_form_names(self, form_progress):
+        return form_progress._get_progress_metadata().get(self.progress_group, [])
+
+    def annotation(self, supports_contexts=False, form_progress=None):
+        if supports_contexts or form_progress is None:
+            return None
+        return self.group_annotation(form_progress.registry_model, self.group_form_names(form_progress))
+
+    def group_annotation(self, registry_model, form_names):
+        """Subclasses supply the PatientFormProgress expression for the group's forms"""
+        return None
+
+
+class ColumnDiagnosisProgress(ColumnProgressGroup):
     field = "diagnosis_progress"
+    progress_group = "diagnosis"
+
+    def group_annotation(self, registry_model, form_names):
+        return PatientFormProgress.objects.group_progress(registry_model, form_names)
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_progress("diagnosis", patient)
@@ -492,8 +551,12 @@ class ColumnDiagnosisProgress(ColumnNonContexts):
         return template % (progress_number, progress_number, progress_number)
 
 
-class ColumnDiagnosisCurrency(ColumnNonContexts):
+class ColumnDiagnosisCurrency(ColumnProgressGroup):
     field = "diagnosis_currency"
+    progress_group = "diagnosis"
+
+    def group_annotation(self, registry_model, form_names):
+        return PatientFormProgress.objects.group_current(registry_model, form_names)
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_currency("diagnosis", patient)
@@ -502,8 +565,12 @@ class ColumnDiagnosisCurrency(ColumnNonContexts):
         return self.icon(diagnosis_currency)
 
 
-class ColumnGeneticDataMap(ColumnNonContexts):
+class ColumnGeneticDataMap(ColumnProgressGroup):
     field = "genetic_data_map"
+    progress_group = "genetic"
+
+    def group_annotation(self, registry_model, form_names):
+        return PatientFormProgress.objects.group_has_data(registry_model, form_names)
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_has_data("genetic", patient)
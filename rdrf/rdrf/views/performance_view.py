@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.generic.base import View
+
+from rdrf.helpers.profiling import profile_summary, reset_profiles
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PerformanceView(View):
+    """
+    Request profiles per url name, as recorded by ProfilingMiddleware in this server process
+    """
+
+    @method_decorator(staff_member_required)
+    @method_decorator(login_required)
+    def get(self, request):
+        return render(request, "rdrf_cdes/performance.html", {
+            "location": "Performance",
+            "profiling_enabled": settings.PROFILING_ENABLED,
+            "url_stats": profile_summary(),
+        })
+
+    @method_decorator(staff_member_required)
+    @method_decorator(login_required)
+    def post(self, request):
+        reset_profiles()
+        return HttpResponseRedirect(reverse("performance"))
+
+
+class PerformanceDataView(View):
+
+    @method_decorator(staff_member_required)
+    @method_decorator(login_required)
+    def get(self, request):
+        return JsonResponse({
+            "profiling_enabled": settings.PROFILING_ENABLED,
+            "urls": profile_summary(),
+        })
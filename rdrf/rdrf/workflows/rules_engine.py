@@ -1,5 +1,10 @@
-from rdrf.models.definition.models import Section
-from rdrf.helpers.utils import get_full_path
+from collections import OrderedDict
+import hashlib
+import json
+
+from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.helpers.registry_graph import get_registry_graph
+from rdrf.helpers.utils import find_cde
 import logging
 
 logger = logging.getLogger(__name__)
@@ -31,91 +36,242 @@ class RulesEvaluationError(Exception):
     pass
 
 
+def _fail(error):
+    # errors are raised when the expression is evaluated, as the interpreter did
+    def evaluate(values):
+        raise error
+    return evaluate
+
+
+def _constant(value):
+    return lambda values: value
+
+
+def _get(field_spec):
+    # a cde without a value raises KeyError, as Patient.get_form_value does
+    return lambda values: values[field_spec]
+
+
+def _binary(op):
+    def compile_op(compiled_rules, expr):
+        left = compiled_rules.compile(expr[1])
+        right = compiled_rules.compile(expr[2])
+        return lambda values: op(left(values), right(values))
+    return compile_op
+
+
+def _compile_and(compiled_rules, expr):
+    operands = [compiled_rules.compile(e) for e in expr[1:]]
+    return lambda values: all(operand(values) for operand in operands)
+
+
+def _compile_or(compiled_rules, expr):
+    operands = [compiled_rules.compile(e) for e in expr[1:]]
+    return lambda values: any(operand(values) for operand in operands)
+
+
+def _compile_in(compiled_rules, expr):
+    element = compiled_rules.compile(expr[1])
+    items = [compiled_rules.compile(e) for e in expr[2]]
+    return lambda values: element(values) in [item(values) for item in items]
+
+
+def _compile_between(compiled_rules, expr):
+    value, low, high = [compiled_rules.compile(e) for e in expr[1:4]]
+
+    def evaluate(values):
+        v = value(values)
+        return v >= low(values) and v <= high(values)
+    return evaluate
+
+
+OPERATORS = {
+    Tokens.EQUALS: _binary(lambda left, right: left == right),
+    Tokens.LT: _binary(lambda left, right: left < right),
+    Tokens.GT: _binary(lambda left, right: left > right),
+    Tokens.GTE: _binary(lambda left, right: left >= right),
+    Tokens.LTE: _binary(lambda left, right: left <= right),
+    Tokens.AND: _compile_and,
+    Tokens.OR: _compile_or,
+    Tokens.IN: _compile_in,
+    Tokens.BETWEEN: _compile_between,
+}
+
+
+class CompiledRules(object):
+    """
+    A list of [condition, action] pairs compiled into closures over a dict of
+    cde values ( field spec -> value ). The cdes the conditions get are
+    resolved to form / section / cde once so the values of a patient can be
+    loaded with a single clinical data query.
+    """
+
+    def __init__(self, rules, registry_model):
+        self.graph = get_registry_graph(registry_model)
+        self.registry_model = self.graph.registry_model
+        # field spec -> (form name, section code, cde code, multisection)
+        self.cde_paths = OrderedDict()
+        self.blocks = [(self.compile(condition), action) for condition, action in rules]
+        self.form_names = sorted(set(path[0] for path in self.cde_paths.values()))
+
+    def compile(self, expr):
+        # atoms evaluate themselves
+        if not isinstance(expr, list):
+            return _constant(expr)
+        head = expr[0]
+        if head == Tokens.GET:
+            return self._compile_get(expr[1])
+        if head not in OPERATORS:
+            return _fail(RulesEvaluationError("Unknown head: %s" % head))
+        return OPERATORS[head](self, expr)
+
+    def _compile_get(self, field_spec):
+        if field_spec not in self.cde_paths:
+            try:
+                self.cde_paths[field_spec] = self._resolve(field_spec)
+            except (ValueError, LookupError) as ex:
+                return _fail(ex)
+        return _get(field_spec)
+
+    def _resolve(self, field_spec):
+        if "/" in field_spec:
+            form_name, section_code, cde_code = field_spec.split("/")
+            section_model = self.graph.section(section_code)
+            if section_model is None:
+                raise LookupError("Unknown section %s" % section_code)
+        else:
+            paths = [(form_model.name, section_model, field_spec)
+                     for form_model in self.graph.forms
+                     for section_model in self.graph.section_models(form_model)
+                     for cde_model in self.graph.cde_models(section_model)
+                     if cde_model.code == field_spec]
+            if len(paths) != 1:
+                raise ValueError("cde code %s is not unique or not used by registry %s" %
+                                 (field_spec, self.registry_model.code))
+            form_name, section_model, cde_code = paths[0]
+        return form_name, section_model.code, cde_code, section_model.allow_multiple
+
+    def values(self, record):
+        """
+        :param record: the nested cdes record of a patient ( or None )
+        :return: field spec -> value for the cdes the rules get
+        """
+        values = {}
+        for field_spec, (form_name, section_code, cde_code, multisection) in self.cde_paths.items():
+            found = find_cde(record, form_name, section_code, cde_code, multisection)
+            if found is None:
+                continue
+            values[field_spec] = [value for value in found if value] if multisection else found["value"]
+        return values
+
+    def flattened_values(self, patient_model, clinical_data):
+        # values from already loaded flattened form data
+        values = {}
+        for field_spec, (form_name, section_code, cde_code, multisection) in self.cde_paths.items():
+            try:
+                values[field_spec] = patient_model.get_form_value(self.registry_model.code, form_name,
+                                                                  section_code, cde_code,
+                                                                  multisection=multisection,
+                                                                  clinical_data=clinical_data)
+            except KeyError:
+                pass
+        return values
+
+    def load_values(self, patient_contexts):
+        """
+        Loads the values of many patients with one query
+        :param patient_contexts: (patient, context) pairs - models or ids
+        :return: (patient id, context id) -> values
+        """
+        if not self.cde_paths:
+            return {(getattr(patient, "pk", patient), getattr(context, "pk", context)): {}
+                    for patient, context in patient_contexts}
+        batch = DynamicDataWrapper.load_batch(self.registry_model.code, patient_contexts,
+                                              form_names=self.form_names)
+        return {key: self.values(record) for key, record in batch.items()}
+
+    def match(self, values):
+        """
+        :return: the action of the first condition that holds, or None
+        """
+        for condition, action in self.blocks:
+            if condition(values):
+                return action
+        return None
+
+
+def rules_hash(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# (registry code, rules hash) -> CompiledRules
+_compiled_rules = {}
+
+
+def compile_rules(rules, registry_model):
+    """
+    :return: the CompiledRules of a rule set, compiled once per definition version
+    """
+    key = (registry_model.code, rules_hash(rules))
+    compiled = _compiled_rules.get(key)
+    if compiled is None or compiled.graph is not get_registry_graph(registry_model):
+        compiled = CompiledRules(rules, registry_model)
+        _compiled_rules[key] = compiled
+    return compiled
+
+
+def evaluate_patients(rules, registry_model, patient_contexts, batch_size=500):
+    """
+    Runs a rule set across many patients, loading their clinical data in batches.
+    Actions aren't performed - use RulesEvaluator for that.
+    :param patient_contexts: patient models ( or a queryset ), evaluated against
+    their first record, or (patient, context) pairs
+    :return: generator of (patient, context, matched action or None)
+    """
+    compiled = compile_rules(rules, registry_model)
+
+    def evaluate_batch(batch):
+        all_values = compiled.load_values(batch)
+        for patient, context in batch:
+            values = all_values[(getattr(patient, "pk", patient), getattr(context, "pk", context))]
+            try:
+                action = compiled.match(values)
+            except Exception as ex:
+                logger.warning("Error evaluating rules for patient %s: %s" % (getattr(patient, "pk", patient), ex))
+                action = None
+            yield patient, context, action
+
+    batch = []
+    for item in patient_contexts:
+        batch.append(item if isinstance(item, tuple) else (item, None))
+        if len(batch) == batch_size:
+            yield from evaluate_batch(batch)
+            batch = []
+    if batch:
+        yield from evaluate_batch(batch)
+
+
 class RulesEvaluator:
     def __init__(self, rules, evaluation_context):
         self.rules = rules
         self.evaluation_context = evaluation_context
 
     def get_action(self):
-        for condition_block, action in self.rules:
-            condition = self._eval(condition_block)
-            if condition:
-                return self._eval_action(action)
-
-    def _eval(self, expr):
-        # atoms evaluate themselves
-        if not isinstance(expr, type([])):
-            return expr
-        else:
-            head = expr[0]
-            if head == Tokens.EQUALS:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) == self._eval(right)
-            elif head == Tokens.GET:
-                cde = expr[1]
-                value = self._get_cde_value(cde)
-                return value
-            elif head == Tokens.AND:
-                rest = expr[1:]
-                return all(map(self._eval, rest))
-            elif head == Tokens.OR:
-                rest = expr[1:]
-                return any(map(self._eval, rest))
-            elif head == Tokens.LT:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) < self._eval(right)
-            elif head == Tokens.GT:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) > self._eval(right)
-            elif head == Tokens.GTE:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) >= self._eval(right)
-            elif head == Tokens.LTE:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) <= self._eval(right)
-            elif head == Tokens.IN:
-                element = self._eval(expr[1])
-                a_list = list(map(self._eval, expr[2]))
-                result = element in a_list
-                return result
-            elif head == Tokens.BETWEEN:
-                value = self._eval(expr[1])
-                low = self._eval(expr[2])
-                high = self._eval(expr[3])
-                return value >= low and value <= high
-            else:
-                raise RulesEvaluationError("Unknown head: %s" % head)
-
-    def _get_cde_value(self, field_spec):
         patient_model = self.evaluation_context["patient_model"]
         registry_model = self.evaluation_context["registry_model"]
         context_id = self.evaluation_context.get("context_id", None)
         # faster to load this in
         clinical_data = self.evaluation_context.get("clinical_data", None)
 
-        if "/" in field_spec:
-            form_name, section_code, cde_code = field_spec.split("/")
+        compiled = compile_rules(self.rules, registry_model)
+        if clinical_data is None:
+            values = compiled.load_values([(patient_model, context_id)])[(patient_model.pk, context_id)]
         else:
-            form_name, section_code, cde_code = self._get_unique_field(field_spec)
+            values = compiled.flattened_values(patient_model, clinical_data)
 
-        section_model = Section.objects.get(code=section_code)
-
-        return patient_model.get_form_value(registry_model.code,
-                                            form_name,
-                                            section_code,
-                                            cde_code,
-                                            multisection=section_model.allow_multiple,
-                                            context_id=context_id,
-                                            clinical_data=clinical_data)
-
-    def _get_unique_field(self, cde_code):
-        registry_model = self.evaluation_context["registry_model"]
-        return get_full_path(registry_model, cde_code)
+        action = compiled.match(values)
+        if action is not None:
+            return self._eval_action(action)
 
     def _eval_action(self, action):
         if not isinstance(action, type([])):
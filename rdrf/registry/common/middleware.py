@@ -1,9 +1,14 @@
 import logging
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.deprecation import MiddlewareMixin
 from ccg_django_utils.conf import EnvConfig
 
+from rdrf.helpers.profiling import instrument_templates, profile_request, record_profile
+from rdrf.helpers.request_cache import start_request_cache, end_request_cache
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,3 +41,41 @@ class EnforceTwoFactorAuthMiddleware(MiddlewareMixin):
             return HttpResponseRedirect(reverse('two_factor:setup'))
 
         return None
+
+
+class RequestCacheMiddleware(object):
+    """
+    Gives each request its own rdrf.helpers.request_cache, dropped when the
+    response is returned.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start_request_cache()
+        try:
+            return self.get_response(request)
+        finally:
+            end_request_cache()
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles requests and aggregates the profiles per url name
+    ( see rdrf.helpers.profiling ). Only used if settings.PROFILING_ENABLED.
+    Install it first so that the queries of the other middleware are counted.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+        instrument_templates()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with profile_request() as profile:
+            response = self.get_response(request)
+        match = request.resolver_match
+        record_profile(match.view_name if match else "unresolved", profile)
+        return response
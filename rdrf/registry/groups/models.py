@@ -4,14 +4,17 @@ from django.core import validators
 from django.contrib.auth.models import AbstractBaseUser, UserManager, PermissionsMixin
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from django.contrib.auth.models import Group
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 
 from registration.signals import user_activated
 from registration.signals import user_registered
 
-from rdrf.models.definition.models import Registry
+from rdrf.helpers.request_cache import request_cached, invalidate_request_cache
+from rdrf.models.definition.models import Registry, RegistryForm
 from registry.groups import GROUPS as RDRF_GROUPS
 
 
@@ -82,10 +85,23 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     objects = UserManager()
 
+    def _request_cached(self, kind, func):
+        # unsaved users have nothing to share a cache entry with
+        if self.pk is None:
+            return func()
+        return request_cached((kind, self.pk), func)
+
+    def _cached_registries(self):
+        return self._request_cached("user_registries", lambda: list(self.registry.all()))
+
+    def _cached_groups(self):
+        # (id, name) pairs
+        return self._request_cached("user_groups", lambda: list(self.groups.values_list("id", "name")))
+
     @property
     def my_registry(self):
         if self.num_registries == 1:
-            return self.registry.first()
+            return self._cached_registries()[0]
 
     def get_full_name(self):
         full_name = "%s %s" % (self.first_name, self.last_name)
@@ -96,16 +112,16 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     @property
     def num_registries(self):
-        return self.registry.count()
+        return len(self._cached_registries())
 
     @property
     def registry_code(self):
         if self.num_registries == 1:
-            return self.registry.first().code
+            return self._cached_registries()[0].code
 
     def can(self, verb, datum):
         if verb == "see":
-            return any([registry.shows(datum) for registry in self.registry.all()])
+            return any([registry.shows(datum) for registry in self._cached_registries()])
 
     @property
     def can_archive(self):
@@ -128,10 +144,12 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
             seen=False).order_by("-created")
 
     def in_registry(self, registry_model):
-        return self.registry.filter(pk=registry_model.pk).exists()
+        return any(registry.pk == registry_model.pk for registry in self._cached_registries())
 
     def in_group(self, name):
-        return self.groups.filter(name__icontains=name).exists()
+        # case insensitive substring match, as name__icontains
+        name = name.lower()
+        return any(name in group_name.lower() for _, group_name in self._cached_groups())
 
     @property
     def is_patient(self):
@@ -190,12 +208,11 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     def has_feature(self, feature):
         if not self.is_superuser:
-            return any([r.has_feature(feature) for r in self.registry.all()])
+            return any([r.has_feature(feature) for r in self._cached_registries()])
         else:
             return any([r.has_feature(feature) for r in Registry.objects.all()])
 
     def add_group(self, group_name):
-        from django.contrib.auth.models import Group
         existing_groups = [g.name for g in self.groups.all()]
         if group_name not in existing_groups:
             group = Group.objects.get(name=group_name)
@@ -205,22 +222,17 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         if self.is_superuser:
             return True
 
-        form_registry = registry_form_model.registry
-        my_registries = [r for r in self.registry.all()]
-
-        if form_registry not in my_registries:
+        if not any(registry.pk == registry_form_model.registry_id for registry in self._cached_registries()):
             return False
 
         if registry_form_model.open:
             return True
 
-        form_allowed_groups = [g for g in registry_form_model.groups_allowed.all()]
-
-        for group in self.groups.all():
-            if group in form_allowed_groups:
-                return True
+        form_allowed_groups = request_cached(
+            ("form_groups", registry_form_model.pk),
+            lambda: set(registry_form_model.groups_allowed.values_list("id", flat=True)))
 
-        return False
+        return any(group_id in form_allowed_groups for group_id, _ in self._cached_groups())
 
     @property
     def menu_links(self):
@@ -312,3 +324,20 @@ def user_activated_callback(sender, user, request, **kwargs):
         process_notification(registry_code,
                              email_notification_description,
                              template_data)
+
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+@receiver([post_save, post_delete], sender=Group)
+def user_groups_changed(sender, **kwargs):
+    invalidate_request_cache("user_groups")
+
+
+@receiver(m2m_changed, sender=CustomUser.registry.through)
+@receiver([post_save, post_delete], sender=Registry)
+def user_registries_changed(sender, **kwargs):
+    invalidate_request_cache("user_registries")
+
+
+@receiver(m2m_changed, sender=RegistryForm.groups_allowed.through)
+def form_groups_changed(sender, **kwargs):
+    invalidate_request_cache("form_groups")
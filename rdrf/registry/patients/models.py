@@ -107,6 +107,42 @@ class NextOfKinRelationship(models.Model):
         return self.relationship
 
 
+def _split_genetic_forms(registry_model):
+    # clinical forms and genetic forms ( by name, as FormProgress groups them )
+    from rdrf.helpers.registry_graph import get_registry_graph
+    form_names = [form_model.name for form_model in get_registry_graph(registry_model).forms]
+    genetic = [name for name in form_names if "genetic" in name.lower()]
+    return [name for name in form_names if name not in genetic], genetic
+
+
+def _patient_records(registry_model, patient_ids=None):
+    records = ClinicalData.objects.collection(registry_model.code, "cdes").filter(django_model="Patient")
+    if patient_ids is not None:
+        records = records.filter(django_id__in=list(patient_ids))
+    return records
+
+
+def clinical_data_current_ids(registry_model, days=365, patient_ids=None):
+    """
+    Ids of the patients with a clinical ( non genetic ) form saved in the last days,
+    out of patient_ids or the whole registry
+    """
+    clinical_forms, _ = _split_genetic_forms(registry_model)
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    records = _patient_records(registry_model, patient_ids).updated_since(clinical_forms, since)
+    return set(records.values_list("django_id", flat=True))
+
+
+def genetic_data_ids(registry_model, patient_ids=None):
+    """
+    Ids of the patients with some genetic data filled in, out of patient_ids
+    or the whole registry
+    """
+    _, genetic_forms = _split_genetic_forms(registry_model)
+    records = _patient_records(registry_model, patient_ids).with_filled_forms(genetic_forms)
+    return set(records.values_list("django_id", flat=True))
+
+
 class PatientManager(models.Manager):
 
     def get_by_registry(self, *registries):
@@ -403,54 +439,16 @@ class Patient(models.Model):
         If some clinical form ( non genetic ) has been updated  in the window
         then the data for that registry is considered "current" - this mirrors
         """
-        time_window_start = datetime.datetime.now() - datetime.timedelta(days=days)
-        currency_map = {}
-        for registry_model in self.rdrf_registry.all():
-            last_updated_in_window = False
-            for form_model in registry_model.forms:
-                if "genetic" in form_model.name.lower():
-                    continue
-                form_timestamp = self.get_form_timestamp(form_model)
-                if form_timestamp and form_timestamp >= time_window_start:
-                    last_updated_in_window = True
-                    break
-            currency_map[registry_model.code] = last_updated_in_window
-
-        return currency_map
+        return {registry_model.code: self.pk in clinical_data_current_ids(registry_model, days, [self.pk])
+                for registry_model in self.rdrf_registry.all()}
 
     @property
     def genetic_data_map(self):
         """
         map of reg code to Boolean iff patient has some genetic data filled in
         """
-        registry_genetic_progress = {}
-
-        class Sentinel(Exception):
-            pass
-
-        for registry_model in self.rdrf_registry.all():
-            has_data = False
-            try:
-                for form_model in registry_model.forms:
-                    if "genetic" in form_model.name.lower():
-                        for section_model in form_model.section_models:
-                            for cde_model in section_model.cde_models:
-                                try:
-                                    self.get_form_value(registry_model.code,
-                                                        form_model.name,
-                                                        section_model.code,
-                                                        cde_model.code,
-                                                        section_model.allow_multiple)
-
-                                    # got value for at least one field
-                                    raise Sentinel()
-                                except KeyError:
-                                    pass
-            except Sentinel:
-                has_data = True
-
-            registry_genetic_progress[registry_model.code] = has_data
-        return registry_genetic_progress
+        return {registry_model.code: self.pk in genetic_data_ids(registry_model, [self.pk])
+                for registry_model in self.rdrf_registry.all()}
 
     def get_form_value(
             self,
@@ -467,14 +465,19 @@ class Patient(models.Model):
         # ( allows faster retrieval of multiple values
         from rdrf.helpers.utils import mongo_key
 
+        key = mongo_key(form_name, section_code, data_element_code)
+
         if clinical_data is None:
+            # look up just this cde rather than loading the whole record
             wrapper = DynamicDataWrapper(self, rdrf_context_id=context_id)
-            data = wrapper.load_dynamic_data(registry_code, "cdes")
-        else:
-            data = clinical_data
-
-        key = mongo_key(form_name, section_code, data_element_code)
+            found = wrapper.find_cde(registry_code, form_name, section_code, data_element_code, multisection)
+            if found is None:
+                raise KeyError(key)
+            if multisection:
+                return [value for value in found if value]
+            return found["value"]
 
+        data = clinical_data
         if data is None:
             # no clinical data
             raise KeyError(key)
@@ -983,9 +986,15 @@ class Patient(models.Model):
         # we get KeyErrors
         # can't use None to sort so we have to use this tricky thing
         bottom = MinType()
+        contexts = [c for c in self.context_models
+                    if c.context_form_group is not None and c.context_form_group.pk == multiple_form_group.pk]
+        naming_values = self._naming_cde_values(multiple_form_group, contexts)
 
         def keyfunc(context_model):
             name_path = multiple_form_group.naming_cde_to_use
+            if naming_values is not None:
+                value = naming_values.get(context_model.pk)
+                return bottom if value is None else value
             if name_path:
                 form_name, section_code, cde_code = name_path.split("/")
                 section_model = Section.objects.get(code=section_code)
@@ -1014,11 +1023,28 @@ class Patient(models.Model):
             def key_func(c):
                 return c.created_at
 
-        contexts = [c for c in self.context_models
-                    if c.context_form_group is not None and c.context_form_group.pk == multiple_form_group.pk]
-
         return sorted(contexts, key=key_func, reverse=True)
 
+    def _naming_cde_values(self, multiple_form_group, contexts):
+        """
+        :return: context id -> value of the naming cde, loaded with one query using the
+        indexed cde value expression ( see rdrf.db.clinical_indexes ) - None for a
+        multisection naming cde
+        """
+        if multiple_form_group.ordering != "N" or not multiple_form_group.naming_cde_to_use:
+            return None
+        form_name, section_code, cde_code = multiple_form_group.naming_cde_to_use.split("/")
+        section_model = Section.objects.get(code=section_code)
+        if section_model.allow_multiple:
+            return None
+        records = ClinicalData.objects.collection(multiple_form_group.registry.code, "cdes").find(self).filter(
+            context_id__in=[context_model.pk for context_model in contexts])
+        naming_values = {}
+        for context_id, value in (records.with_cde_value(form_name, section_code, cde_code)
+                                         .order_by("pk").values_list("context_id", "cde_value")):
+            naming_values.setdefault(context_id, value)
+        return naming_values
+
     def get_forms_by_group(self, context_form_group):
         """
         Return links (pair of url and text)